@@ -1,23 +1,152 @@
-from PIL import Image, ImageDraw, ImageFont
-from PyQt5.QtWidgets import *
-from PyQt5.QtCore import Qt
-import os, sys
+from collections import namedtuple, OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from itertools import compress
+from array import array
+import os, io, re, sys, math, json, mmap, time, zlib, queue, bisect, shutil, struct, argparse, tempfile, threading
+import importlib.util
+
+# Stands for a module that is only imported the first time one of its attributes is used.
+# importlib.util.LazyLoader is not used because other threads can see its modules half loaded; import_module waits for them
+class LazyModule:
+    def __init__(self, name):
+        self.__dict__["name"] = name
+        
+    def __getattr__(self, attribute):
+        return getattr(importlib.import_module(self.name), attribute)
+        
+    def __setattr__(self, attribute, value):
+        setattr(importlib.import_module(self.name), attribute, value)
+
+# A module that is only loaded when it is first used, or None if it is not installed.
+# Pillow and NumPy take longer to import than everything else together, and the window and the command line help
+# do not need them. Folder scans only need Pillow when the headers of the images are read
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        return None
+    return LazyModule(name)
+
+Image = lazy_import("PIL.Image")
+if Image is None:
+    raise ImportError("AutoScale needs Pillow: pip install Pillow")
+ImageDraw = lazy_import("PIL.ImageDraw")
+ImageFont = lazy_import("PIL.ImageFont")
+ImageColor = lazy_import("PIL.ImageColor")
+PngImagePlugin = lazy_import("PIL.PngImagePlugin")
+TiffImagePlugin = lazy_import("PIL.TiffImagePlugin")
+JpegImagePlugin = lazy_import("PIL.JpegImagePlugin")
+BmpImagePlugin = lazy_import("PIL.BmpImagePlugin")
+ImageSequence = lazy_import("PIL.ImageSequence")
+# Optional: only used to draw on 16 bit and floating point images
+numpy = lazy_import("numpy")
+# Only used for archive output
+tarfile = lazy_import("tarfile")
+zipfile = lazy_import("zipfile")
+# Always installed, but only needed by some commands: the worker pools (which load logging), catalogs, the thumbnail
+# and build caches, and the daemon
+futures = LazyModule("concurrent.futures")
+sqlite3 = LazyModule("sqlite3")
+hashlib = LazyModule("hashlib")
+socket = LazyModule("socket")
+socketserver = LazyModule("socketserver")
 
 # A program that sets scales on many images at once.
 # Priority was to be as easy to use as possible for a specific microscope, so other cameras can require a bit of tweaking.
+# This file has everything needed to process images and never loads Qt; the window is in AutoScaleGUI.py.
 
-# Constants
+# Constants. Built-in calibration of the lab microscope; a calibration profile can replace them (see CalibrationProfile)
 ZOOM_10X = 2.604169
 ZOOM_50X = 12.84722
 ZOOM_100X = 25.5002
 
+# Pixel per unit of each zoom level that can be chosen
+Zoom_Levels = {"10x": ZOOM_10X, "50x": ZOOM_50X, "100x": ZOOM_100X}
+
 # List of image filenames
 Valid_Filenames = [".jpeg", ".jpg", ".jfif", ".png", ".bmp", ".tif", ".tiff", ".gif"]
 
-# Adds a scale to an image
-def add_scale(input_image, pixel_per_unit = ZOOM_10X, bar_width_unit = 30, unit = "um", color = "white"):
-    # Load image as drawable
-    drawing = ImageDraw.Draw(input_image)
+# Fonts for the scale text, tried in order. Bare names are looked up in the system font folders by Pillow
+Font_Candidates = ["arial.ttf", "C:\\Windows\\Fonts\\arial.ttf", "/Library/Fonts/Arial.ttf", "/System/Library/Fonts/Supplemental/Arial.ttf",
+                   "DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "/usr/share/fonts/TTF/DejaVuSans.ttf",
+                   "LiberationSans-Regular.ttf", "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf"]
+
+# Find the first usable font. Returns None if there is none, in which case Pillow's default font is used
+@lru_cache(maxsize = None)
+def find_font():
+    for candidate in Font_Candidates:
+        try:
+            ImageFont.truetype(candidate, 10)
+            return candidate
+        except OSError:
+            pass
+    return None
+
+@lru_cache(maxsize = 32)
+def load_font(font_path, size):
+    if font_path is None:
+        return ImageFont.load_default()
+    return ImageFont.truetype(font_path, max(1, size))
+
+# Width of a string. textsize was removed in newer Pillow versions
+def text_width(drawing, text, font = None):
+    if hasattr(drawing, "textsize"):
+        return drawing.textsize(text, font = font)[0]
+    return drawing.textlength(text, font = font)
+
+# Box (left, top, right, bottom) covered by a string drawn at (0, 0)
+def text_box(font, text):
+    if hasattr(font, "getbbox"):
+        return font.getbbox(text)
+    width, height = font.getsize(text)
+    offset_x, offset_y = font.getoffset(text) if hasattr(font, "getoffset") else (0, 0)
+    return (offset_x, offset_y, width, height)
+
+# A pre-rendered scale: patch is an RGBA image (scale color, alpha = coverage) to be put at origin.
+# hard_mask is the same scale without anti-aliasing, for modes where ImageDraw does not anti-alias text (palette, 1-bit...)
+Overlay = namedtuple("Overlay", ["origin", "patch", "hard_mask", "color", "font"])
+
+# Keeps the most recently used scales, so images of the same size and settings only render the scale once
+class OverlayCache:
+    def __init__(self, maxsize = 64):
+        self.maxsize = maxsize
+        self.overlays = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        
+    def get(self, size, pixel_per_unit, bar_width_unit, unit, color, font_path = None):
+        if font_path is None:
+            font_path = find_font()
+        key = (tuple(size), float(pixel_per_unit), float(bar_width_unit), unit, color, font_path)
+        with self.lock:
+            overlay = self.overlays.get(key)
+            if overlay is not None:
+                self.hits = self.hits + 1
+                self.overlays.move_to_end(key)
+                return overlay
+            self.misses = self.misses + 1
+            
+        overlay = render_overlay(size, pixel_per_unit, bar_width_unit, unit, color, font_path)
+        with self.lock:
+            self.overlays[key] = overlay
+            while len(self.overlays) > self.maxsize:
+                self.overlays.popitem(last = False)
+        return overlay
+        
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.overlays), "maxsize": self.maxsize}
+        
+    def clear(self):
+        with self.lock:
+            self.overlays.clear()
+            self.hits = 0
+            self.misses = 0
+
+# Draw the scale (text and bar) for an image of the given size on a transparent patch
+def render_overlay(size, pixel_per_unit, bar_width_unit, unit, color, font_path = None):
+    width, height = size
     
     # String to print
     if unit == "um":
@@ -25,124 +154,3083 @@ def add_scale(input_image, pixel_per_unit = ZOOM_10X, bar_width_unit = 30, unit
         
     scale_string = str(int(bar_width_unit)) + " " + str(unit)
     
-    
     # Calculate location and size of scale bar
     bar_width = bar_width_unit * pixel_per_unit
     
-    image_bbox = input_image.getbbox()
+    scale_rect_end = (width * 0.95, height * 0.96)
+    scale_rect_start = ((width * 0.95) - bar_width, height * 0.95)
     
-    scale_rect_end = (image_bbox[2] * 0.95, image_bbox[3] * 0.96)
-    scale_rect_start = ((image_bbox[2] * 0.95) - bar_width, image_bbox[3] * 0.95)
+    # The position is based on the width of the text in the default font, as it always was
+    text_size = text_width(ImageDraw.Draw(Image.new("L", (1, 1))), scale_string)
+    scale_text_position = ((width * 0.95) - (bar_width / 2) - (text_size*2), height * 0.92)
     
-    text_size = drawing.textsize(scale_string)[0]
-    scale_text_position = ((image_bbox[2] * 0.95) - (bar_width / 2) - (text_size*2), image_bbox[3] * 0.92)
+    font = load_font(font_path, int(40*width/2096))
     
-    # Add scale: text and bar
-    font = ImageFont.truetype("C:\Windows\Fonts\\arial.ttf",int(40*image_bbox[2]/2096))
-    drawing.text(scale_text_position, scale_string, font=font,fill=color)
-    drawing.rectangle((scale_rect_start,scale_rect_end), fill=color) 
+    # Patch covering both the text and the bar
+    text_bbox = text_box(font, scale_string)
+    left = int(math.floor(min(scale_text_position[0] + text_bbox[0], scale_rect_start[0])))
+    top = int(math.floor(min(scale_text_position[1] + text_bbox[1], scale_rect_start[1])))
+    right = int(math.ceil(max(scale_text_position[0] + text_bbox[2], scale_rect_end[0]))) + 1
+    bottom = int(math.ceil(max(scale_text_position[1] + text_bbox[3], scale_rect_end[1]))) + 1
+    
+    # Add scale: text and bar, drawn as coverage so they can be put on images of any mode
+    masks = []
+    for fontmode in ("L", "1"):
+        mask = Image.new("L", (right - left, bottom - top), 0)
+        drawing = ImageDraw.Draw(mask)
+        drawing.fontmode = fontmode
+        drawing.text((scale_text_position[0] - left, scale_text_position[1] - top), scale_string, font=font, fill=255)
+        drawing.rectangle(((scale_rect_start[0] - left, scale_rect_start[1] - top), (scale_rect_end[0] - left, scale_rect_end[1] - top)), fill=255)
+        masks.append(mask)
+    
+    patch = Image.new("RGB", masks[0].size, color)
+    patch.putalpha(masks[0])
+    return Overlay((left, top), patch, masks[1], color, font)
+
+# Modes of scientific cameras (16 bit and floating point), which the scale is drawn on at their own bit depth
+Native_Modes = ("I;16", "I;16L", "I;16B", "I", "F")
+
+# Value of "white" in the native modes: the maximum of 16 bit data. "I" images are 16 bit files opened by Pillow.
+# Floating point images have no fixed maximum, so their brightest pixel is used instead
+Native_White = {"I;16": 65535, "I;16L": 65535, "I;16B": 65535, "I": 65535}
+
+# Value of a color in an image of a native mode: its gray level, as a fraction of white
+def native_value(color, white, integer = True):
+    value = ImageColor.getcolor(color, "L") / 255 * white
+    return int(round(value)) if integer else value
+
+# Blend the scale into a 2D NumPy array, in place. coverage is the alpha of the scale (0-255) for region, which is
+# a view of the array, so only the pixels under the scale are touched
+def blend_array(region, coverage, value):
+    alpha = coverage.astype(numpy.float32) / 255
+    blended = region * (1 - alpha) + value * alpha
+    if numpy.issubdtype(region.dtype, numpy.integer):
+        blended = numpy.rint(blended)
+    region[...] = blended
+
+# Box of the image covered by an overlay, cut to the image, and the same box in the overlay patch
+def clip_overlay(size, overlay):
+    left, top = overlay.origin
+    image_box = (max(left, 0), max(top, 0), min(left + overlay.patch.width, size[0]), min(top + overlay.patch.height, size[1]))
+    patch_box = (image_box[0] - left, image_box[1] - top, image_box[2] - left, image_box[3] - top)
+    return image_box, patch_box
+
+# Draw the scale straight into a 2D NumPy array, e.g. one plane of a 16 bit stack, without copying it.
+# white is the value of "white": by default the maximum of the integer type, or the maximum of the array for floats
+def render_scale_array(array, pixel_per_unit = ZOOM_10X, bar_width_unit = 50, unit = "um", color = "white", white = None, font_path = None, cache = None):
+    if cache is None:
+        cache = Overlay_Cache
+    height, width = array.shape[:2]
+    integer = numpy.issubdtype(array.dtype, numpy.integer)
+    if white is None:
+        white = numpy.iinfo(array.dtype).max if integer else max(1.0, float(array.max()))
+    overlay = cache.get((width, height), pixel_per_unit, bar_width_unit, unit, color, font_path)
+    image_box, patch_box = clip_overlay((width, height), overlay)
+    if image_box[0] >= image_box[2] or image_box[1] >= image_box[3]:
+        return array
+    coverage = numpy.asarray(overlay.patch.getchannel("A").crop(patch_box))
+    region = array[image_box[1]:image_box[3], image_box[0]:image_box[2]]
+    if region.ndim == 3:
+        coverage = coverage[:, :, None]
+    blend_array(region, coverage, native_value(color, white, integer))
+    return array
+
+# Put a scale on an image of a native mode. Only the box under the scale is converted to an array and back
+def paste_overlay_native(image, overlay):
+    if image.mode == "F":
+        white = max(1.0, image.getextrema()[1])
+    else:
+        white = Native_White[image.mode]
+    value = native_value(overlay.color, white, image.mode != "F")
+    if numpy is None:
+        # Without NumPy the text is not anti-aliased, but the value is still right
+        ImageDraw.Draw(image).bitmap(overlay.origin, overlay.hard_mask, fill=value)
+        return
+    image_box, patch_box = clip_overlay(image.size, overlay)
+    if image_box[0] >= image_box[2] or image_box[1] >= image_box[3]:
+        return
+    region = image.crop(image_box)
+    array = numpy.array(region)
+    blend_array(array, numpy.asarray(overlay.patch.getchannel("A").crop(patch_box)), value)
+    image.paste(Image.frombytes(image.mode, region.size, array.tobytes()), image_box[:2])
+
+# Put a pre-rendered scale on an image
+def paste_overlay(image, overlay):
+    if image.mode in ("RGB", "RGBA"):
+        image.paste(overlay.patch, overlay.origin, overlay.patch)
+    elif image.mode in Native_Modes:
+        paste_overlay_native(image, overlay)
+    else:
+        # Let ImageDraw find the right value of the color for other modes (palette, grayscale...)
+        drawing = ImageDraw.Draw(image)
+        mask = overlay.hard_mask if drawing.fontmode == "1" else overlay.patch.getchannel("A")
+        drawing.bitmap(overlay.origin, mask, fill=overlay.color)
+
+Overlay_Cache = OverlayCache()
+
+# Adds a scale to an image
+def add_scale(input_image, pixel_per_unit = ZOOM_10X, bar_width_unit = 30, unit = "um", color = "white", font_path = None, cache = None):
+    if cache is None:
+        cache = Overlay_Cache
+    overlay = cache.get(input_image.size, pixel_per_unit, bar_width_unit, unit, color, font_path)
+    paste_overlay(input_image, overlay)
         
     return input_image
 
-# Full image processing: open image, add scale, save image
-def process_image(filename, input_dir, output_dir, extra_string = "_with_scale", pixel_per_unit = ZOOM_10X, bar_width_unit = 50, 
-                    unit = "um", color = "white", lowercase = True):
-                    
-    # Get filename extension    
-    filename_no_extension, filename_extension = os.path.splitext(filename)
+# Extension of another format to save into (or None to keep the format of the input), with the pyramid setting of a job.
+# Pyramids are always TIFF files, whatever the input is
+def job_output_format(output_format, pyramid = False):
+    if pyramid and output_format not in (".tif", ".tiff"):
+        return ".tif"
+    return output_format
 
+# Name of the file written by process_image for an input file
+# output_format is the extension of another format to save into, e.g. ".png", or None to keep the format of the input
+def output_filename(filename, input_dir, output_dir, extra_string = "_with_scale", lowercase = True, output_format = None):
+    filename_no_extension, filename_extension = os.path.splitext(filename)
+    if output_format:
+        filename_extension = output_format
+    
     # Get the new path for the file if the output directory is not the same as the input
     if input_dir == output_dir:
         filename_new_path = filename_no_extension
     else:
         filename_new_path = filename_no_extension.replace(input_dir,output_dir)
+    
+    if lowercase:
+        filename_new_path = filename_new_path.lower()
+    
+    # Get new filename by taking the old one and adding the new string
+    return filename_new_path + extra_string + filename_extension
+
+# Measures how long the code inside the with block takes, as stats["seconds"][stage]. Does nothing if stats is None.
+# A stage that runs several times (once per frame of a stack) gets the total time
+@contextmanager
+def time_stage(stats, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            seconds = stats.setdefault("seconds", {})
+            seconds[stage] = seconds.get(stage, 0) + time.perf_counter() - start
+
+# Statistics of a decoded image, for the metrics
+def record_image(stats, image):
+    if stats is not None:
+        stats.update(mode = image.mode, width = image.width, height = image.height, pixels = image.width * image.height)
+
+# Checks done before processing a file, and creation of the output folder (unless create_folder is False).
+# Returns the name of the output file, or None if the file must be skipped
+def prepare_output(filename, input_dir, output_dir, extra_string = "_with_scale", lowercase = True, stats = None, output_format = None, create_folder = True):
+    
+    # Get filename extension    
+    filename_extension = os.path.splitext(filename)[1]
+    new_filename = output_filename(filename, input_dir, output_dir, extra_string, False, output_format)
         
     # Create directory if it doesn't exist
-    directory = os.path.dirname(filename_new_path)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    directory = os.path.dirname(new_filename)
+    if create_folder:
+        with time_stage(stats, "mkdir"):
+            # Several threads or workers can create the same folder at the same time
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok = True)
     
     if filename_extension.lower() not in Valid_Filenames:
-        print("File " + filename + "is not an image file. Skipping...")
-        return 1
+        print("File " + filename + " is not an image file. Skipping...", file = sys.stderr)
+        return None
 
 
     # If the image already has a scale, skip
     if extra_string in filename:
-        print("File " + filename + " already has scale. Skipping...")
-        return 1
-        
-    image = Image.open(filename)
-    add_scale(image, pixel_per_unit,bar_width_unit,unit,color)
+        print("File " + filename + " already has scale. Skipping...", file = sys.stderr)
+        return None
     
     if lowercase:
-        filename_new_path = filename_new_path.lower()
+        new_filename = output_filename(filename, input_dir, output_dir, extra_string, True, output_format)
+    return new_filename
+
+# Encoder settings for save_image, by output format. "default" keeps the Pillow defaults.
+# With "metadata", the EXIF data, ICC profile, resolution and TIFF description (ImageJ/OME calibration) of the input are kept.
+# "keep" reuses the quantization tables and subsampling of a JPEG input, or the compression of a TIFF input
+Encoder_Profiles = {
+    "default": {},
+    # Fastest to write, bigger files
+    "fast": {"PNG": {"compress_level": 1}, "JPEG": {"quality": 90, "subsampling": "4:2:0"}, "TIFF": {"compression": "raw"}, "metadata": True},
+    # Smaller files, a bit slower
+    "compact": {"PNG": {"compress_level": 6}, "JPEG": {"quality": 85, "subsampling": "4:2:0", "optimize": True},
+                "TIFF": {"compression": "tiff_lzw"}, "metadata": True},
+    # Best quality and smallest lossless files, slowest
+    "archive": {"PNG": {"compress_level": 9}, "JPEG": {"quality": 95, "subsampling": "4:4:4", "optimize": True},
+                "TIFF": {"compression": "tiff_adobe_deflate"}, "metadata": True},
+    # Same encoding as the input where possible
+    "match-source": {"JPEG": {"quality": "keep"}, "TIFF": {"compression": "keep"}, "metadata": True},
+}
+
+# Modes that some output formats can store. Images in other modes are converted when the format changes
+Format_Modes = {"JPEG": ("L", "RGB", "CMYK"), "BMP": ("1", "L", "P", "RGB", "RGBA"),
+                "PNG": ("1", "L", "LA", "P", "RGB", "RGBA", "I", "I;16")}
+
+# Format (as named by Pillow) of an output extension, e.g. "PNG" for ".png"
+def extension_format(extension):
+    image_format = Image.registered_extensions().get(extension.lower())
+    if image_format is None:
+        raise ValueError("Unknown image format " + repr(extension))
+    return image_format
+
+# Extension of an output format given as "png", ".PNG"... Checks that Pillow can write it
+def normalize_output_format(output_format):
+    if not output_format:
+        return None
+    extension = "." + output_format.lower().lstrip(".")
+    extension_format(extension)
+    return extension
+
+def convert_for_format(image, image_format):
+    modes = Format_Modes.get(image_format)
+    if modes is None or image.mode in modes:
+        return image
+    if image.mode in ("I", "I;16", "I;16B", "I;16L"):
+        # 16 bit to 8 bit
+        return image.convert("I").point(lambda value: value / 256).convert("L")
+    if "A" in image.mode and "RGBA" in modes:
+        return image.convert("RGBA")
+    if image.mode in ("F", "LA"):
+        return image.convert("L")
+    return image.convert("RGB")
+
+# Keyword arguments of Image.save for one encoder profile
+def encoder_options(image, image_format, encoder = "default"):
+    if encoder not in Encoder_Profiles:
+        raise ValueError("Unknown encoder profile " + repr(encoder) + " (use " + ", ".join(Encoder_Profiles) + ")")
+    profile = Encoder_Profiles[encoder]
+    options = dict(profile.get(image_format, {}))
+    if options.get("quality") == "keep" and image.format != "JPEG":
+        del options["quality"]
+    if options.get("compression") == "keep":
+        del options["compression"]
+        if image.format == "TIFF" and image.info.get("compression"):
+            options["compression"] = image.info["compression"]
     
-    # Get new filename by taking the old one and adding the new string
-    new_filename = filename_new_path + extra_string + filename_extension
+    if profile.get("metadata"):
+        if image.info.get("icc_profile"):
+            options["icc_profile"] = image.info["icc_profile"]
+        if image.info.get("exif") and image_format in ("JPEG", "PNG", "TIFF", "WEBP"):
+            options["exif"] = image.info["exif"]
+        if image.format == "TIFF" and image_format == "TIFF":
+            # Pillow already copies the resolution; the description can hold the calibration
+            if 270 in image.tag_v2:
+                options["description"] = image.tag_v2[270]
+        elif image.info.get("dpi"):
+            options["dpi"] = image.info["dpi"]
+    return options
+
+# Save an image to a filename or a file object. The format comes from the extension of filename
+def save_image(image, target, filename, encoder = "default"):
+    image_format = extension_format(os.path.splitext(filename)[1])
+    options = encoder_options(image, image_format, encoder)
+    if image.format is not None and image.format != image_format:
+        image = convert_for_format(image, image_format)
+    image.save(target, format = image_format, **options)
 
-    image.save(new_filename)
+# Stacks: TIFF and GIF files with several frames (z-stacks, time series). Every frame gets the scale, and the frames are
+# read, drawn on and written one at a time, so a stack of any length only needs the memory of one frame.
+
+# Format of the files that can hold stacks, by extension
+Stack_Formats = {".tif": "TIFF", ".tiff": "TIFF", ".gif": "GIF"}
+
+# True if the current frame of image is a reduced resolution page of a TIFF file (a pyramid level, a thumbnail), which is
+# not a frame of the stack (NewSubfileType, tag 254, bit 0)
+def is_reduced_page(image):
+    return image.format == "TIFF" and bool(image.tag_v2.get(254, 0) & 1)
+
+# Open filename if it is a stack that can be saved frame by frame as new_filename (same format), otherwise None. A TIFF
+# file whose other pages are only reduced resolution pages is a single image
+def open_stack(filename, new_filename):
+    image_format = Stack_Formats.get(os.path.splitext(filename)[1].lower())
+    if image_format is None or Stack_Formats.get(os.path.splitext(new_filename)[1].lower()) != image_format:
+        return None
+    image = Image.open(filename)
+    if image.format == image_format and getattr(image, "is_animated", False):
+        if image.format != "TIFF" or sum(not is_reduced_page(frame) for frame in ImageSequence.Iterator(image)) > 1:
+            image.seek(0)
+            return image
+    image.close()
+    return None
+
+# Appends frames to a multi-page TIFF file (a filename or a file object) as they are given
+class TiffStackWriter:
+    def __init__(self, target, options):
+        self.file = TiffImagePlugin.AppendingTiffWriter(target, True)
+        self.options = options
+        
+    def add(self, frame):
+        frame.save(self.file, format = "TIFF", **self.options)
+        self.file.newFrame()
+        
+    def close(self):
+        self.file.close()
+
+# Appends frames to an animated GIF file (a filename or a file object) as they are given. Pillow only writes all the frames
+# of a GIF at once, so every frame is saved as a GIF of its own and copied in, its global color table becoming the local
+# color table of the frame
+class GifStackWriter:
+    def __init__(self, target, loop = None, comment = None):
+        self.close_file = isinstance(target, str)
+        self.file = open(target, "wb") if self.close_file else target
+        self.loop = loop
+        self.comment = comment
+        self.frames = 0
+        
+    def add(self, frame):
+        options = {"duration": frame.info.get("duration", 0)}
+        for key in ("loop", "comment", "background"):
+            # File level blocks, written once after the header instead of in every frame
+            frame.info.pop(key, None)
+        if frame.mode in ("RGBA", "LA", "PA") or "transparency" in frame.info:
+            options["disposal"] = 2 # Frames are complete images, transparent parts must not show the previous frame
+        output = io.BytesIO()
+        frame.save(output, format = "GIF", **options)
+        data = output.getvalue()
+        
+        flags = data[10]
+        table_end = 13 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0)
+        body = data[table_end:data.rindex(b";")]
+        if self.frames == 0:
+            self.file.write(b"GIF89a" + data[6:table_end])
+            if self.loop is not None:
+                self.file.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", self.loop) + b"\0")
+            if self.comment:
+                comment = self.comment.encode() if isinstance(self.comment, str) else self.comment
+                self.file.write(b"!\xfe" + b"".join(bytes([len(comment[i:i + 255])]) + comment[i:i + 255]
+                                                    for i in range(0, len(comment), 255)) + b"\0")
+        elif flags & 0x80:
+            # Skip the extensions (frame duration...) to the image descriptor, and give it the color table
+            position = 0
+            while body[position] == 0x21:
+                position = position + 2
+                while body[position]:
+                    position = position + body[position] + 1
+                position = position + 1
+            descriptor = bytearray(body[position:position + 10])
+            descriptor[9] = descriptor[9] | 0x80 | (flags & 7)
+            body = body[:position] + bytes(descriptor) + data[13:table_end] + body[position + 10:]
+        self.file.write(body)
+        self.frames = self.frames + 1
+        
+    def close(self):
+        self.file.write(b";")
+        if self.close_file:
+            self.file.close()
+
+# Put the scale on every frame of an open stack and save it as target (a filename or a file object), leaving out the reduced
+# resolution pages. Fills stats like process_image, with the total time of every stage and the number of frames. Returns the
+# number of frames
+def save_stack(image, target, pixel_per_unit = ZOOM_10X, bar_width_unit = 50, unit = "um", color = "white", encoder = "default", stats = None):
+    if image.format == "GIF":
+        writer = GifStackWriter(target, image.info.get("loop"), image.info.get("comment"))
+    else:
+        writer = TiffStackWriter(target, encoder_options(image, "TIFF", encoder))
+    frames = 0
+    try:
+        for frame in ImageSequence.Iterator(image):
+            if is_reduced_page(frame):
+                continue
+            with time_stage(stats, "open"):
+                frame = frame.copy()
+                if image.format == "GIF" and frame.mode == "P":
+                    # Like the next frames, which Pillow reads in RGB: the palette may have no free entry for the scale color
+                    frame = frame.convert("RGBA" if "transparency" in frame.info else "RGB")
+            if frames == 0:
+                record_image(stats, frame)
+            with time_stage(stats, "draw"):
+                add_scale(frame, pixel_per_unit, bar_width_unit, unit, color)
+            with time_stage(stats, "save"):
+                writer.add(frame)
+            frames = frames + 1
+    finally:
+        writer.close()
+    if stats is not None:
+        stats["frames"] = frames
+    return frames
+
+# Bytes read and written, for the metrics. output is the output file, or the file object it was written to
+def record_sizes(stats, filename, output):
+    if stats is None:
+        return
+    if isinstance(output, str):
+        bytes_written = os.path.getsize(output)
+    else:
+        bytes_written = output.seek(0, os.SEEK_END)
+    stats.update(bytes_read = os.path.getsize(filename), bytes_written = bytes_written)
+
+# Full image processing: open image, add scale, save image.
+# encoder is a name of Encoder_Profiles, output_format an extension to save into another format (e.g. ".png").
+# With pyramid, the output is a tiled pyramid TIFF (see write_pyramid), saved as .tif unless output_format is ".tiff".
+# If target is a file object, the output is written into it instead, and nothing is created in the output folder.
+# If stats is a dict, it is filled with the time of every stage, the image size and the bytes read and written
+def process_image(filename, input_dir, output_dir, extra_string = "_with_scale", pixel_per_unit = ZOOM_10X, bar_width_unit = 50, 
+                    unit = "um", color = "white", lowercase = True, region_only = False, encoder = "default", output_format = None, pyramid = False,
+                    target = None, stats = None):
+    
+    output_format = job_output_format(output_format, pyramid)
+    new_filename = prepare_output(filename, input_dir, output_dir, extra_string, lowercase, stats, output_format, target is None)
+    if new_filename is None:
+        if stats is not None:
+            stats["skipped"] = True
+        return 1
+    output = new_filename if target is None else target
+    
+    # Tiled pyramid TIFF, written while the input is read
+    if pyramid:
+        write_pyramid(filename, output, pixel_per_unit, bar_width_unit, unit, color, encoder, stats)
+        record_sizes(stats, filename, output)
+        return 1
+    
+    # Stacks are written frame by frame
+    with time_stage(stats, "open"):
+        stack = open_stack(filename, new_filename)
+    if stack is not None:
+        with stack:
+            save_stack(stack, output, pixel_per_unit, bar_width_unit, unit, color, encoder, stats)
+        record_sizes(stats, filename, output)
+        return 1
+    
+    # Only rewrite the part of the file under the scale, if the file allows it. The file keeps its encoding
+    if region_only and target is None and not output_format and os.path.splitext(filename)[1].lower() in Region_Formats:
+        with time_stage(stats, "region"):
+            rewritten = rewrite_region(filename, new_filename, pixel_per_unit, bar_width_unit, unit, color)
+        if rewritten:
+            record_sizes(stats, filename, new_filename)
+            return 1
+    
+    with time_stage(stats, "open"):
+        image = Image.open(filename)
+        image.load()
+    record_image(stats, image)
+    with time_stage(stats, "draw"):
+        add_scale(image, pixel_per_unit,bar_width_unit,unit,color)
+
+    with time_stage(stats, "save"):
+        save_image(image, output, new_filename, encoder)
+    record_sizes(stats, filename, output)
     
     return 1
+
+
+# Previews: small copies of the images with the scale as add_scale would draw it on the full image.
+# Thumbnails are decoded at reduced resolution where the format allows it, and kept in an on-disk cache.
+
+# Pick the reduced resolution page of a TIFF file (NewSubfileType bit 0 set, same proportions) that is the smallest
+# still bigger than max_size. Stays on the first page if there is none
+def select_tiff_page(image, max_size):
+    width, height = image.size
+    best_page, best_width = 0, width
+    try:
+        for page in range(1, image.n_frames):
+            image.seek(page)
+            if not image.tag_v2.get(254, 0) & 1:
+                continue
+            if abs(image.width * height - image.height * width) > max(width, height) * 2:
+                continue
+            if max(image.size) >= max_size and image.width < best_width:
+                best_page, best_width = page, image.width
+    except (EOFError, OSError, ValueError):
+        pass
+    image.seek(best_page)
+
+# Reduced-size RGB copy of an image for previews. JPEG files are decoded directly at 1/2, 1/4 or 1/8 of their size,
+# TIFF files use their reduced resolution pages if they have any. Returns (thumbnail, size of the full image).
+# Images over the size limit of Pillow are only refused if the page to decode is itself that big
+def load_thumbnail(filename, max_size = 512):
+    with open_large_image(filename) as image:
+        full_size = image.size
+        if image.format == "TIFF":
+            select_tiff_page(image, max_size)
+        if image.format != "JPEG" and Image.MAX_IMAGE_PIXELS and image.width * image.height > 2 * Image.MAX_IMAGE_PIXELS:
+            raise Image.DecompressionBombError("Image of " + str(image.width * image.height) + " pixels without reduced resolution pages")
+        image.draft(image.mode, (max_size, max_size))
+        thumbnail = convert_for_format(image, "JPEG")
+        thumbnail.thumbnail((max_size, max_size))
+        return thumbnail.convert("RGB"), full_size
+
+# Thumbnail with the scale that add_scale would draw on the full image, scaled down with it
+def preview_image(thumbnail, full_size, pixel_per_unit = ZOOM_10X, bar_width_unit = 50, unit = "um", color = "white", font_path = None, cache = None):
+    if cache is None:
+        cache = Overlay_Cache
+    overlay = cache.get(full_size, pixel_per_unit, bar_width_unit, unit, color, font_path)
+    scale = thumbnail.width / full_size[0]
+    patch = overlay.patch.convert("RGBA")
+    patch = patch.resize((max(1, round(patch.width * scale)), max(1, round(patch.height * scale))), Image.BOX)
+    preview = thumbnail.copy()
+    preview.paste(patch, (round(overlay.origin[0] * scale), round(overlay.origin[1] * scale)), patch)
+    return preview
+
+# Folder for a cache of this user: thumbnails, catalogs
+def default_cache_folder(kind = "thumbnails"):
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(base, "MicroAutoScale", kind)
+
+# Thumbnails saved as small PNG files, named after the path, modification time and size of the image, so a changed
+# image never uses an old thumbnail. When the folder grows over max_bytes, the least recently used thumbnails are deleted.
+# If the folder cannot be written, thumbnails are simply not kept
+class ThumbnailCache:
+    def __init__(self, folder = None, max_bytes = 256 << 20, thumbnail_size = 512):
+        self.folder = folder or default_cache_folder()
+        self.max_bytes = max_bytes
+        self.thumbnail_size = thumbnail_size
+        self.total_bytes = None # Only counted when first needed
+        self.lock = threading.Lock()
+        
+    def path(self, filename):
+        stat = os.stat(filename)
+        key = "|".join((os.path.abspath(filename), str(stat.st_mtime_ns), str(stat.st_size), str(self.thumbnail_size)))
+        return os.path.join(self.folder, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".png")
+    
+    # (thumbnail, size of the full image) of a file
+    def get(self, filename):
+        path = self.path(filename)
+        try:
+            with Image.open(path) as cached:
+                cached.load()
+                full_size = tuple(int(value) for value in cached.info["full_size"].split("x"))
+                os.utime(path) # Recently used
+                return cached.convert("RGB"), full_size
+        except (OSError, KeyError, ValueError):
+            pass
+        
+        thumbnail, full_size = load_thumbnail(filename, self.thumbnail_size)
+        self.store(path, thumbnail, full_size)
+        return thumbnail, full_size
+    
+    def store(self, path, thumbnail, full_size):
+        info = PngImagePlugin.PngInfo()
+        info.add_text("full_size", str(full_size[0]) + "x" + str(full_size[1]))
+        try:
+            os.makedirs(self.folder, exist_ok = True)
+            temporary = path + "." + str(threading.get_ident()) + ".tmp"
+            thumbnail.save(temporary, format = "PNG", pnginfo = info, compress_level = 1)
+            os.replace(temporary, path)
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes = self.total_bytes + size
+            if self.total_bytes is None or self.total_bytes > self.max_bytes:
+                self.evict()
+    
+    # Delete the least recently used thumbnails until the cache is under 90% of max_bytes
+    def evict(self):
+        files = []
+        try:
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".png"):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+        self.total_bytes = sum(size for mtime, size, path in files)
+        if self.total_bytes <= self.max_bytes:
+            return
+        files.sort()
+        for mtime, size, path in files:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.total_bytes = self.total_bytes - size
+            except OSError:
+                pass
+    
+    def clear(self):
+        with self.lock:
+            shutil.rmtree(self.folder, ignore_errors = True)
+            self.total_bytes = 0
+
+
+# Region-only rewrite: the scale only covers a small box near the bottom right, so for large TIFF and JPEG files
+# only the strips, tiles or JPEG restart intervals under the scale are re-encoded. Everything else is copied as is.
+# Files that cannot be handled this way (unsupported compression, no restart markers...) are rewritten completely instead.
+
+Region_Formats = [".tif", ".tiff", ".jpeg", ".jpg", ".jfif"]
+
+# Byte size and struct format of TIFF field types
+Tiff_Type_Sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+Tiff_Type_Formats = {1: "B", 3: "H", 4: "L", 6: "b", 8: "h", 9: "l", 16: "Q", 17: "q", 18: "Q"}
+
+# TIFF compressions that can be decoded and encoded here: none and deflate
+Tiff_Compressions = [1, 8, 32946]
+
+# TIFF compressions that can be decoded here (for the pyramid input): also LZW
+Tiff_Decode_Compressions = Tiff_Compressions + [5]
+
+# First page of a TIFF file. The image is split in blocks (strips or tiles) of block_width x block_height pixels.
+# offsets_entry and counts_entry are (field type, file position) of the block offsets and byte counts, so they can be changed
+TiffLayout = namedtuple("TiffLayout", ["byte_order", "width", "height", "mode", "compression", "tiled", "block_width", "block_height",
+                                       "offsets", "byte_counts", "offsets_entry", "counts_entry"])
+
+# Byte order, offset of the first directory and whether it is a BigTIFF (64 bit offsets) of a TIFF file, or None if it
+# is not a TIFF
+def read_tiff_header(file):
+    header = file.read(16)
+    if header[:2] == b"II":
+        byte_order = "<"
+    elif header[:2] == b"MM":
+        byte_order = ">"
+    else:
+        return None
+    version = struct.unpack(byte_order + "H", header[2:4])[0] if len(header) >= 8 else None
+    if version == 42:
+        return byte_order, struct.unpack(byte_order + "L", header[4:8])[0], False
+    if version == 43 and len(header) == 16 and struct.unpack(byte_order + "HH", header[4:8]) == (8, 0):
+        return byte_order, struct.unpack(byte_order + "Q", header[8:])[0], True
+    return None
+
+# Read the entries of a TIFF directory, as {tag: (type, count, position of the values)}
+def read_tiff_entries(file, byte_order, ifd_offset, bigtiff = False):
+    count_format, entry_format, value_size = ("Q", "HHQ8s", 8) if bigtiff else ("H", "HHL4s", 4)
+    count_size, entry_size = struct.calcsize(count_format), 4 + 2 * value_size
+    file.seek(ifd_offset)
+    number_entries = struct.unpack(byte_order + count_format, file.read(count_size))[0]
+    entries = {}
+    for i in range(number_entries):
+        tag, field_type, count, value = struct.unpack(byte_order + entry_format, file.read(entry_size))
+        if Tiff_Type_Sizes.get(field_type, 1) * count <= value_size:
+            position = ifd_offset + count_size + entry_size*i + 4 + value_size
+        else:
+            position = struct.unpack(byte_order + ("Q" if bigtiff else "L"), value)[0]
+        entries[tag] = (field_type, count, position)
+    return entries
+
+def read_tiff_values(file, byte_order, entry):
+    field_type, count, position = entry
+    if field_type not in Tiff_Type_Formats:
+        return None
+    value_format = byte_order + str(count) + Tiff_Type_Formats[field_type]
+    file.seek(position)
+    return list(struct.unpack(value_format, file.read(struct.calcsize(value_format))))
+
+# Read the layout of the first page of a TIFF file. Returns None if it is not a TIFF whose blocks can be decoded here
+# (rewrite_tiff_region also needs them to be encoded again, see Tiff_Compressions)
+def read_tiff_layout(file):
+    header = read_tiff_header(file)
+    if header is None:
+        return None
+    byte_order, ifd_offset, bigtiff = header
+    entries = read_tiff_entries(file, byte_order, ifd_offset, bigtiff)
+    
+    def values(tag, default = None):
+        if tag not in entries:
+            return default
+        return read_tiff_values(file, byte_order, entries[tag]) or default
+    def value(tag, default = None):
+        return values(tag, [default])[0]
+    
+    width, height = value(256), value(257)
+    samples = value(277, 1)
+    photometric = value(262)
+    compression = value(259, 1)
+    if width is None or height is None or compression not in Tiff_Decode_Compressions or value(317, 1) != 1:
+        return None # Predictors are not supported
+    
+    # Only 8 bit images that Pillow reads without any conversion
+    mode = None
+    if set(values(258, [1])) == {8} and set(values(339, [1])) == {1} and (value(284, 1) == 1 or samples == 1):
+        if photometric == 1 and samples == 1:
+            mode = "L"
+        elif photometric == 2 and samples == 3:
+            mode = "RGB"
+        elif photometric == 2 and samples == 4 and values(338) == [2]:
+            mode = "RGBA"
+    if mode is None:
+        return None
+        
+    tiled = 322 in entries
+    if tiled:
+        block_width, block_height = value(322), value(323)
+        offsets_tag, counts_tag = 324, 325
+    else:
+        block_width, block_height = width, min(value(278, height), height)
+        offsets_tag, counts_tag = 273, 279
+    if offsets_tag not in entries or counts_tag not in entries:
+        return None
+        
+    # Blocks that grow when re-encoded are moved to the end of the file, which needs 32 (or BigTIFF 64) bit offsets and counts
+    offsets_type, counts_type = entries[offsets_tag][0], entries[counts_tag][0]
+    if offsets_type not in (3, 4, 16) or counts_type not in (3, 4, 16) or (compression != 1 and 3 in (offsets_type, counts_type)):
+        return None
+        
+    return TiffLayout(byte_order, width, height, mode, compression, tiled, block_width, block_height, values(offsets_tag), values(counts_tag),
+                      (offsets_type, entries[offsets_tag][2]), (counts_type, entries[counts_tag][2]))
+
+# Pixel box (left, top, right, bottom) of a TIFF block. Tiles always have the full tile size, even at the image border
+def tiff_block_box(layout, index):
+    if layout.tiled:
+        tiles_across = (layout.width + layout.block_width - 1) // layout.block_width
+        left = (index % tiles_across) * layout.block_width
+        top = (index // tiles_across) * layout.block_height
+        return (left, top, left + layout.block_width, top + layout.block_height)
+    top = index * layout.block_height
+    return (0, top, layout.width, min(top + layout.block_height, layout.height))
+
+# Streaming decoder of TIFF LZW data (MSB first codes of 9 to 12 bits, code width changed one code early), with the
+# interface of zlib.decompressobj: decompress returns about max_length bytes at most, the input left is in unconsumed_tail
+class LzwDecompressor:
+    def __init__(self):
+        self.bits = 0
+        self.bit_count = 0
+        self.table = None
+        self.previous = None
+        self.eof = False
+        self.unconsumed_tail = b""
+        
+    def decompress(self, data, max_length = 0):
+        output = bytearray()
+        position = 0
+        table, previous = self.table, self.previous
+        bits, bit_count = self.bits, self.bit_count
+        width = 9 if table is None else min(12, (len(table) + 1).bit_length())
+        while not self.eof and (not max_length or len(output) < max_length):
+            while bit_count < width and position < len(data):
+                bits = ((bits << 8) | data[position]) & 0xFFFFFF
+                bit_count = bit_count + 8
+                position = position + 1
+            if bit_count < width:
+                break
+            bit_count = bit_count - width
+            code = (bits >> bit_count) & ((1 << width) - 1)
+            if code == 256: # Clear
+                table = [bytes([byte]) for byte in range(256)] + [b"", b""]
+                previous = None
+                width = 9
+                continue
+            if code == 257: # End of information
+                self.eof = True
+                break
+            if table is None:
+                raise ValueError("LZW data does not start with a clear code")
+            if previous is None:
+                entry = table[code]
+            else:
+                if code < len(table):
+                    entry = table[code]
+                elif code == len(table):
+                    entry = previous + previous[:1]
+                else:
+                    raise ValueError("Corrupt LZW data")
+                if len(table) < 4096:
+                    table.append(previous + entry[:1])
+                    width = min(12, (len(table) + 1).bit_length())
+            output += entry
+            previous = entry
+        self.table, self.previous = table, previous
+        self.bits, self.bit_count = bits, bit_count
+        self.unconsumed_tail = data[position:]
+        return bytes(output)
+
+# Decoded size up to which LZW blocks are decoded by libtiff through Pillow, many times faster than LzwDecompressor.
+# Bigger blocks (a whole image in one strip) are streamed by LzwDecompressor
+Lzw_Libtiff_Size = 1 << 26
+
+# Decompressor of the blocks of a TIFF layout, None if they are not compressed
+def tiff_decompressor(layout):
+    if layout.compression == 1:
+        return None
+    return LzwDecompressor() if layout.compression == 5 else zlib.decompressobj()
+
+# Image of an LZW block decoded by libtiff, given to Pillow as a TIFF file of its own holding only that block.
+# None if Pillow was built without libtiff
+def decode_lzw_block(layout, data, size):
+    samples = len(layout.mode)
+    entries = [(256, 4, [size[0]]), (257, 4, [size[1]]), (258, 3, [8] * samples), (259, 3, [5]), (262, 3, [1 if samples == 1 else 2]),
+               (273, 4, [0]), (277, 3, [samples]), (278, 4, [size[1]]), (279, 4, [len(data)]), (284, 3, [1])]
+    if layout.mode == "RGBA":
+        entries.append((338, 3, [2]))
+    values_position = 8 + 2 + 12 * len(entries) + 4
+    directory, values = struct.pack("<H", len(entries)), b""
+    for tag, field_type, tag_values in entries:
+        value = struct.pack("<" + str(len(tag_values)) + Tiff_Type_Formats[field_type], *tag_values)
+        if len(value) > 4:
+            value, values = struct.pack("<L", values_position + len(values)), values + value
+        directory = directory + struct.pack("<HHL", tag, field_type, len(tag_values)) + value.ljust(4, b"\0")
+    data_position = values_position + len(values)
+    directory = directory.replace(struct.pack("<HHLL", 273, 4, 1, 0), struct.pack("<HHLL", 273, 4, 1, data_position))
+    try:
+        image = Image.open(io.BytesIO(b"II*\0" + struct.pack("<L", 8) + directory + b"\0" * 4 + values + data))
+        image.load()
+    except OSError:
+        return None
+    return image if image.mode == layout.mode and image.size == size else None
+
+def read_tiff_block(file, layout, index):
+    file.seek(layout.offsets[index])
+    data = file.read(layout.byte_counts[index])
+    box = tiff_block_box(layout, index)
+    size = (box[2] - box[0], box[3] - box[1])
+    if layout.compression == 5 and size[0] * size[1] * len(layout.mode) <= Lzw_Libtiff_Size:
+        image = decode_lzw_block(layout, data, size)
+        if image is not None:
+            return image
+    decompressor = tiff_decompressor(layout)
+    if decompressor is not None:
+        data = decompressor.decompress(data)
+    return Image.frombytes(layout.mode, size, data)
+
+def encode_tiff_block(layout, image):
+    data = image.tobytes()
+    if layout.compression != 1:
+        data = zlib.compress(data, 6)
+    return data
+
+def boxes_overlap(first, second):
+    return first[0] < second[2] and second[0] < first[2] and first[1] < second[3] and second[1] < first[3]
+
+# Box of the image covered by an overlay
+def overlay_box(overlay):
+    left, top = overlay.origin
+    return (left, top, left + overlay.patch.width, top + overlay.patch.height)
+
+# Copy a TIFF file and put the scale in the blocks under it. Returns False if the file is not supported
+def rewrite_tiff_region(filename, new_filename, pixel_per_unit, bar_width_unit, unit, color):
+    with open(filename, "rb") as file:
+        layout = read_tiff_layout(file)
+    if layout is None or layout.compression not in Tiff_Compressions:
+        return False
+    overlay = Overlay_Cache.get((layout.width, layout.height), pixel_per_unit, bar_width_unit, unit, color)
+    region = overlay_box(overlay)
+    blocks = [index for index in range(len(layout.offsets)) if boxes_overlap(tiff_block_box(layout, index), region)]
+    
+    shutil.copyfile(filename, new_filename)
+    with open(new_filename, "r+b") as file:
+        for index in blocks:
+            box = tiff_block_box(layout, index)
+            block = read_tiff_block(file, layout, index)
+            paste_overlay(block, overlay._replace(origin = (region[0] - box[0], region[1] - box[1])))
+            data = encode_tiff_block(layout, block)
+            
+            if len(data) <= layout.byte_counts[index]:
+                position = layout.offsets[index]
+            else:
+                file.seek(0, os.SEEK_END)
+                position = file.tell()
+                if position % 2:
+                    file.write(b"\0") # Blocks start on a word boundary
+                    position = position + 1
+            file.seek(position)
+            file.write(data)
+            
+            for (field_type, values_position), new_value in ((layout.offsets_entry, position), (layout.counts_entry, len(data))):
+                value_format = layout.byte_order + Tiff_Type_Formats[field_type]
+                file.seek(values_position + index * struct.calcsize(value_format))
+                file.write(struct.pack(value_format, new_value))
+    return True
+
+# Baseline JPEG file, split in restart intervals of restart_interval MCUs each.
+# segments are (marker, start, end) of the header segments, intervals are (start, end) of the compressed data of each interval
+JpegLayout = namedtuple("JpegLayout", ["width", "height", "components", "mcu_width", "mcu_height", "restart_interval", "segments", "intervals"])
+
+# Restart markers and end of image marker. 0xFF bytes inside compressed data are always followed by 0x00
+Jpeg_Marker_Pattern = re.compile(rb"\xff[\xd0-\xd9]")
+
+# Parse the header segments of a JPEG file, up to and including the start of scan
+def read_jpeg_segments(data):
+    if data[:2] != b"\xff\xd8":
+        return None
+    segments = []
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position = position + 1 # Fill byte
+            continue
+        end = position + 2 + struct.unpack(">H", data[position + 2:position + 4])[0]
+        segments.append((marker, position, end))
+        position = end
+        if marker == 0xDA:
+            return segments
+    return None
+
+# Frame and scan information of parsed segments: (width, height, components, scan header)
+def read_jpeg_frame(data, segments):
+    frame = [segment for segment in segments if segment[0] in (0xC0, 0xC1)]
+    if len(frame) != 1 or any(0xC2 <= segment[0] <= 0xCF and segment[0] not in (0xC4, 0xC8, 0xCC) for segment in segments):
+        return None # Only baseline/extended sequential Huffman JPEGs
+    start = frame[0][1]
+    precision, height, width, number_components = struct.unpack(">BHHB", data[start + 4:start + 10])
+    components = [tuple(data[start + 10 + 3*i:start + 13 + 3*i]) for i in range(number_components)]
+    scan = segments[-1]
+    return width, height, components, bytes(data[scan[1]:scan[2]])
+
+# Quantization and Huffman tables of parsed segments, as {(kind, id): table bytes}
+def read_jpeg_tables(data, segments):
+    tables = {}
+    for marker, start, end in segments:
+        position = start + 4
+        while marker in (0xDB, 0xC4) and position < end:
+            table_id = data[position]
+            if marker == 0xDB:
+                length = 1 + (128 if table_id >> 4 else 64)
+                tables[("quantization", table_id & 0x0F)] = bytes(data[position:position + length])
+            else:
+                length = 17 + sum(data[position + 1:position + 17])
+                tables[("huffman", table_id)] = bytes(data[position:position + length])
+            position = position + length
+    return tables
+
+def read_jpeg_layout(data):
+    segments = read_jpeg_segments(data)
+    if segments is None:
+        return None
+    frame = read_jpeg_frame(data, segments)
+    restart = [segment for segment in segments if segment[0] == 0xDD]
+    if frame is None or not restart:
+        return None
+    width, height, components, scan = frame
+    if scan[4] != len(components) or len(components) not in (1, 3):
+        return None # Progressive-like multi-scan files are not supported
+    restart_interval = struct.unpack(">H", data[restart[-1][1] + 4:restart[-1][1] + 6])[0]
+    
+    if len(components) == 1:
+        mcu_width = mcu_height = 8
+    else:
+        mcu_width = 8 * max(component[1] >> 4 for component in components)
+        mcu_height = 8 * max(component[1] & 0x0F for component in components)
+    mcus_per_row = (width + mcu_width - 1) // mcu_width
+    total_mcus = mcus_per_row * ((height + mcu_height - 1) // mcu_height)
+    
+    # Intervals must be whole rows of MCUs, or whole parts of a single row, to be re-encoded on their own
+    if restart_interval == 0 or (restart_interval % mcus_per_row and mcus_per_row % restart_interval):
+        return None
+    
+    # Restart markers split the compressed data; the data ends at the end of image marker
+    intervals = []
+    start = segments[-1][2]
+    for marker in Jpeg_Marker_Pattern.finditer(data, start):
+        intervals.append((start, marker.start()))
+        start = marker.end()
+        if marker.group()[1] == 0xD9:
+            break
+    else:
+        return None
+    if len(intervals) != (total_mcus + restart_interval - 1) // restart_interval:
+        return None
+    return JpegLayout(width, height, components, mcu_width, mcu_height, restart_interval, segments, intervals)
+
+# Pixel box (left, top, right, bottom) of a restart interval
+def jpeg_interval_box(layout, index):
+    mcus_per_row = (layout.width + layout.mcu_width - 1) // layout.mcu_width
+    first_mcu = index * layout.restart_interval
+    if layout.restart_interval % mcus_per_row == 0:
+        top = (first_mcu // mcus_per_row) * layout.mcu_height
+        bottom = top + (layout.restart_interval // mcus_per_row) * layout.mcu_height
+        return (0, top, layout.width, min(bottom, layout.height))
+    left = (first_mcu % mcus_per_row) * layout.mcu_width
+    top = (first_mcu // mcus_per_row) * layout.mcu_height
+    return (left, top, min(left + layout.restart_interval * layout.mcu_width, layout.width), min(top + layout.mcu_height, layout.height))
+
+# Each restart interval starts from scratch, so it can be decoded as a small JPEG of its own with the same tables
+def decode_jpeg_interval(data, layout, index):
+    box = jpeg_interval_box(layout, index)
+    header = [b"\xff\xd8"]
+    for marker, start, end in layout.segments:
+        if marker in (0xDB, 0xC4, 0xDA):
+            header.append(data[start:end])
+        elif marker in (0xC0, 0xC1):
+            header.append(data[start:start + 5] + struct.pack(">HH", box[3] - box[1], box[2] - box[0]) + data[start + 9:end])
+    start, end = layout.intervals[index]
+    image = Image.open(io.BytesIO(b"".join(header) + data[start:end] + b"\xff\xd9"))
+    image.load()
+    return image
+
+# Encode an interval again with the tables of the original file. Returns the compressed data, or None if Pillow
+# did not use exactly the same tables (e.g. the original had optimized Huffman tables), in which case it cannot be spliced in
+def encode_jpeg_interval(image, data, layout, quantization):
+    if len(layout.components) == 1:
+        subsampling = 0
+    else:
+        sampling = [component[1] for component in layout.components]
+        subsampling = {(0x11, 0x11, 0x11): 0, (0x21, 0x11, 0x11): 1, (0x22, 0x11, 0x11): 2}.get(tuple(sampling))
+        if subsampling is None:
+            return None
+    output = io.BytesIO()
+    image.save(output, "JPEG", qtables = quantization, subsampling = subsampling)
+    encoded = output.getvalue()
+    
+    segments = read_jpeg_segments(encoded)
+    if segments is None:
+        return None
+    original_frame = read_jpeg_frame(data, layout.segments)
+    frame = read_jpeg_frame(encoded, segments)
+    if frame is None or frame[2] != original_frame[2] or frame[3] != original_frame[3]:
+        return None
+    tables = read_jpeg_tables(encoded, segments)
+    original_tables = read_jpeg_tables(data, layout.segments)
+    for key, table in tables.items():
+        if original_tables.get(key) != table:
+            return None
+    end = encoded.rfind(b"\xff\xd9")
+    return encoded[segments[-1][2]:end]
+
+# Copy a JPEG file and re-encode only the restart intervals under the scale. Returns False if the file is not supported
+def rewrite_jpeg_region(filename, new_filename, pixel_per_unit, bar_width_unit, unit, color):
+    with open(filename, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            layout = read_jpeg_layout(data)
+            if layout is None:
+                return False
+            overlay = Overlay_Cache.get((layout.width, layout.height), pixel_per_unit, bar_width_unit, unit, color)
+            region = overlay_box(overlay)
+            
+            replacements = []
+            quantization = None
+            for index in range(len(layout.intervals)):
+                box = jpeg_interval_box(layout, index)
+                if not boxes_overlap(box, region):
+                    continue
+                image = decode_jpeg_interval(data, layout, index)
+                if image.mode not in ("L", "RGB"):
+                    return False
+                if quantization is None:
+                    quantization = image.quantization
+                paste_overlay(image, overlay._replace(origin = (region[0] - box[0], region[1] - box[1])))
+                encoded = encode_jpeg_interval(image, data, layout, quantization)
+                if encoded is None:
+                    return False
+                replacements.append((layout.intervals[index], encoded))
+            
+            with open(new_filename, "wb") as output:
+                position = 0
+                for (start, end), encoded in replacements:
+                    output.write(data[position:start])
+                    output.write(encoded)
+                    position = end
+                output.write(data[position:])
+            return True
+        finally:
+            data.close()
+
+# Put the scale on a copy of the file, only re-encoding the parts under it. Returns False if the file must be rewritten completely
+def rewrite_region(filename, new_filename, pixel_per_unit, bar_width_unit, unit, color):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in (".tif", ".tiff"):
+        return rewrite_tiff_region(filename, new_filename, pixel_per_unit, bar_width_unit, unit, color)
+    if extension in (".jpeg", ".jpg", ".jfif"):
+        return rewrite_jpeg_region(filename, new_filename, pixel_per_unit, bar_width_unit, unit, color)
+    return False
+
+
+# Pyramid output, for stitched scans too big to open in one piece: a tiled TIFF with the full image as first page and
+# copies reduced by 2, 4, 8... as the next pages (NewSubfileType 1), each with its own scale. The input is read a band of
+# rows at a time and every level only keeps one row of tiles, so the memory does not grow with the size of the image.
+
+Pyramid_Tile_Size = 256
+
+# Modes the pyramid is written in, as (photometric interpretation, samples per pixel)
+Pyramid_Modes = {"L": (1, 1), "RGB": (2, 3), "RGBA": (2, 4)}
+
+# zlib level of the tiles for each encoder profile. None writes them uncompressed
+Pyramid_Compression = {"fast": None, "archive": 9}
+
+# Threads compressing the tiles of a row. zlib does not hold the GIL, so this uses several cores even in a worker process
+Pyramid_Threads = 4
+
+# Decoded data of a strip of a TIFF file, at most about max_length bytes at a time. LZW strips small enough for
+# decode_lzw_block are decoded at once
+def read_tiff_strip(file, layout, index, max_length):
+    box = tiff_block_box(layout, index)
+    strip_left = (box[3] - box[1]) * layout.width * len(layout.mode)
+    if layout.compression == 5 and strip_left <= Lzw_Libtiff_Size:
+        yield read_tiff_block(file, layout, index).tobytes()
+        return
+    decompressor = tiff_decompressor(layout)
+    position = layout.offsets[index]
+    remaining = layout.byte_counts[index]
+    while remaining and strip_left:
+        file.seek(position)
+        chunk = file.read(min(remaining, 1 << 20))
+        if not chunk:
+            break
+        position = position + len(chunk)
+        remaining = remaining - len(chunk)
+        while chunk and strip_left:
+            if decompressor is None:
+                data, chunk = chunk[:strip_left], b""
+            else:
+                data = decompressor.decompress(chunk, min(strip_left, max_length))[:strip_left]
+                chunk = decompressor.unconsumed_tail
+            strip_left = strip_left - len(data)
+            yield data
+
+# Bands of rows (full width images of at most rows lines) of a TIFF file that read_tiff_layout accepts.
+# Strips are decompressed a bit at a time, so even a file that is a single huge strip is never held in memory
+def read_tiff_bands(file, layout, rows):
+    row_bytes = layout.width * len(layout.mode)
+    band_bytes = rows * row_bytes
+    if layout.tiled:
+        tiles_across = (layout.width + layout.block_width - 1) // layout.block_width
+        for top in range(0, layout.height, layout.block_height):
+            band = Image.new(layout.mode, (layout.width, min(layout.block_height, layout.height - top)))
+            first = (top // layout.block_height) * tiles_across
+            for index in range(first, first + tiles_across):
+                band.paste(read_tiff_block(file, layout, index), (tiff_block_box(layout, index)[0], 0))
+            for band_top in range(0, band.height, rows):
+                yield band.crop((0, band_top, layout.width, min(band_top + rows, band.height)))
+        return
+    
+    pending = bytearray()
+    read_rows = 0
+    for index in range(len(layout.offsets)):
+        for data in read_tiff_strip(file, layout, index, band_bytes):
+            pending += data
+            while len(pending) >= band_bytes:
+                yield Image.frombytes(layout.mode, (layout.width, rows), bytes(pending[:band_bytes]))
+                del pending[:band_bytes]
+                read_rows = read_rows + rows
+    if read_rows + len(pending) // row_bytes < layout.height:
+        raise ValueError("Truncated TIFF file")
+    if pending:
+        yield Image.frombytes(layout.mode, (layout.width, len(pending) // row_bytes), bytes(pending))
+
+# Open an image of any size. Image.open refuses images over twice Image.MAX_IMAGE_PIXELS, which scans easily are, and
+# Image.open(filename, formats = [...]) checks the size too. The check is only done by Image.open, so those images are
+# opened with the plugin class of their format, a public part of Pillow since before 6.2.1, the oldest version supported
+# (see README). The limit stays on for every other image and thread. Other formats over the limit are still refused
+def open_large_image(filename):
+    try:
+        return Image.open(filename)
+    except Image.DecompressionBombError as error:
+        refused = error
+    for plugin in (TiffImagePlugin.TiffImageFile, JpegImagePlugin.JpegImageFile, PngImagePlugin.PngImageFile, BmpImagePlugin.BmpImageFile):
+        # Each class refuses files of other formats
+        try:
+            return plugin(filename)
+        except (SyntaxError, IndexError, TypeError, struct.error):
+            continue
+    raise refused
+
+# Same image in one of Pyramid_Modes. 16 bit and floating point images are made 8 bit
+def pyramid_image(image):
+    if image.mode in Pyramid_Modes:
+        return image
+    if "A" in image.mode or "transparency" in image.info:
+        return image.convert("RGBA")
+    image = convert_for_format(image, "JPEG")
+    return image if image.mode in Pyramid_Modes else image.convert("RGB")
+
+# Mode, size and bands of rows of an input file. Uncompressed, deflate and LZW 8 bit TIFF and BigTIFF files are streamed,
+# anything else is decoded completely first (without the size limit of Pillow, with a warning over it) and then cut in bands
+def open_pyramid_input(filename, file, rows):
+    layout = read_tiff_layout(file)
+    if layout is not None:
+        return layout.mode, (layout.width, layout.height), read_tiff_bands(file, layout, rows)
+    image = open_large_image(filename)
+    if Image.MAX_IMAGE_PIXELS and image.width * image.height > Image.MAX_IMAGE_PIXELS:
+        print("Warning: " + filename + " (" + str(image.width) + " x " + str(image.height) + ", " + str(image.format) +
+              ") cannot be streamed, the whole image is decoded in memory", file = sys.stderr)
+    image.load()
+    image = pyramid_image(image)
+    bands = (image.crop((0, top, image.width, min(top + rows, image.height))) for top in range(0, image.height, rows))
+    return image.mode, image.size, bands
+
+# Half of an image, each pixel the average of 2x2 pixels. Odd sizes are rounded up
+def reduce_half(image):
+    if hasattr(image, "reduce"):
+        return image.reduce(2)
+    return image.resize(((image.width + 1) // 2, (image.height + 1) // 2), Image.BOX)
+
+# One page of the pyramid: the rows not written yet (less than a row of tiles) and the offsets and sizes of the written tiles
+class PyramidLevel:
+    def __init__(self, size, overlay, pixel_per_unit):
+        self.width, self.height = size
+        self.overlay = overlay
+        self.pixel_per_unit = pixel_per_unit
+        self.band = None
+        self.filled = 0
+        self.top = 0
+        self.offsets = []
+        self.byte_counts = []
+
+# Writes a tiled pyramid TIFF from bands of rows of the full image, given from top to bottom with add_rows().
+# Every level gets the scale for its size and pixel per unit, drawn on the tiles only: the smaller levels are made from
+# the image without scale. Files that might grow over 4 GB are written as BigTIFF
+class PyramidWriter:
+    def __init__(self, file, mode, size, pixel_per_unit, bar_width_unit, unit, color, tile_size = Pyramid_Tile_Size, compress_level = 6, executor = None):
+        self.file = file
+        self.mode = mode
+        self.tile_size = tile_size
+        self.compress_level = compress_level
+        self.executor = executor
+        self.levels = []
+        width, height = size
+        while True:
+            level_pixel_per_unit = pixel_per_unit / 2**len(self.levels)
+            overlay = Overlay_Cache.get((width, height), level_pixel_per_unit, bar_width_unit, unit, color)
+            self.levels.append(PyramidLevel((width, height), overlay, level_pixel_per_unit))
+            if max(width, height) <= tile_size:
+                break
+            width, height = (width + 1) // 2, (height + 1) // 2
+        self.unit = unit
+        
+        tile_bytes = tile_size * tile_size * len(mode)
+        total = sum(self.tiles_across(level) * self.tiles_down(level) for level in self.levels) * tile_bytes
+        self.big = total * 1.01 + (1 << 20) >= 1 << 32
+        self.byte_order = "<"
+        if self.big:
+            self.file.write(b"II+\0" + struct.pack("<HHQ", 8, 0, 0))
+        else:
+            self.file.write(b"II*\0" + struct.pack("<L", 0))
+    
+    def tiles_across(self, level):
+        return (level.width + self.tile_size - 1) // self.tile_size
+    
+    def tiles_down(self, level):
+        return (level.height + self.tile_size - 1) // self.tile_size
+    
+    def add_rows(self, image, number = 0):
+        level = self.levels[number]
+        top = 0
+        while top < image.height:
+            if level.band is None:
+                level.band = Image.new(self.mode, (level.width, self.tile_size))
+            rows = min(image.height - top, self.tile_size - level.filled)
+            level.band.paste(image.crop((0, top, level.width, top + rows)), (0, level.filled))
+            level.filled = level.filled + rows
+            top = top + rows
+            if level.filled == self.tile_size or level.top + level.filled >= level.height:
+                self.write_band(number)
+    
+    # Write the row of tiles of a level, after giving its reduced copy to the next level
+    def write_band(self, number):
+        level = self.levels[number]
+        band = level.band
+        if number + 1 < len(self.levels):
+            self.add_rows(reduce_half(band.crop((0, 0, level.width, level.filled))), number + 1)
+        
+        box = overlay_box(level.overlay)
+        if boxes_overlap(box, (0, level.top, level.width, level.top + level.filled)):
+            paste_overlay(band, level.overlay._replace(origin = (box[0], box[1] - level.top)))
+        
+        tiles = [band.crop((left, 0, left + self.tile_size, self.tile_size)) for left in range(0, level.width, self.tile_size)]
+        encoded = self.executor.map(self.encode_tile, tiles) if self.executor is not None else map(self.encode_tile, tiles)
+        for data in encoded:
+            level.offsets.append(self.file.tell())
+            level.byte_counts.append(len(data))
+            self.file.write(data)
+            if len(data) % 2:
+                self.file.write(b"\0") # Tiles start on a word boundary
+        level.top = level.top + level.filled
+        level.band = None
+        level.filled = 0
+    
+    def encode_tile(self, tile):
+        data = tile.tobytes()
+        if self.compress_level is not None:
+            data = zlib.compress(data, self.compress_level)
+        return data
+    
+    # Tags of the page of a level, as (tag, field type, values)
+    def level_entries(self, number):
+        level = self.levels[number]
+        photometric, samples = Pyramid_Modes[self.mode]
+        offset_type = 16 if self.big else 4
+        entries = [(254, 4, [1 if number else 0]), (256, 4, [level.width]), (257, 4, [level.height]), (258, 3, [8] * samples),
+                   (259, 3, [1 if self.compress_level is None else 8]), (262, 3, [photometric]), (277, 3, [samples])]
+        if self.unit in Unit_Lengths:
+            # Resolution in pixels per centimeter, so the calibration of every level can be read back
+            resolution = (int(round(level.pixel_per_unit / Unit_Lengths[self.unit] * Unit_Lengths["cm"] * 1000)), 1000)
+            entries.extend([(282, 5, resolution), (283, 5, resolution)])
+        entries.append((284, 3, [1]))
+        if self.unit in Unit_Lengths:
+            entries.append((296, 3, [3]))
+        entries.extend([(322, 3, [self.tile_size]), (323, 3, [self.tile_size]), (324, offset_type, level.offsets), (325, offset_type, level.byte_counts)])
+        if self.mode == "RGBA":
+            entries.append((338, 3, [2]))
+        return entries
+    
+    # Write one directory with its values. Returns (position of the directory, position of its next directory offset)
+    def write_directory(self, entries):
+        inline_size = 8 if self.big else 4
+        entry_format = "<HHQ" if self.big else "<HHL"
+        packed = []
+        for tag, field_type, values in entries:
+            data = struct.pack("<" + str(len(values)) + Tiff_Type_Formats.get(field_type, "L"), *values)
+            count = len(values) // 2 if field_type == 5 else len(values)
+            if len(data) <= inline_size:
+                packed.append((tag, field_type, count, data.ljust(inline_size, b"\0")))
+            else:
+                position = self.file.tell()
+                self.file.write(data)
+                if len(data) % 2:
+                    self.file.write(b"\0")
+                packed.append((tag, field_type, count, struct.pack("<Q" if self.big else "<L", position)))
+        
+        directory = self.file.tell()
+        self.file.write(struct.pack("<Q" if self.big else "<H", len(packed)))
+        for tag, field_type, count, value in packed:
+            self.file.write(struct.pack(entry_format, tag, field_type, count) + value)
+        next_position = self.file.tell()
+        self.file.write(b"\0" * inline_size)
+        return directory, next_position
+    
+    # Write the rows that are left and the directories of all levels
+    def close(self):
+        for number in range(len(self.levels)):
+            if self.levels[number].filled:
+                self.write_band(number)
+        next_position = 8 if self.big else 4
+        for number in range(len(self.levels)):
+            directory, new_next_position = self.write_directory(self.level_entries(number))
+            self.file.seek(next_position)
+            self.file.write(struct.pack("<Q" if self.big else "<L", directory))
+            self.file.seek(0, os.SEEK_END)
+            next_position = new_next_position
+
+# Write the image of filename with its scale as a tiled pyramid TIFF, into target (a filename or a file object).
+# Fills stats like process_image
+def write_pyramid(filename, target, pixel_per_unit, bar_width_unit, unit, color, encoder = "default", stats = None):
+    compress_level = Pyramid_Compression.get(encoder, 6)
+    output_file = open(target, "wb") if isinstance(target, str) else nullcontext(target)
+    with open(filename, "rb") as file, output_file as output, futures.ThreadPoolExecutor(Pyramid_Threads) as executor:
+        with time_stage(stats, "open"):
+            mode, size, bands = open_pyramid_input(filename, file, Pyramid_Tile_Size)
+        if stats is not None:
+            stats.update(mode = mode, width = size[0], height = size[1], pixels = size[0] * size[1])
+        with time_stage(stats, "pyramid"):
+            writer = PyramidWriter(output, mode, size, pixel_per_unit, bar_width_unit, unit, color, compress_level = compress_level, executor = executor)
+            for band in bands:
+                writer.add_rows(band)
+            writer.close()
+
+
+# Result of one file of a batch. count is what process_image returned, error is None or a short reason,
+# stats is the dict filled by process_image (timings, sizes), also for files that failed.
+# output is the ArchiveOutput of jobs that write into an archive, until the engine stores it
+BatchResult = namedtuple("BatchResult", ["index", "filename", "count", "error", "stats", "output"], defaults = (None, None))
+
+# Output of a job that goes into an archive: a temporary file (path, size in bytes), which the archive copies and deletes.
+# Only this goes back from the worker process, so outputs of any size never have to be in memory
+ArchiveOutput = namedtuple("ArchiveOutput", ["path", "size"])
+
+# Keys of a job that are not arguments of process_image: the archive the output goes into, and its shard size in bytes
+Archive_Keys = ("archive", "shard_size")
+
+# Temporary file for the output of a job with an archive, open for writing and reading. Deleted if the block fails
+@contextmanager
+def archive_spool():
+    file = tempfile.NamedTemporaryFile(prefix = "autoscale-", delete = False)
+    try:
+        with file:
+            yield file
+    except BaseException:
+        discard_output(ArchiveOutput(file.name, 0))
+        raise
+
+# Delete the temporary file of an output that will not go into its archive
+def discard_output(output):
+    try:
+        os.unlink(output.path)
+    except OSError:
+        pass
+
+# Runs a single batch job. Lives at module level so it can be sent to worker processes.
+# Jobs with an archive are written to a temporary file, returned in BatchResult.output; the engine copies it into the archive
+def run_job(index, job):
+    stats = {}
+    try:
+        if not job.get("archive"):
+            count = process_image(stats = stats, **job)
+            return BatchResult(index, job["filename"], count, None, stats)
+        arguments = dict((key, value) for key, value in job.items() if key not in Archive_Keys)
+        with archive_spool() as file:
+            count = process_image(stats = stats, target = file, **arguments)
+            output = ArchiveOutput(file.name, file.seek(0, os.SEEK_END))
+        if stats.get("skipped"):
+            discard_output(output)
+            output = None
+        return BatchResult(index, job["filename"], count, None, stats, output)
+    except Exception as error:
+        return BatchResult(index, job["filename"], 0, type(error).__name__ + ": " + str(error), stats)
+
+
+# Archive output: instead of thousands of separate files (each one a few slow metadata operations on network shares),
+# the outputs of a batch are written into uncompressed ZIP or tar archives, with the paths they would have in the
+# output folder. Each archive ends with a manifest of its entries and the settings they were made with.
+
+Archive_Formats = {".zip": "zip", ".tar": "tar"}
+
+Archive_Manifest = "autoscale_manifest.json"
+
+# Threads writing shards at the same time, when the archive is split by size
+Archive_Writers = 4
+
+# Format of an archive path, checked before a batch starts
+def archive_format(path):
+    archive_type = Archive_Formats.get(os.path.splitext(path)[1].lower())
+    if archive_type is None:
+        raise ValueError("Unknown archive format " + repr(path) + " (use " + ", ".join(Archive_Formats) + ")")
+    return archive_type
+
+# Path of the output of a job inside its archive: the path it would have relative to the output folder, with the same
+# name rules (suffix, lowercase, output format)
+def archive_name(job):
+    relative = os.path.relpath(job["filename"], job["input_dir"])
+    name = output_filename(relative, "", "", job.get("extra_string", "_with_scale"), job.get("lowercase", True),
+                           job_output_format(job.get("output_format"), job.get("pyramid")))
+    return name.replace(os.sep, "/")
+
+# Manifest entry of a job: its input and every setting that changes the output
+def archive_entry(job, name, size):
+    entry = {"name": name, "source": os.path.relpath(job["filename"], job["input_dir"]).replace(os.sep, "/"), "bytes": size}
+    for key, value in BuildCache.job_settings(job):
+        if key not in Archive_Keys:
+            entry[key] = value
+    return entry
+
+# One archive file being written
+class ArchiveShard:
+    def __init__(self, path, archive_type):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.file = open(path, "wb")
+        if archive_type == "tar":
+            self.archive = tarfile.open(fileobj = self.file, mode = "w", format = tarfile.PAX_FORMAT)
+        else:
+            self.archive = zipfile.ZipFile(self.file, "w", zipfile.ZIP_STORED, allowZip64 = True)
+        self.manifest = []
+        
+    # Copy size bytes of a file object into the archive as name, a block at a time
+    def add(self, name, file, size):
+        if isinstance(self.archive, tarfile.TarFile):
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = time.time()
+            self.archive.addfile(info, file)
+        else:
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.file_size = size
+            with self.archive.open(info, "w", force_zip64 = size > zipfile.ZIP64_LIMIT) as entry:
+                shutil.copyfileobj(file, entry, 1 << 20)
+            
+    def size(self):
+        return self.file.tell()
+        
+    def close(self):
+        manifest = json.dumps({"entries": self.manifest}, indent = 1).encode("utf-8")
+        self.add(Archive_Manifest, io.BytesIO(manifest), len(manifest))
+        self.archive.close()
+        self.file.close()
+
+# Error of an archive that could not be finished. filenames are the input files whose outputs were in it
+class ArchiveError(OSError):
+    def __init__(self, message, filenames = ()):
+        super().__init__(message)
+        self.filenames = list(filenames)
+
+# Writes entries into the archive at path, in background threads. With shard_size (in bytes), entries go into
+# shards in the order they are added, and the next shard is started once the entries of one add up to shard_size,
+# so only the last shard is smaller. Shards are named like name-0000.zip, name-0001.zip..., and Archive_Writers
+# threads write shards at the same time. on_written(error) of every entry is called by its writer thread once the
+# entry is in the archive (error None) or could not be written; errors closing a shard are raised by close()
+class ArchiveSink:
+    def __init__(self, path, shard_size = None):
+        self.path = path
+        self.type = archive_format(path)
+        self.shard_size = shard_size
+        # (path, entries) of every shard, in order. Entries are only paths of temporary files, so nothing limits them
+        self.shards = queue.Queue()
+        self.filling = None
+        self.filled = 0
+        self.number = 0
+        self.lock = threading.Lock()
+        self.errors = []
+        self.threads = [threading.Thread(target = self.write_shards, daemon = True) for i in range(Archive_Writers if shard_size else 1)]
+        for thread in self.threads:
+            thread.start()
+    
+    def next_path(self):
+        number = self.number
+        self.number = self.number + 1
+        if not self.shard_size:
+            return self.path
+        root, extension = os.path.splitext(self.path)
+        return root + "-%04d" % number + extension
+    
+    # Queue one entry of the input file filename. output is its ArchiveOutput, entry its manifest entry
+    def add(self, filename, name, output, entry, on_written):
+        with self.lock:
+            if self.filling is None:
+                self.filling = queue.Queue()
+                self.shards.put((self.next_path(), self.filling))
+            self.filling.put((filename, name, output, entry, on_written))
+            self.filled = self.filled + output.size
+            if self.shard_size and self.filled >= self.shard_size:
+                self.filling.put(None)
+                self.filling = None
+                self.filled = 0
+    
+    def write_shards(self):
+        while True:
+            item = self.shards.get()
+            if item is None:
+                break
+            self.write_shard(*item)
+    
+    # Once an entry failed the archive is broken, so the entries after it fail too
+    def write_shard(self, path, entries):
+        shard = None
+        error = None
+        filenames = []
+        for filename, name, output, entry, on_written in iter(entries.get, None):
+            try:
+                if error is None:
+                    if shard is None:
+                        shard = ArchiveShard(path, self.type)
+                    with open(output.path, "rb") as file:
+                        shard.add(name, file, output.size)
+                    shard.manifest.append(entry)
+                    filenames.append(filename)
+            except Exception as exception:
+                error = type(exception).__name__ + ": " + str(exception)
+            finally:
+                discard_output(output)
+            on_written(error if error is None else "Could not write " + path + ": " + error)
+        if shard is not None:
+            try:
+                shard.close()
+            except Exception as exception:
+                with self.lock:
+                    self.errors.append(ArchiveError(path + ": " + type(exception).__name__ + ": " + str(exception), filenames))
+    
+    # Finish every shard. Raises an ArchiveError with all files of the shards that could not be finished
+    def close(self):
+        with self.lock:
+            if self.filling is not None:
+                self.filling.put(None)
+                self.filling = None
+        for thread in self.threads:
+            self.shards.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise ArchiveError("; ".join(str(error) for error in self.errors), [filename for error in self.errors for filename in error.filenames])
+
+# The archives of one batch, by path. Engines give it every result of run_job, and get them back from on_stored
+# once their outputs are in the archive (or failed). Without on_stored they are read with stored_results()
+class ArchiveSinks:
+    def __init__(self, on_stored = None):
+        self.sinks = {}
+        self.lock = threading.Lock()
+        self.stored = queue.Queue()
+        self.on_stored = on_stored or self.stored.put
+        self.waiting = 0
+        self.done = threading.Condition(self.lock)
+    
+    # Store the output of a result of run_job. on_stored gets the result without it, or failed if it could not be stored;
+    # right away if there is nothing to store. The temporary file of the output is always deleted
+    def store(self, job, result):
+        output = result.output
+        if output is None:
+            self.on_stored(result)
+            return
+        try:
+            name = archive_name(job)
+            entry = archive_entry(job, name, output.size)
+            with self.lock:
+                sink = self.sinks.get(job["archive"])
+                if sink is None:
+                    sink = self.sinks[job["archive"]] = ArchiveSink(job["archive"], job.get("shard_size"))
+                self.waiting = self.waiting + 1
+        except Exception as error:
+            discard_output(output)
+            self.on_stored(result._replace(count = 0, error = type(error).__name__ + ": " + str(error), output = None))
+            return
+        sink.add(job["filename"], name, output, entry, lambda error: self.written(result, error))
+    
+    def written(self, result, error):
+        try:
+            self.on_stored(result._replace(output = None) if error is None else result._replace(count = 0, error = error, output = None))
+        finally:
+            with self.lock:
+                self.waiting = self.waiting - 1
+                self.done.notify_all()
+    
+    # Results stored since the last call, without blocking (only without on_stored)
+    def stored_results(self):
+        while True:
+            try:
+                yield self.stored.get_nowait()
+            except queue.Empty:
+                return
+    
+    # Wait until every stored output is in its archive or failed
+    def join(self):
+        with self.lock:
+            while self.waiting:
+                self.done.wait()
+    
+    # Finish every archive. Raises an ArchiveError with the files of every archive that could not be finished
+    def close(self):
+        errors = []
+        for sink in self.sinks.values():
+            try:
+                sink.close()
+            except ArchiveError as error:
+                errors.append(error)
+        self.sinks = {}
+        if errors:
+            raise ArchiveError("; ".join(str(error) for error in errors), [filename for error in errors for filename in error.filenames])
+
+
+# Spreads batch jobs over a pool of worker processes.
+# run() is a generator for scripts; start()/poll() run the batch in a background thread so the GUI stays responsive.
+class BatchEngine:
+    def __init__(self, workers = None, window = None):
+        self.workers = workers or os.cpu_count() or 1
+        # Only a few jobs per worker are submitted at once, so cancelling is quick and huge batches use little memory
+        self.window = window or self.workers * 4
+        self.executor = None
+        self.thread = None
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+        
+    def get_executor(self):
+        # The pool is kept alive between batches, so workers are only started once
+        if self.executor is None:
+            self.executor = futures.ProcessPoolExecutor(self.workers)
+        return self.executor
+        
+    # Yields a BatchResult for every job, in completion order. jobs is an iterable of (index, process_image kwargs).
+    # Outputs of jobs with an archive are written into it here, and their results come once they are in it
+    def run(self, jobs):
+        self.cancelled.clear()
+        jobs = iter(jobs)
+        archives = ArchiveSinks()
+        try:
+            if self.workers <= 1:
+                for index, job in jobs:
+                    if self.cancelled.is_set():
+                        break
+                    archives.store(job, run_job(index, job))
+                    yield from archives.stored_results()
+            else:
+                yield from self.run_in_pool(jobs, archives)
+            archives.join()
+            yield from archives.stored_results()
+        finally:
+            archives.close()
+    
+    def run_in_pool(self, jobs, archives):
+        executor = self.get_executor()
+        pending = {}
+        try:
+            while True:
+                if self.cancelled.is_set():
+                    # Drop everything that has not started yet; running files are allowed to finish
+                    for future in pending:
+                        future.cancel()
+                else:
+                    while len(pending) < self.window:
+                        item = next(jobs, None)
+                        if item is None:
+                            break
+                        index, job = item
+                        pending[executor.submit(run_job, index, job)] = (index, job)
+                        
+                if not pending:
+                    break
+                
+                done, _ = futures.wait(pending, return_when = futures.FIRST_COMPLETED)
+                for future in done:
+                    index, job = pending.pop(future)
+                    if future.cancelled():
+                        continue
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        # Only happens if the pool itself broke (e.g. a worker was killed)
+                        self.executor = None
+                        result = BatchResult(index, job["filename"], 0, type(error).__name__ + ": " + str(error))
+                    archives.store(job, result)
+                yield from archives.stored_results()
+        finally:
+            for future in pending:
+                future.cancel()
+    
+    # Run a batch in a background thread. Results are collected with poll()
+    def start(self, jobs):
+        jobs = list(jobs)
+        self.cancelled.clear()
+        self.thread = threading.Thread(target = self.run_in_thread, args = (jobs,), daemon = True)
+        self.thread.start()
+        
+    def run_in_thread(self, jobs):
+        for result in self.run(jobs):
+            self.results.put(result)
+    
+    # Get all results that arrived since the last call, without blocking
+    def poll(self):
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+    
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+        
+    def cancel(self):
+        self.cancelled.set()
+        
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+        
+    # Stop the worker processes. Files that are being processed are finished first
+    def shutdown(self):
+        self.cancel()
+        if self.thread is not None:
+            self.thread.join()
+        if self.executor is not None:
+            self.executor.shutdown(wait = True)
+            self.executor = None
+    
+    
+# Reads and writes whole files for the pipeline. Replace it to read from somewhere else, or to simulate slow storage
+class LocalStorage:
+    def read(self, filename):
+        with open(filename, "rb") as file:
+            return file.read()
+            
+    def write(self, filename, data):
+        with open(filename, "wb") as file:
+            file.write(data)
+
+# Local files with an artificial delay on every read and write, to try the pipeline as if the files were on a slow share
+class LatencyStorage(LocalStorage):
+    def __init__(self, read_latency = 0.05, write_latency = 0.05):
+        self.read_latency = read_latency
+        self.write_latency = write_latency
+        
+    def read(self, filename):
+        time.sleep(self.read_latency)
+        return super().read(filename)
+        
+    def write(self, filename, data):
+        time.sleep(self.write_latency)
+        super().write(filename, data)
+
+# Limits the memory used by the images waiting between stages. An image bigger than the whole budget is still
+# allowed through when nothing else is in use, so it cannot block the pipeline forever
+class MemoryBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+        
+    def acquire(self, size):
+        with self.condition:
+            while self.used > 0 and self.used + size > self.limit:
+                self.condition.wait()
+            self.used = self.used + size
+            
+    def release(self, size):
+        with self.condition:
+            self.used = self.used - size
+            self.condition.notify_all()
+
+# Approximate memory used by a decoded image (Pillow stores 3 band images with 4 bytes per pixel)
+def image_memory(image):
+    bytes_per_pixel = {"1": 1, "L": 1, "P": 1, "LA": 4, "PA": 4, "I;16": 2, "I;16B": 2, "I;16L": 2, "I": 4, "F": 4}.get(image.mode, 4)
+    return image.width * image.height * bytes_per_pixel
+
+# Processes files in three overlapping stages connected by bounded queues: readers load and decode the next files,
+# one thread draws the scales, and writers encode and store the results. Decoding, encoding and file access release
+# the GIL, so waiting for slow storage overlaps with the work on other files even in a single process.
+# Used like BatchEngine: run() yields a BatchResult per file.
+class PipelineEngine(BatchEngine):
+    def __init__(self, readers = 4, writers = 4, queue_depth = 8, memory_limit = 1 << 30, storage = None):
+        super().__init__(workers = 1)
+        self.readers = readers
+        self.writers = writers
+        self.queue_depth = queue_depth
+        self.memory_limit = memory_limit
+        self.storage = storage if storage is not None else LocalStorage()
+    
+    def run(self, jobs):
+        self.cancelled.clear()
+        jobs = iter(jobs)
+        jobs_lock = threading.Lock()
+        budget = MemoryBudget(self.memory_limit)
+        render_queue = queue.Queue(self.queue_depth)
+        write_queue = queue.Queue(self.queue_depth)
+        results = queue.Queue()
+        readers_left = [self.readers]
+        # Results of jobs with an archive come from it, once their output is written
+        archives = ArchiveSinks(results.put)
+        
+        def next_job():
+            with jobs_lock:
+                if self.cancelled.is_set():
+                    return None
+                return next(jobs, None)
+        
+        # Stage 1: check the file, read it and decode it
+        def read_stage():
+            while True:
+                item = next_job()
+                if item is None:
+                    break
+                index, job = item
+                stats = {}
+                try:
+                    new_filename = prepare_output(job["filename"], job["input_dir"], job["output_dir"], job.get("extra_string", "_with_scale"),
+                                                  job.get("lowercase", True), stats, job_output_format(job.get("output_format"), job.get("pyramid")),
+                                                  not job.get("archive"))
+                    if new_filename is None:
+                        stats["skipped"] = True
+                        results.put(BatchResult(index, job["filename"], 1, None, stats))
+                        continue
+                    # Pyramids and stacks are streamed from the file, so they do not go through the stages nor the memory budget
+                    stack = None
+                    if not job.get("pyramid"):
+                        with time_stage(stats, "open"):
+                            stack = open_stack(job["filename"], new_filename)
+                    if job.get("pyramid") or stack is not None:
+                        with archive_spool() if job.get("archive") else nullcontext(new_filename) as output:
+                            if stack is None:
+                                write_pyramid(job["filename"], output, job["pixel_per_unit"], job["bar_width_unit"], job["unit"], job["color"],
+                                              job.get("encoder", "default"), stats)
+                            else:
+                                with stack:
+                                    save_stack(stack, output, job["pixel_per_unit"], job["bar_width_unit"], job["unit"], job["color"],
+                                               job.get("encoder", "default"), stats)
+                            record_sizes(stats, job["filename"], output)
+                        archives.store(job, BatchResult(index, job["filename"], 1, None, stats,
+                                                        ArchiveOutput(output.name, stats["bytes_written"]) if job.get("archive") else None))
+                        continue
+                    if (job.get("region_only") and not job.get("archive") and not job.get("output_format")
+                            and os.path.splitext(job["filename"])[1].lower() in Region_Formats):
+                        with time_stage(stats, "region"):
+                            rewritten = rewrite_region(job["filename"], new_filename, job["pixel_per_unit"], job["bar_width_unit"], job["unit"], job["color"])
+                        if rewritten:
+                            stats.update(bytes_read = os.path.getsize(job["filename"]), bytes_written = os.path.getsize(new_filename))
+                            results.put(BatchResult(index, job["filename"], 1, None, stats))
+                            continue
+                    with time_stage(stats, "read"):
+                        data = self.storage.read(job["filename"])
+                    stats["bytes_read"] = len(data)
+                    image = Image.open(io.BytesIO(data))
+                    size = image_memory(image)
+                    with time_stage(stats, "wait"):
+                        budget.acquire(size)
+                    try:
+                        with time_stage(stats, "open"):
+                            image.load()
+                    except Exception:
+                        budget.release(size)
+                        raise
+                    record_image(stats, image)
+                    render_queue.put((index, job, new_filename, image, size, stats))
+                except Exception as error:
+                    results.put(BatchResult(index, job["filename"], 0, type(error).__name__ + ": " + str(error), stats))
+            with jobs_lock:
+                readers_left[0] = readers_left[0] - 1
+                if readers_left[0] == 0:
+                    render_queue.put(None)
+        
+        # Stage 2: draw the scales
+        def render_stage():
+            while True:
+                item = render_queue.get()
+                if item is None:
+                    break
+                index, job, new_filename, image, size, stats = item
+                try:
+                    with time_stage(stats, "draw"):
+                        add_scale(image, job["pixel_per_unit"], job["bar_width_unit"], job["unit"], job["color"])
+                    write_queue.put(item)
+                except Exception as error:
+                    budget.release(size)
+                    results.put(BatchResult(index, job["filename"], 0, type(error).__name__ + ": " + str(error), stats))
+            for i in range(self.writers):
+                write_queue.put(None)
+        
+        # Stage 3: encode and write the results
+        def write_stage():
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    break
+                index, job, new_filename, image, size, stats = item
+                try:
+                    with archive_spool() if job.get("archive") else nullcontext(io.BytesIO()) as output:
+                        with time_stage(stats, "save"):
+                            save_image(image, output, new_filename, job.get("encoder", "default"))
+                        stats["bytes_written"] = output.seek(0, os.SEEK_END)
+                        data = None if job.get("archive") else output.getvalue()
+                    image.close()
+                    budget.release(size)
+                    size = 0
+                    if job.get("archive"):
+                        archives.store(job, BatchResult(index, job["filename"], 1, None, stats, ArchiveOutput(output.name, stats["bytes_written"])))
+                        continue
+                    with time_stage(stats, "write"):
+                        self.storage.write(new_filename, data)
+                    results.put(BatchResult(index, job["filename"], 1, None, stats))
+                except Exception as error:
+                    results.put(BatchResult(index, job["filename"], 0, type(error).__name__ + ": " + str(error), stats))
+                finally:
+                    budget.release(size)
+            results.put(None)
+        
+        threads = [threading.Thread(target = read_stage, daemon = True) for i in range(self.readers)]
+        threads.append(threading.Thread(target = render_stage, daemon = True))
+        threads.extend(threading.Thread(target = write_stage, daemon = True) for i in range(self.writers))
+        writers_left = self.writers
+        try:
+            for thread in threads:
+                thread.start()
+            while writers_left:
+                result = results.get()
+                if result is None:
+                    writers_left = writers_left - 1
+                else:
+                    yield result
+            archives.join()
+            while not results.empty():
+                yield results.get()
+        finally:
+            if writers_left:
+                # Stopped early (the generator was closed): start no new file, let the stages finish theirs
+                self.cancelled.set()
+            for thread in threads:
+                if thread.is_alive():
+                    thread.join()
+            archives.close()
+
+
+# Metrics: statistics of every processed file, to find which formats, sizes or shares are slow.
+# Metrics.record() takes the BatchResults of a batch; hooks get one record (a dict) per file as it finishes,
+# e.g. JsonLinesWriter for a log, and the totals and histograms can be written in the Prometheus text format.
+
+# Upper bounds, in seconds, of the buckets of the stage time histograms
+Metrics_Buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Size classes of the histograms, as (name, upper bound in megapixels)
+Size_Classes = [("0-1MP", 1), ("1-8MP", 8), ("8-50MP", 50), ("50MP+", None)]
+
+def size_class(pixels):
+    if not pixels:
+        return "unknown"
+    for name, megapixels in Size_Classes:
+        if megapixels is None or pixels <= megapixels * 1e6:
+            return name
+
+# Histogram of durations. counts[i] is the number of values in bucket i (not cumulative), the last one is +Inf
+class Histogram:
+    def __init__(self, buckets = Metrics_Buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+# One line of the metrics: what happened to a file, how big it was and how long each stage took
+def metrics_record(result):
+    stats = result.stats or {}
+    if result.error is not None:
+        outcome = "failed"
+    elif stats.get("skipped"):
+        outcome = "skipped"
+    else:
+        outcome = "processed"
+    record = {"time": round(time.time(), 3), "filename": result.filename, "outcome": outcome,
+              "format": os.path.splitext(result.filename)[1].lower().lstrip(".") or "none",
+              "size_class": size_class(stats.get("pixels"))}
+    for key in ("mode", "width", "height", "pixels", "frames", "bytes_read", "bytes_written"):
+        if key in stats:
+            record[key] = stats[key]
+    record["seconds"] = dict((stage, round(seconds, 6)) for stage, seconds in stats.get("seconds", {}).items())
+    if result.error is not None:
+        record["error"] = result.error
+        record["reason"] = result.error.split(":")[0]
+    return record
+
+# Writes every record as one line of JSON. Can be given as a hook to Metrics
+class JsonLinesWriter:
+    def __init__(self, path):
+        self.file = open(path, "a", encoding = "utf-8")
+        
+    def __call__(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        
+    def close(self):
+        self.file.close()
+
+def prometheus_labels(labels):
+    return "{" + ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for name, value in labels) + "}"
+
+class Metrics:
+    def __init__(self, hooks = ()):
+        self.hooks = list(hooks)
+        self.lock = threading.Lock()
+        self.clear()
+        
+    def clear(self):
+        with self.lock:
+            self.files = {}      # (format, size class, outcome): number of files
+            self.failures = {}   # reason: number of files
+            self.totals = {}     # format: {"bytes_read", "bytes_written", "pixels"}
+            self.histograms = {} # (stage, format, size class): Histogram
+    
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+    
+    # Add a BatchResult. Returns its record
+    def record(self, result):
+        record = metrics_record(result)
+        file_format, size = record["format"], record["size_class"]
+        with self.lock:
+            key = (file_format, size, record["outcome"])
+            self.files[key] = self.files.get(key, 0) + 1
+            if "reason" in record:
+                self.failures[record["reason"]] = self.failures.get(record["reason"], 0) + 1
+            totals = self.totals.setdefault(file_format, {"bytes_read": 0, "bytes_written": 0, "pixels": 0})
+            for name in totals:
+                totals[name] = totals[name] + record.get(name, 0)
+            for stage, seconds in record["seconds"].items():
+                key = (stage, file_format, size)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram()
+                self.histograms[key].observe(seconds)
+        for hook in self.hooks:
+            hook(record)
+        return record
+    
+    # Totals for a JSON summary: files per outcome, failures per reason, and seconds spent in every stage
+    def summary(self):
+        with self.lock:
+            outcomes = {}
+            for (file_format, size, outcome), count in self.files.items():
+                outcomes[outcome] = outcomes.get(outcome, 0) + count
+            stages = {}
+            for (stage, file_format, size), histogram in self.histograms.items():
+                stages[stage] = stages.get(stage, 0) + histogram.sum
+            return {"files": outcomes, "failures": dict(self.failures),
+                    "seconds": dict((stage, round(seconds, 3)) for stage, seconds in sorted(stages.items())),
+                    "bytes_read": sum(totals["bytes_read"] for totals in self.totals.values()),
+                    "bytes_written": sum(totals["bytes_written"] for totals in self.totals.values())}
+    
+    # Everything in the Prometheus text format
+    def prometheus(self):
+        lines = []
+        def metric(name, metric_type, help_text):
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + metric_type)
+        with self.lock:
+            metric("autoscale_files_total", "counter", "Files handled, by format, size class and outcome.")
+            for (file_format, size, outcome), count in sorted(self.files.items()):
+                lines.append("autoscale_files_total" + prometheus_labels([("format", file_format), ("size_class", size), ("outcome", outcome)]) + " " + str(count))
+            metric("autoscale_failures_total", "counter", "Files that could not be processed, by reason.")
+            for reason, count in sorted(self.failures.items()):
+                lines.append("autoscale_failures_total" + prometheus_labels([("reason", reason)]) + " " + str(count))
+            for name, help_text in (("bytes_read", "Bytes of the input files."), ("bytes_written", "Bytes of the output files."),
+                                    ("pixels", "Pixels of the decoded images.")):
+                metric("autoscale_" + name + "_total", "counter", help_text + " By format.")
+                for file_format, totals in sorted(self.totals.items()):
+                    lines.append("autoscale_" + name + "_total" + prometheus_labels([("format", file_format)]) + " " + str(totals[name]))
+            metric("autoscale_stage_seconds", "histogram", "Time spent in every stage of the processing, by format and size class.")
+            for (stage, file_format, size), histogram in sorted(self.histograms.items()):
+                labels = [("stage", stage), ("format", file_format), ("size_class", size)]
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                    cumulative = cumulative + count
+                    lines.append("autoscale_stage_seconds_bucket" + prometheus_labels(labels + [("le", bound)]) + " " + str(cumulative))
+                lines.append("autoscale_stage_seconds_sum" + prometheus_labels(labels) + " " + repr(histogram.sum))
+                lines.append("autoscale_stage_seconds_count" + prometheus_labels(labels) + " " + str(histogram.count))
+        return "\n".join(lines) + "\n"
+    
+    # Write the Prometheus file in one go, so a collector never reads half of it
+    def write_prometheus(self, path):
+        temporary = path + ".tmp"
+        with open(temporary, "w", encoding = "utf-8") as file:
+            file.write(self.prometheus())
+        os.replace(temporary, path)
+
+
+# Name of the file, in the output folder, that remembers which images were already processed
+Build_Cache_Filename = ".autoscale_cache.json"
+
+# Remembers, for each input file, its size and modification time, the settings used and the output file.
+# A job is up to date if none of these changed and the output still exists, so it does not need to run again.
+# With check_content, files that were touched but not changed (same content hash) are also up to date.
+# Several threads can record and save at the same time (daemon batches writing to the same output folder).
+class BuildCache:
+    def __init__(self, path, check_content = False):
+        self.path = path
+        self.check_content = check_content
+        self.entries = {}
+        self.skipped = 0
+        self.lock = threading.Lock()
+        self.load()
+    
+    @staticmethod
+    def for_output_dir(output_dir, check_content = False):
+        return BuildCache(os.path.join(output_dir, Build_Cache_Filename), check_content)
+        
+    def load(self):
+        try:
+            with open(self.path, encoding = "utf-8") as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+            
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        # Write to a temporary file first, so an interrupted save never leaves a broken cache
+        temporary_path = self.path + ".tmp"
+        with self.lock:
+            with open(temporary_path, "w", encoding = "utf-8") as file:
+                json.dump(self.entries, file)
+            os.replace(temporary_path, self.path)
+    
+    # Settings of a job that change the output: everything except the paths
+    @staticmethod
+    def job_settings(job):
+        return [[key, job[key]] for key in sorted(job) if key not in ("filename", "input_dir", "output_dir")]
+        
+    @staticmethod
+    def job_output(job):
+        return output_filename(job["filename"], job["input_dir"], job["output_dir"], job.get("extra_string", "_with_scale"), job.get("lowercase", True),
+                               job_output_format(job.get("output_format"), job.get("pyramid")))
+    
+    @staticmethod
+    def file_hash(filename):
+        digest = hashlib.sha1()
+        with open(filename, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+        
+    def is_up_to_date(self, job):
+        filename = os.path.abspath(job["filename"])
+        entry = self.entries.get(filename)
+        if entry is None:
+            return False
+        output = self.job_output(job)
+        if entry["settings"] != self.job_settings(job) or entry["output"] != output or not os.path.exists(output):
+            return False
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]:
+            return True
+        if self.check_content and stat.st_size == entry["size"] and entry.get("hash") == self.file_hash(filename):
+            # Same content: remember the new time so the hash is not needed next time
+            entry["mtime_ns"] = stat.st_mtime_ns
+            return True
+        return False
+    
+    # Remember a job that was processed successfully
+    def record(self, job):
+        filename = os.path.abspath(job["filename"])
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return # Removed since it was processed
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "settings": self.job_settings(job), "output": self.job_output(job)}
+        if self.check_content:
+            entry["hash"] = self.file_hash(filename)
+        with self.lock:
+            self.entries[filename] = entry
+    
+    # Only keep the jobs that are not up to date. The number of skipped jobs is kept in self.skipped
+    def filter_jobs(self, jobs):
+        for index, job in jobs:
+            if self.is_up_to_date(job):
+                self.skipped = self.skipped + 1
+            else:
+                yield index, job
+    
+    
+# Images (os.DirEntry) and subfolders (paths) of one folder, sorted. Folders that cannot be read are ignored, like os.walk does
+def scan_folder(path):
+    files = []
+    folders = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks = False):
+                        folders.append(entry.path)
+                    elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in Valid_Filenames:
+                        files.append(entry)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    files.sort(key = lambda entry: entry.name)
+    folders.sort()
+    return files, folders
+
+# Yields the os.DirEntry of every image in a folder. Subfolders are scanned in parallel by a few threads, which helps a lot
+# on network shares, but the entries always come in the same order: the files of a folder, then each of its subfolders
+# in turn. Entries keep the stat data the system gave while listing the folder.
+def scan_images(folder_path, run_subdirectories = False, workers = 8, stop = None):
+    if not run_subdirectories or workers <= 1:
+        folders = [folder_path]
+        while folders:
+            files, subfolders = scan_folder(folders.pop())
+            yield from files
+            if stop is not None and stop.is_set():
+                return
+            if run_subdirectories:
+                folders.extend(reversed(subfolders))
+        return
+    
+    closed = threading.Event()
+    # Every scan starts the scans of its subfolders as soon as it is done, so the threads never wait for the caller
+    def scan(path):
+        if closed.is_set():
+            return [], []
+        files, subfolders = scan_folder(path)
+        return files, [executor.submit(scan, subfolder) for subfolder in subfolders]
+    
+    with futures.ThreadPoolExecutor(workers) as executor:
+        folders = [executor.submit(scan, folder_path)]
+        try:
+            while folders:
+                files, subfolders = folders.pop().result()
+                yield from files
+                if stop is not None and stop.is_set():
+                    return
+                folders.extend(reversed(subfolders))
+        finally:
+            # Scans that did not start yet return at once
+            closed.set()
+
+# Calibration: the pixel per unit of each file. It is read from the image header when the microscope software wrote it
+# (TIFF resolution, ImageJ and OME descriptions, Zeiss LSM, JPEG/PNG/BMP density), otherwise the objective is guessed
+# from the filename. Headers are read without decoding any pixels, several files at a time.
+
+# Length of each unit in micrometers
+Unit_Lengths = {"nm": 1e-3, "um": 1.0, "µm": 1.0, "μm": 1.0, "micron": 1.0, "microns": 1.0, "mm": 1e3, "cm": 1e4, "m": 1e6, "in": 25400.0, "inch": 25400.0}
+
+# Pixel per unit of each objective, how to recognize them in filenames, and how far to trust image headers.
+# A profile can be loaded from a JSON file like:
+#   {"unit": "um", "default": "10x", "objectives": {"10x": 2.604169, "50x": 12.84722},
+#    "patterns": [["(?i)50x|x50", "50x"]], "use_headers": true, "min_pixel_per_um": 0.1, "tolerance": 0.02}
+# Patterns are regular expressions searched in the filename, in order. Header resolutions below min_pixel_per_um
+# (e.g. the 72 or 300 dpi written by any program) are ignored. A header value within tolerance (relative) of an
+# objective selects that objective, any other value is used as a custom pixel per unit.
+class CalibrationProfile:
+    def __init__(self, objectives, patterns = (), default = None, unit = "um", use_headers = True, min_pixel_per_um = 0.1, tolerance = 0.02):
+        self.objectives = dict((str(name), float(value)) for name, value in objectives.items())
+        try:
+            self.patterns = [(re.compile(pattern), str(objective)) for pattern, objective in patterns]
+        except re.error as error:
+            raise ValueError("Wrong pattern in calibration profile: " + str(error))
+        self.default = default if default is not None else next(iter(self.objectives))
+        self.unit = unit
+        self.use_headers = use_headers
+        self.min_pixel_per_um = min_pixel_per_um
+        self.tolerance = tolerance
+        for objective in [self.default] + [objective for pattern, objective in self.patterns]:
+            if objective not in self.objectives:
+                raise ValueError("Unknown objective " + repr(objective) + " in calibration profile")
+        if unit not in Unit_Lengths:
+            raise ValueError("Unknown unit " + repr(unit) + " in calibration profile (use " + ", ".join(sorted(Unit_Lengths)) + ")")
+    
+    @staticmethod
+    def load(path):
+        with open(path, encoding = "utf-8") as file:
+            settings = json.load(file)
+        if not isinstance(settings, dict) or not settings.get("objectives"):
+            raise ValueError(path + " is not a calibration profile: it needs at least \"objectives\"")
+        names = ("patterns", "default", "unit", "use_headers", "min_pixel_per_um", "tolerance")
+        return CalibrationProfile(settings["objectives"], **dict((name, settings[name]) for name in names if name in settings))
+    
+    # The profile in Calibration_Filename next to this file if there is one, otherwise the built-in profile
+    @staticmethod
+    def find():
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), Calibration_Filename)
+        if os.path.exists(path):
+            return CalibrationProfile.load(path)
+        return Default_Profile
+    
+    # Objective of a file, from its name
+    def guess_zoom(self, filename):
+        for pattern, objective in self.patterns:
+            if pattern.search(filename):
+                return objective
+        return self.default
+    
+    # Objective with this pixel per unit, or "Custom"
+    def zoom_for(self, pixel_per_unit):
+        for objective, value in self.objectives.items():
+            if abs(pixel_per_unit - value) <= value * self.tolerance:
+                return objective
+        return "Custom"
+    
+    # (zoom, pixel per unit) of a file: from the calibration in its header if there is one, otherwise guessed from its name
+    def calibration(self, filename, pixel_per_unit = None):
+        if pixel_per_unit is None:
+            zoom = self.guess_zoom(filename)
+            return zoom, self.objectives[zoom]
+        return self.zoom_for(pixel_per_unit), pixel_per_unit
+    
+    # Pixel per unit for a calibration read from an image header (in pixels per micrometer), or None if it cannot be trusted
+    def header_calibration(self, pixels_per_um):
+        if pixels_per_um is None or pixels_per_um < self.min_pixel_per_um:
+            return None
+        return pixels_per_um * Unit_Lengths[self.unit]
+    
+    # Everything that changes the settings given to files, to know when they must be worked out again
+    def signature(self):
+        return json.dumps([self.objectives, [(pattern.pattern, objective) for pattern, objective in self.patterns], self.default,
+                           self.unit, self.use_headers, self.min_pixel_per_um, self.tolerance], sort_keys = True)
+
+# Name of a calibration profile that is loaded automatically if it is next to AutoScale.py
+Calibration_Filename = "autoscale_calibration.json"
+
+# The objectives of the lab microscope, recognized in filenames like sample_x10.jpg or sample_50x.jpg
+Default_Profile = CalibrationProfile(Zoom_Levels, [("100x|x100", "100x"), ("50x|x50", "50x")], "10x")
+
+# Offset of VoxelSizeX (float64, in meters) in the Zeiss LSM information block (TIFF tag 34412)
+Lsm_Voxel_Size_Offset = 40
+
+# Pixels per micrometer given in an image description, or None
+def description_pixels_per_um(description, x_resolution):
+    if isinstance(description, bytes):
+        description = description.decode("utf-8", "replace")
+    # OME-XML: size of a pixel, in micrometers unless another unit is given
+    match = re.search(r'PhysicalSizeX="([0-9.eE+-]+)"', description)
+    if match:
+        unit = re.search(r'PhysicalSizeXUnit="([^"]+)"', description)
+        size = float(match.group(1)) * Unit_Lengths.get(unit.group(1) if unit else "um", 0)
+        return 1 / size if size > 0 else None
+    # ImageJ: the TIFF resolution is in pixels per unit of the description
+    if description.startswith("ImageJ=") and x_resolution:
+        match = re.search(r"^unit=(\S+)", description, re.MULTILINE)
+        if match and match.group(1).replace("\\u00B5", "µ") in Unit_Lengths:
+            return x_resolution / Unit_Lengths[match.group(1).replace("\\u00B5", "µ")]
+    return None
+
+# Tags of the first TIFF directory that can hold the calibration: description, X resolution, resolution unit, Zeiss LSM information
+Calibration_Tags = (270, 282, 296, 34412)
+
+# Values of the calibration tags of a TIFF file, as {tag: value}, or None if it is not a TIFF.
+# Only the first directory is read, with plain struct calls, which is much faster than opening the file with Pillow
+def read_tiff_calibration_tags(file):
+    header = read_tiff_header(file)
+    if header is None:
+        return None
+    byte_order, ifd_offset, bigtiff = header
+    entries = read_tiff_entries(file, byte_order, ifd_offset, bigtiff)
+    tags = {}
+    for tag in Calibration_Tags:
+        if tag not in entries:
+            continue
+        field_type, count, position = entries[tag]
+        file.seek(position)
+        if field_type == 5: # Rational
+            numerator, denominator = struct.unpack(byte_order + "LL", file.read(8))
+            tags[tag] = numerator / denominator if denominator else 0
+        elif field_type == 2: # Text. OME descriptions can be huge, the sizes are at the start
+            tags[tag] = file.read(min(count, 1 << 20)).rstrip(b"\0").decode("utf-8", "replace")
+        elif field_type in (1, 7): # Bytes
+            tags[tag] = file.read(min(count, 1 << 20))
+        else:
+            values = read_tiff_values(file, byte_order, entries[tag])
+            tags[tag] = values[0] if values else None
+    return tags
+
+def tiff_pixels_per_um(tags):
+    x_resolution = tags.get(282)
+    if isinstance(tags.get(270), str):
+        pixels_per_um = description_pixels_per_um(tags[270], x_resolution)
+        if pixels_per_um:
+            return pixels_per_um
+    lsm_information = tags.get(34412)
+    if isinstance(lsm_information, bytes) and len(lsm_information) >= Lsm_Voxel_Size_Offset + 8:
+        voxel_size = struct.unpack_from("<d", lsm_information, Lsm_Voxel_Size_Offset)[0]
+        if voxel_size > 0:
+            return 1e-6 / voxel_size
+    if x_resolution:
+        unit = tags.get(296, 2)
+        if unit == 2:
+            return x_resolution / Unit_Lengths["inch"]
+        if unit == 3:
+            return x_resolution / Unit_Lengths["cm"]
+    return None
+
+# Pixels per micrometer written in the header of a file, or None. No pixels are decoded
+def header_pixels_per_um(filename):
+    with open(filename, "rb") as file:
+        tags = read_tiff_calibration_tags(file)
+    if tags is not None:
+        return tiff_pixels_per_um(tags)
+    
+    with Image.open(filename) as image:
+        for key in ("Description", "ImageDescription", "description", "comment"):
+            if key in image.info:
+                pixels_per_um = description_pixels_per_um(image.info[key], None)
+                if pixels_per_um:
+                    return pixels_per_um
+        # JPEG, PNG and BMP densities are given as dpi by Pillow
+        dpi = image.info.get("dpi")
+        if dpi and dpi[0]:
+            return float(dpi[0]) / Unit_Lengths["inch"]
+    return None
+
+# Same as header_pixels_per_um, but None for files that cannot be read
+def read_header_pixels_per_um(filename):
+    try:
+        return header_pixels_per_um(filename)
+    except Exception: # Unreadable files are reported when they are processed
+        return None
+
+# Pixel per unit (in the unit of the profile) written in the header of a file, or None if there is none that can be trusted
+def read_header_calibration(filename, profile):
+    return profile.header_calibration(read_header_pixels_per_um(filename))
+
+# Yields (filename, pixels per micrometer from the header or None) for every filename, in the same order.
+# Up to workers headers are read at the same time, which matters most on network shares
+def read_headers(filenames, workers = 8):
+    if workers <= 1:
+        for filename in filenames:
+            yield filename, read_header_pixels_per_um(filename)
+        return
+    
+    with futures.ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        try:
+            for filename in filenames:
+                pending.append((filename, executor.submit(read_header_pixels_per_um, filename)))
+                if len(pending) >= workers * 8:
+                    filename, future = pending.popleft()
+                    yield filename, future.result()
+            while pending:
+                filename, future = pending.popleft()
+                yield filename, future.result()
+        finally:
+            for filename, future in pending:
+                future.cancel()
+
+# Yields (filename, pixel per unit from the header or None) for every filename, in the same order
+def calibrate_files(filenames, profile, workers = 8):
+    if not profile.use_headers:
+        for filename in filenames:
+            yield filename, None
+        return
+    for filename, pixels_per_um in read_headers(filenames, workers):
+        yield filename, profile.header_calibration(pixels_per_um)
+
+
+# Watches a folder for new images. An image is only reported once its size and modification time did not change
+# between two polls, so files that are still being written are not processed too early.
+class FolderWatcher:
+    def __init__(self, folder_path, run_subdirectories = False, interval = 2.0, known = (), ignore = None):
+        self.folder_path = folder_path
+        self.run_subdirectories = run_subdirectories
+        self.interval = interval
+        self.ignore = ignore
+        self.seen = set(known)
+        self.pending = {}
+        self.stop_event = threading.Event()
+        
+    # New images that are complete since the last poll
+    def poll(self):
+        ready = []
+        pending = {}
+        for entry in scan_images(self.folder_path, self.run_subdirectories, stop = self.stop_event):
+            if entry.path in self.seen or (self.ignore is not None and self.ignore(entry.path)):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self.pending.get(entry.path) == signature:
+                ready.append(entry.path)
+                self.seen.add(entry.path)
+            else:
+                pending[entry.path] = signature
+        self.pending = pending
+        return ready
+    
+    # Yields lists of new images until stop() is called
+    def watch(self):
+        while not self.stop_event.is_set():
+            ready = self.poll()
+            if ready:
+                yield ready
+            self.stop_event.wait(self.interval)
+            
+    def stop(self):
+        self.stop_event.set()
+    
+    
+# Catalog: the files of a folder and their settings, kept in a SQLite database so the list does not have to be built
+# again every time the folder is opened, and settings edited in the window are not lost.
+# Opening a folder again only lists the folders whose modification time changed (a file was added, removed or renamed);
+# files changed in place are caught by the build cache when they are processed. The header calibration is stored as
+# read, so the settings can be worked out again when the calibration profile changes; settings edited by the user are kept.
+# Catalogs are kept in the cache folder of the user, one per folder, so nothing is written next to the images.
+
+# Version of the catalog tables. Catalogs of another version are built again
+Catalog_Version = 1
+
+# Files only refer to a row of the settings table, since most files share the same settings: the table of files stays
+# small, and a whole catalog loads with two strings
+class Catalog:
+    Schema = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, mtime_ns INTEGER);
+        CREATE TABLE IF NOT EXISTS settings (id INTEGER PRIMARY KEY, do INTEGER, zoom TEXT, pixel_per_unit REAL, bar_width_unit REAL,
+                                             unit TEXT, color TEXT, UNIQUE (do, zoom, pixel_per_unit, bar_width_unit, unit, color));
+        CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, folder TEXT, header REAL, edited INTEGER DEFAULT 0, settings INTEGER) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+        CREATE INDEX IF NOT EXISTS files_settings ON files (settings);
+        CREATE INDEX IF NOT EXISTS settings_zoom ON settings (zoom);
+    """
+    Settings_Columns = "do, zoom, pixel_per_unit, bar_width_unit, unit, color"
+    # Folders modified less than this many seconds before they were listed are listed again next time, since files
+    # added in the same clock tick would not change their modification time
+    Settle_Time = 2.0
+    
+    def __init__(self, path, root):
+        self.path = path
+        self.root = os.path.abspath(root)
+        self.prefix = os.path.join(self.root, "")
+        self.lock = threading.RLock()
+        # Ids of the settings rows used by the current write
+        self.settings_ids = {}
+        self.connection = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        try:
+            # WAL: the window and command line runs can read the catalog while another one writes to it
+            self.connection.execute("PRAGMA journal_mode = WAL")
+            self.connection.execute("PRAGMA synchronous = NORMAL")
+            with self.connection:
+                if self.get_meta("version") not in (None, str(Catalog_Version)):
+                    self.connection.executescript("DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS settings; DROP TABLE IF EXISTS folders; "
+                                                  "DROP TABLE IF EXISTS meta;")
+                self.connection.executescript(self.Schema)
+                self.set_meta("version", Catalog_Version)
+                self.set_meta("root", self.root)
+        except BaseException:
+            self.connection.close()
+            raise
+    
+    # The catalog of a folder, in the cache folder of the user (or in cache_folder)
+    @staticmethod
+    def for_folder(folder_path, cache_folder = None):
+        cache_folder = cache_folder or default_cache_folder("catalogs")
+        os.makedirs(cache_folder, exist_ok = True)
+        folder_path = os.path.abspath(folder_path)
+        name = hashlib.sha1(os.path.normcase(folder_path).encode("utf-8", "surrogateescape")).hexdigest() + ".sqlite"
+        return Catalog(os.path.join(cache_folder, name), folder_path)
+    
+    def close(self):
+        with self.lock:
+            self.connection.close()
+    
+    def get_meta(self, key):
+        try:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        except sqlite3.OperationalError: # No tables yet
+            return None
+        return row[0] if row else None
+    
+    def set_meta(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+    
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    
+    # Id of a settings row (do, zoom, pixel per unit, bar width, unit, color), added if it is new
+    def settings_id(self, values):
+        settings_id = self.settings_ids.get(values)
+        if settings_id is None:
+            row = (1 if values[0] else 0, str(values[1]), float(values[2]), float(values[3]), str(values[4]), str(values[5]))
+            self.connection.execute("INSERT OR IGNORE INTO settings (" + self.Settings_Columns + ") VALUES (?, ?, ?, ?, ?, ?)", row)
+            settings_id = self.connection.execute("SELECT id FROM settings WHERE do = ? AND zoom = ? AND pixel_per_unit = ? AND "
+                                                  "bar_width_unit = ? AND unit = ? AND color = ?", row).fetchone()[0]
+            self.settings_ids[values] = settings_id
+        return settings_id
+    
+    # Bring the catalog up to date with the folder. Returns (files added, files removed).
+    # on_added is given the new files as they are added, as lists of records like iter_records gives
+    def reconcile(self, profile, run_subdirectories = False, workers = 8, stop = None, on_added = None):
+        with self.lock, self.connection:
+            self.settings_ids.clear()
+            if self.get_meta("subdirectories") != str(bool(run_subdirectories)):
+                if run_subdirectories:
+                    # Subfolders were never listed: list everything again
+                    self.connection.execute("UPDATE folders SET mtime_ns = -1")
+                else:
+                    self.connection.execute("DELETE FROM files WHERE folder != ''")
+                    self.connection.execute("DELETE FROM folders WHERE path != ''")
+                self.set_meta("subdirectories", bool(run_subdirectories))
+            if self.get_meta("profile") != profile.signature():
+                self.recalibrate(profile)
+                self.set_meta("profile", profile.signature())
+            
+            known = dict(self.connection.execute("SELECT path, mtime_ns FROM folders"))
+            known.setdefault("", -1)
+            added = removed = 0
+            with futures.ThreadPoolExecutor(max(1, workers)) as executor:
+                changed = []
+                for folder, mtime_ns in zip(known, executor.map(self.folder_mtime, known)):
+                    if mtime_ns is None:
+                        removed = removed + self.forget_folder(folder)
+                    elif mtime_ns != known[folder]:
+                        changed.append((folder, mtime_ns))
+                
+                # New subfolders are found while listing their parent, and listed in the next round
+                while changed and not (stop is not None and stop.is_set()):
+                    listings = executor.map(scan_folder, [os.path.join(self.root, folder) for folder, mtime_ns in changed])
+                    new_folders = []
+                    for (folder, mtime_ns), (entries, subfolders) in zip(changed, listings):
+                        new_files, gone = self.update_folder(folder, mtime_ns, entries)
+                        self.add_files(profile, new_files, workers, on_added)
+                        added = added + len(new_files)
+                        removed = removed + gone
+                        if run_subdirectories:
+                            for subfolder in subfolders:
+                                subfolder = self.relative(subfolder)
+                                if subfolder not in known:
+                                    known[subfolder] = -1
+                                    new_folders.append((subfolder, self.folder_mtime(subfolder)))
+                    changed = [(folder, mtime_ns) for folder, mtime_ns in new_folders if mtime_ns is not None]
+                if changed:
+                    # Stopped before new subfolders were listed: list everything again next time, so they are found
+                    self.connection.execute("UPDATE folders SET mtime_ns = -1")
+            return added, removed
+    
+    def relative(self, path):
+        if path.startswith(self.prefix):
+            return path[len(self.prefix):]
+        path = os.path.relpath(path, self.root)
+        return "" if path == os.curdir else path
+    
+    # Modification time of a folder of the catalog, or None if it is gone
+    def folder_mtime(self, folder):
+        try:
+            return os.stat(os.path.join(self.root, folder)).st_mtime_ns
+        except OSError:
+            return None
+    
+    # Remove a folder that does not exist anymore. Returns how many files it had
+    def forget_folder(self, folder):
+        self.connection.execute("DELETE FROM folders WHERE path = ?", (folder,))
+        return self.connection.execute("DELETE FROM files WHERE folder = ?", (folder,)).rowcount
+    
+    # Compare the listing of a folder with the catalog. Files that are gone are removed.
+    # Returns the new files (relative paths) and how many were removed
+    def update_folder(self, folder, mtime_ns, entries):
+        if time.time() - mtime_ns / 1e9 < self.Settle_Time:
+            mtime_ns = -1
+        self.connection.execute("INSERT OR REPLACE INTO folders VALUES (?, ?)", (folder, mtime_ns))
+        names = set(os.path.join(folder, entry.name) for entry in entries)
+        old_names = set(path for path, in self.connection.execute("SELECT path FROM files WHERE folder = ?", (folder,)))
+        gone = old_names.difference(names)
+        self.connection.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in gone))
+        return sorted(names.difference(old_names)), len(gone)
+    
+    # Settings (do, zoom, pixel per unit, bar width, unit, color) of a file that the user did not edit, from the
+    # calibration in its header (pixels per micrometer) or its name
+    def calibrated_settings(self, profile, filename, pixels_per_um, do = 1, bar_width_unit = 50, color = "white"):
+        header = profile.header_calibration(pixels_per_um) if profile.use_headers else None
+        zoom, pixel_per_unit = profile.calibration(filename, header)
+        return (do, zoom, pixel_per_unit, bar_width_unit, profile.unit, color)
+    
+    # Add new files, with the calibration in their header. They are written a thousand at a time
+    def add_files(self, profile, paths, workers = 8, on_added = None):
+        records = []
+        for filename, pixels_per_um in read_headers([os.path.join(self.root, path) for path in paths], workers):
+            records.append((filename, pixels_per_um) + self.calibrated_settings(profile, filename, pixels_per_um))
+            if len(records) >= 1000:
+                self.insert_files(records, on_added)
+                records = []
+        self.insert_files(records, on_added)
+    
+    def insert_files(self, records, on_added = None):
+        rows = []
+        for record in records:
+            path = self.relative(record[0])
+            rows.append((path, os.path.dirname(path), record[1], self.settings_id(record[2:])))
+        self.connection.executemany("INSERT OR REPLACE INTO files (path, folder, header, settings) VALUES (?, ?, ?, ?)", rows)
+        if on_added is not None and records:
+            on_added([record[:1] + record[2:] for record in records])
     
+    # Work out the calibration of the files the user did not edit again, for another calibration profile
+    def recalibrate(self, profile):
+        rows = self.connection.execute("SELECT path, header, do, bar_width_unit, color FROM files JOIN settings ON settings.id = files.settings "
+                                       "WHERE edited = 0").fetchall()
+        self.connection.executemany("UPDATE files SET settings = ? WHERE path = ?",
+                                    ((self.settings_id(self.calibrated_settings(profile, self.prefix + path, pixels_per_um, do, bar_width_unit, color)), path)
+                                     for path, pixels_per_um, do, bar_width_unit, color in rows))
     
+    # Yields lists of (filename, do, zoom, pixel per unit, bar width, unit, color) for all files, sorted by path
+    def iter_records(self, size = 10000):
+        with self.lock:
+            # One string per column is much quicker than a row object per file
+            paths, ids = self.connection.execute("SELECT group_concat(path, char(0)), group_concat(settings) FROM "
+                                                 "(SELECT path, settings FROM files ORDER BY path)").fetchone()
+            settings = dict((row[0], row[1:]) for row in self.connection.execute("SELECT id, " + self.Settings_Columns + " FROM settings"))
+        if paths is None:
+            return
+        paths = paths.split("\0")
+        ids = ids.split(",")
+        for start in range(0, len(paths), size):
+            filenames = zip(map(self.prefix.__add__, paths[start:start + size]))
+            yield list(map(tuple.__add__, filenames, map(settings.__getitem__, map(int, ids[start:start + size]))))
+    
+    # Write the settings of files, given like iter_records. edited marks them as chosen by the user, so they are kept
+    # when the calibration profile changes
+    def save(self, records, edited = True):
+        with self.lock, self.connection:
+            self.settings_ids.clear()
+            rows = [(self.settings_id(record[1:]), 1 if edited else 0, self.relative(record[0])) for record in records]
+            self.connection.executemany("UPDATE files SET settings = ?, edited = MAX(edited, ?) WHERE path = ?", rows)
+
+
+# Dictionary-like view of one file of a FileList, for code written for the old list of dictionaries
+class FileRecord:
+    __slots__ = ("file_list", "row")
+    
+    def __init__(self, file_list, row):
+        self.file_list = file_list
+        self.row = row
+        
+    def __getitem__(self, field):
+        return self.file_list.get(self.row, field)
+        
+    def __setitem__(self, field, value):
+        self.file_list.set_column(field, value, [self.row])
+        
+    def keys(self):
+        return ["filename"] + list(FileList.Columns)
+        
+    def __repr__(self):
+        return repr(self.file_list.get_file(self.row))
+
+# All files of a FileList as FileRecord views
+class FileRecords:
+    __slots__ = ("file_list",)
+    
+    def __init__(self, file_list):
+        self.file_list = file_list
+        
+    def __len__(self):
+        return len(self.file_list)
+        
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [FileRecord(self.file_list, index) for index in range(len(self.file_list))[row]]
+        if row < 0:
+            row = row + len(self.file_list)
+        if not 0 <= row < len(self.file_list):
+            raise IndexError("file index out of range")
+        return FileRecord(self.file_list, row)
+        
+    def __repr__(self):
+        return repr([self.file_list.get_file(row) for row in range(len(self.file_list))])
+
+
+# The files of a folder and their settings. Each setting is kept in its own column (compact arrays and lists of
+# interned strings) instead of one dictionary per file, so long lists take little memory and bulk edits are quick.
 class FileList:
+    # Settings columns, after the filename
+    Columns = ("do", "zoom", "pixel_per_unit", "bar_width_unit", "unit", "color")
+    # Settings that are copied from one file to others
+    Settings = ("zoom", "pixel_per_unit", "bar_width_unit", "unit", "color")
+    
     def __init__(self):
-        self.files = []
+        self.clear()
         self.cwd = os.getcwd()
         self.output_dir = os.getcwd()
         self.subdirectories = False
         self.lowercase = False
+        self.region_only = False
+        self.pyramid = False
+        self.archive = None
+        self.shard_size = None
+        self.force = False
+        self.encoder = "default"
+        self.output_format = None
+        self.skipped = 0
+        self.profile = CalibrationProfile.find()
+        
+    def clear(self):
+        # Catalog the settings are saved to, see load_catalog
+        self.catalog = None
+        self.filenames = []
+        self.do = bytearray()
+        self.zoom = []
+        self.pixel_per_unit = array("d")
+        self.bar_width_unit = array("d")
+        self.unit = []
+        self.color = []
+        
+    def __len__(self):
+        return len(self.filenames)
+        
+    # Old-style access to the files: file_list.files[row]["zoom"]
+    @property
+    def files(self):
+        return FileRecords(self)
+        
+    # Import a file. pixel_per_unit is the calibration read from its header, if any
+    def new_file(self,filename, pixel_per_unit = None):
+        # Without a calibration in the header, check if the filename can give a hint as to what the zoom level is
+        zoom, pixel_per_unit = self.profile.calibration(filename, pixel_per_unit)
+        self.filenames.append(filename)
+        self.do.append(1)
+        self.zoom.append(sys.intern(zoom))
+        self.pixel_per_unit.append(pixel_per_unit)
+        self.bar_width_unit.append(50)
+        self.unit.append(sys.intern(self.profile.unit))
+        self.color.append(sys.intern("white"))
+        
+    # Add files with all their settings, as (filename, do, zoom, pixel per unit, bar width, unit, color) records
+    def extend_records(self, records):
+        if not records:
+            return
+        filenames, do, zoom, pixel_per_unit, bar_width_unit, unit, color = zip(*records)
+        self.filenames.extend(filenames)
+        self.do.extend(map(bool, do))
+        self.zoom.extend(map(sys.intern, zoom))
+        self.pixel_per_unit.extend(pixel_per_unit)
+        self.bar_width_unit.extend(bar_width_unit)
+        self.unit.extend(map(sys.intern, unit))
+        self.color.extend(map(sys.intern, color))
         
-    # Import a file
-    def new_file(self,filename):
-        newfile = {}
-        newfile["filename"] = filename
-        
-        # Check if the filename can give a hint as to what the zoom level is
-        if "100x" in filename or "x100" in filename:
-            newfile["zoom"] = "100x"
-            newfile["pixel_per_unit"] = ZOOM_100X
-        elif "50x" in filename or "x50" in filename:
-            newfile["zoom"] = "50x"
-            newfile["pixel_per_unit"] = ZOOM_50X
-        else: # Default case is equal to the 10x case
-            newfile["zoom"] = "10x"
-            newfile["pixel_per_unit"] = ZOOM_10X
+    # Settings of some files (all if rows is None) as records, like extend_records takes them
+    def records(self, rows = None):
+        if rows is None:
+            rows = range(len(self))
+        return [(self.filenames[row], self.do[row], self.zoom[row], self.pixel_per_unit[row], self.bar_width_unit[row],
+                 self.unit[row], self.color[row]) for row in rows]
+    
+    # Value of one setting of one file
+    def get(self, row, field):
+        if field == "filename":
+            return self.filenames[row]
+        if field == "do":
+            return bool(self.do[row])
+        return getattr(self, field)[row]
+    
+    # All settings of one file, as a dictionary
+    def get_file(self, row):
+        file = {"filename": self.filenames[row]}
+        for field in self.Columns:
+            file[field] = self.get(row, field)
+        return file
+        
+    # Set one setting for some rows: a list of rows, a mask (bytes or bytearray with a non-zero byte for every row
+    # to set, e.g. from match()) or all rows if rows is None
+    def set_column(self, field, value, rows = None):
+        if field not in self.Columns:
+            raise KeyError(field)
+        column = getattr(self, field)
+        if field == "do":
+            value = 1 if value else 0
+        elif field in ("pixel_per_unit", "bar_width_unit"):
+            value = float(value)
+        else:
+            value = sys.intern(str(value))
             
-        newfile["bar_width_unit"] = 50
-        newfile["do"] = True
-        newfile["unit"] = "um"
-        newfile["color"] = "white"
+        if rows is None:
+            # One slice assignment for the whole column
+            if isinstance(column, list):
+                column[:] = [value] * len(column)
+            elif isinstance(column, bytearray):
+                column[:] = bytes((value,)) * len(column)
+            else:
+                column[:] = array(column.typecode, (value,)) * len(column)
+        elif isinstance(rows, (bytes, bytearray)):
+            if len(rows) != len(column):
+                raise ValueError("mask of " + str(len(rows)) + " rows for " + str(len(column)) + " files")
+            # One slice assignment for every run of selected rows
+            for run in re.finditer(b"[^\x00]+", rows):
+                start, end = run.span()
+                if isinstance(column, list):
+                    column[start:end] = [value] * (end - start)
+                elif isinstance(column, bytearray):
+                    column[start:end] = bytes((value,)) * (end - start)
+                else:
+                    column[start:end] = array(column.typecode, (value,)) * (end - start)
+        else:
+            for row in rows:
+                column[row] = value
+    
+    # Change the settings of some files (all if rows is None). A known zoom level also sets the pixel per unit, unless one is given
+    def set_settings_where(self, rows = None, zoom = None, pixel_per_unit = None, bar_width_unit = None, unit = None, color = None, do = None):
+        if rows is not None and not isinstance(rows, (bytes, bytearray)):
+            rows = list(rows)
+        if zoom is not None:
+            self.set_column("zoom", zoom, rows)
+            if zoom in self.profile.objectives and pixel_per_unit is None:
+                self.set_column("pixel_per_unit", self.profile.objectives[zoom], rows)
+        if pixel_per_unit is not None:
+            self.set_column("pixel_per_unit", pixel_per_unit, rows)
+            if zoom is None:
+                self.set_column("zoom", "Custom", rows)
+        if bar_width_unit is not None:
+            self.set_column("bar_width_unit", bar_width_unit, rows)
+        if unit is not None:
+            self.set_column("unit", unit, rows)
+        if color is not None:
+            self.set_column("color", color, rows)
+        if do is not None:
+            self.set_column("do", do, rows)
+    
+    # Change the settings of a file
+    def set_settings(self, index, zoom = None, pixel_per_unit = None, bar_width_unit = None, unit = None, color = None, do = None):
+        self.set_settings_where([index], zoom, pixel_per_unit, bar_width_unit, unit, color, do)
         
-        self.files.append(newfile)
+    # Give some files (all if rows is None) the settings of one file
+    def copy_settings(self, source_row, rows = None):
+        for field in self.Settings:
+            self.set_column(field, getattr(self, field)[source_row], rows)
+    
+    # Mask of the files whose name contains pattern, for set_column. With rows, only these files can match
+    def match(self, pattern, rows = None):
+        if rows is None:
+            return bytearray(pattern in os.path.basename(filename) for filename in self.filenames)
+        mask = bytearray(len(self.filenames))
+        for row in rows:
+            mask[row] = pattern in os.path.basename(self.filenames[row])
+        return mask
+    
+    # Rows of the files that will be processed
+    def selected_rows(self):
+        return list(compress(range(len(self.filenames)), self.do))
     
     
     def get_all_images_in_folder(self,folder_path = None, run_subdirectories = None):
-        self.files = []
+        for filename in self.iter_images_in_folder(folder_path, run_subdirectories):
+            pass
+        return self.files
+    
+    # Same as get_all_images_in_folder, but yields each file as soon as it was added
+    def iter_images_in_folder(self, folder_path = None, run_subdirectories = None):
+        self.clear()
         if folder_path is None:
             folder_path = self.cwd
         if run_subdirectories is None:
             run_subdirectories = self.subdirectories
             
-        for r,d,f in os.walk(folder_path):
-            for file in f:
-                if '.tiff' in file or '.tif' in file or '.png' in file or '.jpg' in file or '.jpeg' in file:
-                    self.new_file(os.path.join(r,file))
-            
-            if not run_subdirectories:
-                break # Do not run in subdirectories
-            
-            # Else, run subdirectories
+        filenames = (entry.path for entry in scan_images(folder_path, run_subdirectories))
+        for filename, pixel_per_unit in calibrate_files(filenames, self.profile):
+            self.new_file(filename, pixel_per_unit)
+            yield filename
+    
+    # Load the files of cwd from its catalog instead of scanning the whole folder: only the folders that changed since
+    # the last time are listed. Settings changed afterwards can be kept in the catalog with save_settings
+    def load_catalog(self, catalog = None, stop = None):
+        if catalog is None:
+            catalog = Catalog.for_folder(self.cwd)
+        catalog.reconcile(self.profile, self.subdirectories, stop = stop)
+        self.clear()
+        for records in catalog.iter_records():
+            self.extend_records(records)
+        self.catalog = catalog
         
-        return self.files
+    # Save the settings of some files (all if rows is None) in the catalog, if the list came from one.
+    # edited tells that the user chose these settings, so they are kept even if the calibration profile changes
+    def save_settings(self, rows = None, edited = True):
+        if self.catalog is not None:
+            self.catalog.save(self.records(rows), edited)
+    
+    # Use the calibration in the headers of some files (all if rows is None), for files that were added with new_file
+    def calibrate(self, rows = None, workers = 8):
+        if rows is None:
+            rows = range(len(self))
+        rows = list(rows)
+        calibrations = calibrate_files([self.filenames[row] for row in rows], self.profile, workers)
+        for row, (filename, pixel_per_unit) in zip(rows, calibrations):
+            if pixel_per_unit is not None:
+                self.set_settings(row, zoom = self.profile.zoom_for(pixel_per_unit), pixel_per_unit = pixel_per_unit)
+    
+    # Arguments for process_image of every selected file, as (index, kwargs) pairs. rows limits it to some files
+    def get_jobs(self, rows = None):
+        if rows is None:
+            rows = self.selected_rows()
+        # Encoder settings are only added when they are not the defaults, so the build cache of older versions stays valid
+        output_settings = {}
+        if self.encoder != "default":
+            output_settings["encoder"] = self.encoder
+        if self.output_format or self.pyramid:
+            output_settings["output_format"] = job_output_format(self.output_format, self.pyramid)
+        if self.pyramid:
+            output_settings["pyramid"] = True
+        if self.archive:
+            output_settings["archive"] = self.archive
+            if self.shard_size:
+                output_settings["shard_size"] = self.shard_size
+        for index in rows:
+            if self.do[index]:
+                yield index, dict(filename = self.filenames[index], input_dir = self.cwd, output_dir = self.output_dir,
+                    pixel_per_unit = self.pixel_per_unit[index], bar_width_unit = self.bar_width_unit[index], unit = self.unit[index],
+                    color = self.color[index], lowercase = self.lowercase, region_only = self.region_only, **output_settings)
+    
+    # Cache of what was already processed in the output folder, or None if everything must be processed again.
+    # Archives are written again completely, so they have no cache
+    def get_build_cache(self):
+        if self.force or self.archive:
+            return None
+        return BuildCache.for_output_dir(self.output_dir)
     
-    def process_all_images(self):
+    # Jobs that still need to run, skipping the ones the cache knows are up to date
+    def get_pending_jobs(self, cache = None, rows = None):
+        if cache is None:
+            return self.get_jobs(rows)
+        return cache.filter_jobs(self.get_jobs(rows))
+    
+    # Process all selected files. Without an engine the files are processed one at a time in this process.
+    # Files that are up to date are skipped, unless force is set; self.skipped has how many were skipped
+    def process_all_images(self, engine = None, on_result = None, rows = None):
+        if engine is None:
+            engine = BatchEngine(workers = 1)
+        cache = self.get_build_cache()
+        jobs = dict(self.get_pending_jobs(cache, rows))
         number_files = 0
-        for file in self.files:
-            if file["do"]:
-                number_files = number_files + process_image(file["filename"], self.cwd, self.output_dir, pixel_per_unit = file["pixel_per_unit"],
-                bar_width_unit = file["bar_width_unit"], unit=file["unit"], color = file["color"], lowercase = self.lowercase)
+        try:
+            for result in engine.run(jobs.items()):
+                if result.error is not None:
+                    print("Could not process " + result.filename + ": " + result.error, file = sys.stderr)
+                elif cache is not None:
+                    cache.record(jobs[result.index])
+                number_files = number_files + result.count
+                if on_result is not None:
+                    on_result(result)
+        finally:
+            self.skipped = cache.skipped if cache is not None else 0
+            if cache is not None:
+                cache.save()
         return number_files
     
     def set_cwd(self, path):
@@ -171,364 +3259,724 @@ class FileList:
         return self.subdirectories
     def set_lowercase(self, value):
         self.lowercase = value
+    def set_region_only(self, value):
+        self.region_only = value
+    def set_pyramid(self, value):
+        self.pyramid = value
+    # Write the outputs into an archive (.zip or .tar) instead of the output folder, or not if path is None.
+    # shard_size in bytes splits it into several archives
+    def set_archive(self, path, shard_size = None):
+        if path:
+            archive_format(path)
+        self.archive = path
+        self.shard_size = shard_size
+    def set_force(self, value):
+        self.force = value
+    def set_profile(self, profile):
+        self.profile = profile
+    def set_encoder(self, encoder):
+        if encoder not in Encoder_Profiles:
+            raise ValueError("Unknown encoder profile " + repr(encoder) + " (use " + ", ".join(Encoder_Profiles) + ")")
+        self.encoder = encoder
+    # Extension of the format to save into, e.g. "png", or None to keep the format of each input file
+    def set_output_format(self, output_format):
+        self.output_format = normalize_output_format(output_format)
 
-# Visual frames for file selection. Contain file location info
-class FileSelector(QWidget):
-    def __init__(self,parent, fileList, is_output = False, other_selector = None):
-        super().__init__()
-        self.parent = parent
-        self.is_output = is_output
-        self.fileList = fileList
-        self.other_selector = other_selector
-        if is_output:
-            self.labeltext = "Output folder: "
-        else:
-            self.labeltext = "Input folder: "
-            
-        self.fileText = os.getcwd()
-
-        layout = QGridLayout(self)
-        self.label = QLabel(self.labeltext)
-        layout.addWidget(self.label,0,0)
-        self.textBox = QLineEdit(self.fileText)
-        layout.addWidget(self.textBox,0,1)
-        self.button = QPushButton("Browse...",self)
-        self.button.clicked.connect(self.on_click)
-        layout.addWidget(self.button,0,2)
-        if not is_output:
-            self.run_subdirectories = QCheckBox("Also edit files in subfolders", self)
-            self.run_subdirectories.clicked.connect(self.on_checkbox_click)
-            layout.addWidget(self.run_subdirectories,1,1)
-        else:
-            self.isLowercase = QCheckBox("Turn all files into lowercase", self)
-            self.isLowercase.clicked.connect(self.on_checkbox_click)
-            layout.addWidget(self.isLowercase,1,1)
 
-        
-        
-    def on_click(self):
-        self.fileText = str(QFileDialog.getExistingDirectory(self, "Select folder",fileList.get_cwd()))
-        self.textBox.setText(self.fileText)
-        if not self.is_output:
-            self.fileList.set_cwd(self.fileText)
-            self.parent.refresh_file_list()
-            self.other_selector.fileText = self.fileText
-            self.other_selector.textBox.setText(self.fileText)
-        else:
-            self.fileList.set_output_dir(self.fileText)
+# Command line mode, for scripts and machines without a screen.
+# Settings that can be given per filename pattern, and the set_settings argument they change
+Pattern_Settings = {"zoom": "zoom", "ppu": "pixel_per_unit", "pixel_per_unit": "pixel_per_unit", "bar": "bar_width_unit",
+                    "bar_width_unit": "bar_width_unit", "unit": "unit", "color": "color"}
+
+# Read "PATTERN:key=value,key=value" into (pattern, settings)
+def parse_pattern(text):
+    pattern, separator, values = text.rpartition(":")
+    if not separator:
+        raise argparse.ArgumentTypeError("expected PATTERN:key=value[,key=value...], got " + repr(text))
+    settings = {}
+    for item in values.split(","):
+        key, separator, value = item.partition("=")
+        key = key.strip().lower()
+        if not separator or key not in Pattern_Settings:
+            raise argparse.ArgumentTypeError("unknown setting " + repr(item) + " (use " + ", ".join(sorted(Pattern_Settings)) + ")")
+        settings[Pattern_Settings[key]] = value.strip()
+    return pattern, settings
+
+# Filenames listed in a manifest file, or in stdin if the name is "-". Empty lines and lines starting with # are ignored
+def read_manifest(manifest, input_dir):
+    if manifest == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(manifest, encoding = "utf-8") as file:
+            lines = file.read().splitlines()
+    filenames = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            filenames.append(os.path.join(input_dir, line))
+    return filenames
+
+def parse_arguments(argv = None):
+    parser = argparse.ArgumentParser(prog = "AutoScale.py", description = "Add scale bars to a batch of images without opening the window. "
+                                     "Without any arguments, the window is opened instead.")
+    parser.add_argument("files", nargs = "*", help = "images to process. If no files or manifest are given, the input folder is scanned")
+    parser.add_argument("-i", "--input", default = os.getcwd(), help = "input folder (default: current folder)")
+    parser.add_argument("-o", "--output", help = "output folder (default: same as the input folder)")
+    parser.add_argument("-r", "--recursive", action = "store_true", help = "also process images in subfolders")
+    parser.add_argument("-m", "--manifest", help = "file with one image per line, relative to the input folder. Use - to read stdin")
+    parser.add_argument("--zoom", help = "zoom of all images, instead of reading it from the header or guessing from the filename "
+                        "(" + ", ".join(Zoom_Levels) + " or an objective of the calibration profile)")
+    parser.add_argument("--pixel-per-unit", type = float, help = "pixels per unit of all images")
+    parser.add_argument("--bar", type = float, help = "bar size in units (default: 50)")
+    parser.add_argument("--unit", help = "unit name (default: um)")
+    parser.add_argument("--color", help = "scale color (default: white)")
+    parser.add_argument("-p", "--pattern", type = parse_pattern, action = "append", default = [], metavar = "PATTERN:KEY=VALUE,...",
+                        help = "settings for images whose name contains PATTERN, e.g. 100x:bar=20,color=black. "
+                        "Keys: zoom, ppu, bar, unit, color. Can be repeated; later patterns win")
+    parser.add_argument("--calibration", help = "calibration profile (JSON) with the objectives and the filename patterns "
+                        "(default: " + Calibration_Filename + " next to AutoScale.py if it exists, otherwise the built-in values)")
+    parser.add_argument("--no-headers", action = "store_true", help = "do not read the pixel per unit from the image headers, only guess from the filenames")
+    parser.add_argument("--encoder", choices = list(Encoder_Profiles), default = "default",
+                        help = "how output files are encoded: fast (quickest, bigger files), compact, archive (best quality, slowest), "
+                        "match-source (same JPEG tables or TIFF compression as the input). All but default keep EXIF, ICC profile and resolution")
+    parser.add_argument("--output-format", help = "save every image in this format instead of the format of the input, e.g. png, jpg or tif")
+    parser.add_argument("--catalog", action = "store_true", help = "use the catalog of the input folder instead of scanning it: only new and removed files "
+                        "are looked at, and the settings edited in the window are used")
+    parser.add_argument("--lowercase", action = "store_true", help = "turn output filenames into lowercase")
+    parser.add_argument("--region-only", action = "store_true", help = "for TIFF and JPEG files, only re-encode the part of the file under the scale")
+    parser.add_argument("--pyramid", action = "store_true", help = "write tiled pyramid TIFF files with a scale on every level, for very large images")
+    parser.add_argument("--archive", help = "write the output images into this uncompressed .zip or .tar file instead of separate files")
+    parser.add_argument("--shard-size", type = float, help = "split the archive into archives of about this size in MB, written at the same time")
+    parser.add_argument("-f", "--force", action = "store_true", help = "process every image again, even the ones that are up to date")
+    parser.add_argument("-w", "--watch", action = "store_true", help = "after the batch, keep watching the input folder and process new images as they arrive")
+    parser.add_argument("--interval", type = float, default = 2.0, help = "seconds between two checks of the folder in watch mode (default: 2)")
+    parser.add_argument("--pipeline", action = "store_true", help = "process in one process with overlapping read, draw and write stages "
+                        "(best for slow network storage)")
+    parser.add_argument("--queue-depth", type = int, default = 8, help = "images waiting between two pipeline stages (default: 8)")
+    parser.add_argument("--memory-limit", type = float, default = 1024, help = "memory in MB for images waiting in the pipeline (default: 1024)")
+    parser.add_argument("-j", "--workers", type = int, default = None, help = "number of worker processes (default: one per CPU), "
+                        "or of reader and writer threads with --pipeline (default: 4)")
+    parser.add_argument("--daemon", action = "store_true", help = "keep running with warm workers and process the batches sent with --submit. "
+                        "-j sets the number of workers")
+    parser.add_argument("--submit", action = "store_true", help = "send the batch to a running daemon instead of processing it here "
+                        "(processed here if there is no daemon)")
+    parser.add_argument("--socket", help = "Unix socket of the daemon (default: " + default_socket_path() + ")")
+    parser.add_argument("--summary", help = "write a JSON summary to this file. Use - for stdout")
+    parser.add_argument("--metrics", help = "append the timings, sizes and outcome of every file to this file, as JSON lines")
+    parser.add_argument("--prometheus", help = "write totals and stage time histograms to this file in the Prometheus text format, "
+                        "e.g. for the textfile collector of node_exporter. In watch mode it is updated after every batch")
+    return parser.parse_args(argv)
+
+# Build the file list of a command line run
+def build_file_list(arguments):
+    file_list = FileList()
+    file_list.set_cwd(os.path.abspath(arguments.input))
+    file_list.set_output_dir(os.path.abspath(arguments.output) if arguments.output else file_list.get_cwd())
+    file_list.set_subdirectories(arguments.recursive)
+    file_list.set_lowercase(arguments.lowercase)
+    file_list.set_region_only(arguments.region_only)
+    file_list.set_pyramid(arguments.pyramid)
+    if arguments.archive:
+        file_list.set_archive(os.path.abspath(arguments.archive), int(arguments.shard_size * (1 << 20)) if arguments.shard_size else None)
+    file_list.set_force(arguments.force)
+    file_list.set_encoder(arguments.encoder)
+    file_list.set_output_format(arguments.output_format)
+    if arguments.calibration:
+        file_list.set_profile(CalibrationProfile.load(arguments.calibration))
+    if arguments.no_headers:
+        file_list.profile.use_headers = False
+    check_zoom(file_list.profile, arguments.zoom)
+    for pattern, settings in arguments.pattern:
+        check_zoom(file_list.profile, settings.get("zoom"))
     
-    def on_checkbox_click(self):
-        if not self.is_output:
-            self.fileList.set_subdirectories(self.run_subdirectories.isChecked())
-            self.parent.refresh_file_list()
-        else:
-            self.fileList.set_lowercase(self.isLowercase.isChecked())
-        
-    def set_other_selector(self,other_selector):
-        self.other_selector = other_selector
-    
-    def get_file_path(self):
-        self.fileText = self.textBox.text()
-        return self.fileText
-        
-    
-# Control buttons
-class ControlsPane(QWidget):
-    def __init__(self, parent, file_list_reference):
-        super().__init__()
-        self.parent = parent
-        self.file_list_reference = file_list_reference
-        layout = QVBoxLayout(self)
-        self.refresh_button = QPushButton("Refresh",self)
-        self.refresh_button.clicked.connect(self.refresh)
-        layout.addWidget(self.refresh_button)
-        
-        self.add_button = QPushButton("Add Scales", self)
-        self.add_button.clicked.connect(self.do)
-        layout.addWidget(self.add_button)
-        
-    # Get all files
-    def refresh(self):
-        self.parent.refresh_file_list()
-
-    # Apply transformation
-    def do(self):
-        self.file_list_reference.set_cwd(self.input_selector.get_file_path())
-        self.file_list_reference.set_output_dir(self.output_selector.get_file_path())
-        number_of_files = self.file_list_reference.process_all_images()
-        dialog = QMessageBox()
-        dialog.setIcon(QMessageBox.Information)
-        if number_of_files == 1:
-            dialog.setText("1 image processed.")
-        else:
-            dialog.setText(str(number_of_files) + " images processed.")
-            
-        dialog.setWindowTitle("Complete")
-        dialog.setStandardButtons(QMessageBox.Ok)
-        dialog.exec()
-        
-
-class ImageListTable(QWidget):
-    def __init__(self, parent, file_list_reference):
-        super().__init__()
-        self.parent = parent
-        self.fileList = file_list_reference
-        
-        layout = QGridLayout(self)
-        self.table = QTableWidget()
-        self.rows = -1
-        self.table.setRowCount(0)
-        self.table.setColumnCount(7)
-        
-        self.table.setHorizontalHeaderLabels(["do","File","Zoom","Pixel per unit", "Bar size (Unit)", "Unit"])
-        
-        layout.addWidget(self.table,0,0,3,4)
-        
-        # Buttons for selection
-        self.selectAll = QPushButton("Select All")
-        self.selectAll.clicked.connect(self.select_all)
-        layout.addWidget(self.selectAll,3,2)
-        
-        self.selectNone = QPushButton("Select None")
-        self.selectNone.clicked.connect(self.select_none)
-        layout.addWidget(self.selectNone,3,3)
-        
-        self.copySettings = QPushButton("Copy settings to other files")
-        self.copySettings.clicked.connect(self.copy_settings)
-        layout.addWidget(self.copySettings,3,1)
-        
-        self.table.resizeColumnsToContents()
-        
-    def add_file(self,file):
-        self.rows = self.rows + 1
-        currentRow = self.rows
-        self.table.setRowCount(self.rows + 1)
-        
-        image_name = file["filename"].split('\\')[-1]
-        
-        checkbox = QTableWidgetItem(True)
-        checkbox.setFlags((checkbox.flags() | Qt.ItemIsUserCheckable) & ~(Qt.ItemIsEditable))
-        checkbox.setCheckState(Qt.Checked if file["do"] else Qt.Unchecked)
-        self.table.setItem(self.rows,0, checkbox)
-        imagenameitem = QTableWidgetItem(image_name)
-        imagenameitem.setFlags(imagenameitem.flags() & ~(Qt.ItemIsEditable))
-        self.table.setItem(self.rows,1, imagenameitem)
-        zoom_options = ['10x','50x','100x','Custom']
-        
-        zoomitem = QComboBox()
-        zoomitem.addItems(zoom_options)
-        if file["zoom"] == '10x':
-            zoomitem.setCurrentIndex(0)
-        elif file["zoom"] == '50x':
-            zoomitem.setCurrentIndex(1)
-        elif file["zoom"] == '100x':
-            zoomitem.setCurrentIndex(2)
-        
-
-        # Connect signal to check when the zoom is changed, as it requires a different method call.
-        # We need to explicitly specify which file it is and that it is the zoom that is being changed.
-        # That is why we use the lambda expression.
-        zoomitem.currentIndexChanged.connect(lambda: self.update_file_of_selected_row(currentRow,2))
-
-        self.table.setCellWidget(self.rows,2, zoomitem)
-        self.table.setItem(self.rows,3, QTableWidgetItem(str(file["pixel_per_unit"])))
-        self.remove_flag(self.rows,3,Qt.ItemIsEditable)
-        self.table.setItem(self.rows,4, QTableWidgetItem(str(file["bar_width_unit"])))
-        self.table.setItem(self.rows,5, QTableWidgetItem(str(file["unit"])))
-        self.table.setItem(self.rows,6, QTableWidgetItem(str(file["color"])))
-        
-        # Connect signal to check when table was changed
-        self.table.cellChanged.connect(self.update_file_of_selected_row)
-                
-    def add_all_files(self):
-        self.clear_table()
-        for file in self.fileList.files:
-            self.add_file(file)
-        
-        self.table.resizeColumnsToContents()
-        
-    def clear_table(self):
-        self.table.clear()
-        self.table.setHorizontalHeaderLabels(["do","File","Zoom","Pixel per unit", "Bar size (Unit)", "Unit","Color"])
-        self.rows = -1
-        self.table.setRowCount(0)
-        
-    def get_value(self, row, col):
-        item = self.table.item(row,col).text()
-        
-        return item
-        
-    def is_selected(self,row,col):
-        item = self.table.item(row,col).checkState()
-        return item == Qt.Checked
-    
-    def set_selected(self,row,col,state):
-        widget = self.table.item(row,col)
-        widget.setCheckState(Qt.Checked if state else ~(Qt.Checked))
-    
-    def get_selection(self, row, col):
-        widget = self.table.cellWidget(row,col)
-        return str(widget.currentText())
-    
-    def set_selection_by_text(self,row,col,text):
-        widget = self.table.cellWidget(row,col)
-        if text == "10x":
-            widget.setCurrentIndex(0)
-        elif text == "50x":
-            widget.setCurrentIndex(1)
-        elif text == "100x":
-            widget.setCurrentIndex(2)
-        else:
-            widget.setCurrentIndex(3)
-        
-    def remove_flag(self,row,col,flag):
-        widget = self.table.item(row,col)
-        widget.setFlags(widget.flags() & ~flag)
-    
-    def add_flag(self,row,col,flag):
-        widget = self.table.item(row,col)
-        widget.setFlags(widget.flags() | flag)
-        
-    def change_text(self,row,col,text):
-        widget = self.table.item(row,col)
-        widget.setText(str(text))
-        
-    # Set all files to "do"
-    def select_all(self):
-        for row in range(0, self.rows+1):
-            self.set_selected(row,0,True)
-            self.fileList.files[row]["do"] = True
-    
-    # Set all files to "don't do"
-    def select_none(self):
-        for row in range(0, self.rows+1):
-            self.set_selected(row,0,False)
-            self.fileList.files[row]["do"] = False
-            
+    filenames = [os.path.abspath(filename) for filename in arguments.files]
+    if arguments.manifest:
+        filenames.extend(read_manifest(arguments.manifest, file_list.get_cwd()))
+    if filenames or arguments.manifest:
+        for filename in filenames:
+            file_list.new_file(filename)
+        file_list.calibrate()
+    elif arguments.catalog:
+        try:
+            file_list.load_catalog()
+        except sqlite3.Error as error:
+            print("Could not use the catalog (" + str(error) + "), scanning the folder.", file = sys.stderr)
+            file_list.get_all_images_in_folder()
+    else:
+        file_list.get_all_images_in_folder()
+    
+    apply_arguments_settings(file_list, None, arguments)
+    return file_list
+
+# Raise ValueError for a zoom (of --zoom, a pattern or a file sent to the daemon) that the calibration profile does not have
+def check_zoom(profile, zoom):
+    if zoom is not None and zoom not in profile.objectives:
+        raise ValueError("Unknown zoom " + zoom + " (use " + ", ".join(profile.objectives) + ")")
+
+# Settings given on the command line, for some files (all if rows is None)
+def apply_arguments_settings(file_list, rows, arguments):
+    file_list.set_settings_where(rows, zoom = arguments.zoom, pixel_per_unit = arguments.pixel_per_unit, bar_width_unit = arguments.bar,
+                                 unit = arguments.unit, color = arguments.color)
+    for pattern, settings in arguments.pattern:
+        file_list.set_settings_where(file_list.match(pattern, rows), **settings)
+
+# Process new images as they appear in the input folder, until Ctrl+C. Returns the number of images processed.
+# after_batch is called after every group of new images
+def watch_folder(file_list, engine, arguments, on_result, after_batch = None):
+    output_dir = os.path.join(file_list.get_output_dir(), "")
+    # Never pick up our own outputs
+    def is_output(filename):
+        return "_with_scale" in filename or (file_list.get_output_dir() != file_list.get_cwd() and filename.startswith(output_dir))
+    
+    watcher = FolderWatcher(file_list.get_cwd(), file_list.get_do_subdirectories(), arguments.interval,
+                            known = file_list.filenames, ignore = is_output)
+    print("Watching " + file_list.get_cwd() + " for new images. Press Ctrl+C to stop.", file = sys.stderr)
+    number_files = 0
+    try:
+        for filenames in watcher.watch():
+            first = len(file_list)
+            for filename in filenames:
+                file_list.new_file(filename)
+            rows = range(first, len(file_list))
+            file_list.calibrate(rows)
+            apply_arguments_settings(file_list, rows, arguments)
+            number_files = number_files + file_list.process_all_images(engine, on_result = on_result, rows = rows)
+            if after_batch is not None:
+                after_batch()
+    except KeyboardInterrupt:
+        watcher.stop()
+    return number_files
+
+# Daemon mode: a long-running process that keeps its worker processes, fonts and scale overlays warm and takes batches
+# from other processes over a Unix domain socket, so a script that sends a few images at a time does not pay for
+# starting Python, importing Pillow and starting the workers on every run. Messages are JSON, one per line:
+#   {"type": "submit", "arguments": {...}, "files": [...]}: "arguments" are the command line options (see submit_arguments),
+#       "files" optional per-file settings like {"filename": ..., "zoom": "50x", "bar": 20}. The daemon answers
+#       {"type": "accepted", ...}, then {"type": "result", ...} for every file as soon as it is done, then {"type": "done", ...},
+#       or {"type": "error", "message": ...} if the batch could not be built.
+#   {"type": "status"} and {"type": "shutdown"}. On shutdown the running files are finished, and the files still
+#       waiting get a "result" with an error, so every batch still ends with "done".
+# Batches of several clients run at the same time: files are handed to the workers from each batch in turn.
+
+# Socket used when none is given: in the runtime folder of the user, which only they can use
+def default_socket_path():
+    folder = os.environ.get("XDG_RUNTIME_DIR")
+    if folder and os.path.isdir(folder):
+        return os.path.join(folder, "autoscale.sock")
+    user = str(os.getuid()) if hasattr(os, "getuid") else os.environ.get("USERNAME", "user")
+    return os.path.join(tempfile.gettempdir(), "autoscale-" + user + ".sock")
+
+# Settings that can be given per file in a submitted batch, and the set_settings argument they change
+Daemon_File_Settings = dict(Pattern_Settings, do = "do")
+
+# Error of the files that were still waiting when the daemon was stopped
+Daemon_Stopped = "the daemon was stopped before this file was processed"
+
+# Seconds the daemon waits, when it stops, for its clients to get their last results
+Daemon_Shutdown_Timeout = 10
+
+# Loads what the first batch would otherwise wait for. Runs once in every worker process of the daemon
+def warm_worker():
+    Image.init()
+    font_path = find_font()
+    for size in range(8, 65, 8):
+        load_font(font_path, size)
+    return os.getpid()
+
+# Jobs of several batches, handed out one batch after the other (round robin), so a big batch cannot hold up small ones
+class FairQueue:
+    def __init__(self):
+        self.lanes = OrderedDict()
+        self.condition = threading.Condition()
+        self.closed = False
         
-    # Change settings to they are similar between files
-    def copy_settings(self):
-        # Get selected row
-        selected_row = self.table.currentRow()
-        
-        # Save parameters
-        zoom = self.fileList.files[selected_row]["zoom"]
-        pixel_per_unit = self.fileList.files[selected_row]["pixel_per_unit"]
-        bar_width_unit = self.fileList.files[selected_row]["bar_width_unit"]
-        unit = self.fileList.files[selected_row]["unit"]
-        color = self.fileList.files[selected_row]["color"]
-
-        # Put parameters in other files and change values in table
-        for row in range(0,self.rows+1):
-            self.fileList.files[row]["zoom"] = zoom
-            self.fileList.files[selected_row]["pixel_per_unit"] = pixel_per_unit
-            self.fileList.files[selected_row]["bar_width_unit"] = bar_width_unit
-            self.fileList.files[selected_row]["unit"] = unit
-            self.fileList.files[selected_row]["color"] = color
+    # Returns False, and queues nothing, once the queue is closed
+    def put_many(self, key, items):
+        items = list(items)
+        with self.condition:
+            if self.closed:
+                return False
+            if items:
+                self.lanes.setdefault(key, deque()).extend(items)
+                self.condition.notify_all()
+            return True
             
-            self.change_text(row,3,str(pixel_per_unit))
-            self.change_text(row,4,str(bar_width_unit))
-            self.change_text(row,5,str(unit))
-            self.set_selection_by_text(row,2,str(zoom))
-            self.change_text(row,6,str(color))
-
-    # Update file information when an item is changed
-    def update_file_of_selected_row(self, row, col):
-        selectedFile = self.fileList.files[row]
-        if col == 0:
-            # do or do not
-            self.fileList.files[row]["do"] = self.is_selected(row,col)
+    # Next item, or None if there was none within timeout seconds
+    def get(self, timeout = None):
+        with self.condition:
+            if not self.lanes:
+                self.condition.wait(timeout)
+            if not self.lanes:
+                return None
+            key, lane = self.lanes.popitem(last = False)
+            item = lane.popleft()
+            # The batch goes to the back of the line
+            if lane:
+                self.lanes[key] = lane
+            return item
+    
+    # Drop the waiting items of a batch. Returns how many there were
+    def remove(self, key):
+        with self.condition:
+            return len(self.lanes.pop(key, ()))
             
-        elif col == 2:
-            # 1 will never be chosen because it is the file name (non-editable)
-            # 2 is the zoom level
-            text = self.get_selection(row,col)
-            self.fileList.files[row]["zoom"] = text
-            if text == "10x":
-                self.fileList.files[row]["pixel_per_unit"] = ZOOM_10X
-                self.change_text(row,3,ZOOM_10X)
-                self.remove_flag(row,3,(Qt.ItemIsEditable))
-            elif text == "50x":
-                self.fileList.files[row]["pixel_per_unit"] = ZOOM_50X
-                self.change_text(row,3,ZOOM_50X)
-                self.remove_flag(row,3,(Qt.ItemIsEditable))
-            elif text == "100x":
-                self.fileList.files[row]["pixel_per_unit"] = ZOOM_100X
-                self.change_text(row,3,ZOOM_100X)
-                self.remove_flag(row,3,(Qt.ItemIsEditable))
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+    
+    # Take no more items. Returns the items that were still waiting
+    def close(self):
+        with self.condition:
+            self.closed = True
+            items = [item for lane in self.lanes.values() for item in lane]
+            self.lanes.clear()
+            self.condition.notify_all()
+            return items
             
-            else:
-                self.add_flag(row,3,Qt.ItemIsEditable)
+    def __len__(self):
+        with self.condition:
+            return sum(len(lane) for lane in self.lanes.values())
+    
+    def batches(self):
+        with self.condition:
+            return len(self.lanes)
+
+# One batch sent to the daemon. The dispatcher only puts the results in messages, which never blocks; the thread of
+# the connection stores and records them and sends them, so a client that reads slowly only holds up its own batch
+class DaemonBatch:
+    def __init__(self, jobs, cache):
+        self.jobs = jobs
+        self.cache = cache
+        self.remaining = len(jobs)
+        self.processed = 0
+        self.failed = 0
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.messages = queue.Queue()
+        # Results of jobs with an archive come back from it, once their output is written
+        self.archives = ArchiveSinks(self.report)
+        if not jobs:
+            self.messages.put(None)
+    
+    def add_result(self, result):
+        self.messages.put_nowait(result)
+    
+    # Next message to send to the client, or None once the batch is finished
+    def next_message(self):
+        while True:
+            message = self.messages.get()
+            if not isinstance(message, BatchResult):
+                return message
+            self.archives.store(self.jobs[message.index], message)
+    
+    def report(self, result):
+        if result.error is None and self.cache is not None:
+            self.cache.record(self.jobs[result.index])
+        self.messages.put({"type": "result", "index": result.index, "filename": result.filename, "processed": result.count,
+                           "error": result.error, "stats": result.stats})
+        self.finish_job(result)
         
-        elif col == 3:
-            # Pixel per unit
-            self.fileList.files[row]["pixel_per_unit"] = float(self.get_value(row,col))
-            
-        elif col == 4:
-            # Bar width in units (um or something)
-            self.fileList.files[row]["bar_width_unit"] = float(self.get_value(row,col))
-        
-        elif col == 5:
-            # Unit name
-            self.fileList.files[row]["unit"] = str(self.get_value(row,col))
-                    
-        elif col == 6:
-            # Color
-            self.fileList.files[row]["color"] = str(self.get_value(row,col))
+    # Count a job as done. After the last one, None tells the connection that the batch is finished
+    def finish_job(self, result = None):
+        with self.lock:
+            if result is not None:
+                self.processed = self.processed + result.count
+                self.failed = self.failed + (result.error is not None)
+            self.remaining = self.remaining - 1
+            if self.remaining == 0:
+                self.messages.put(None)
+    
+    # Finish the archives of the batch, once every job is done. Returns the error message, or None
+    def close_archives(self):
+        try:
+            self.archives.close()
+        except ArchiveError as error:
+            return "Could not write the archive: " + str(error)
+        return None
+                
+    def cancel(self, dropped):
+        self.cancelled = True
+        for i in range(dropped):
+            self.finish_job()
+
+# Connection to the daemon. serve() mixes it into socketserver.StreamRequestHandler, so socketserver is only loaded by the daemon
+class DaemonRequestHandler:
+    def handle(self):
+        daemon = self.server.job_daemon
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            kind = request.get("type")
+        except (ValueError, AttributeError):
+            self.send({"type": "error", "message": "expected one JSON object per line"})
+            return
+        if kind == "status":
+            self.send(daemon.status())
+        elif kind == "shutdown":
+            self.send({"type": "done"})
+            daemon.stop()
+        elif kind == "submit":
+            daemon.serve_batch(request, self.send)
+        else:
+            self.send({"type": "error", "message": "unknown request type " + repr(kind)})
             
+    def send(self, message):
+        self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+        self.wfile.flush()
 
-class App(QMainWindow):
-    def __init__(self,fileList):
-        super().__init__()
-        self.title = 'Micro Auto Scale'
-        self.setWindowTitle(self.title)
-        self.width = 680
-        self.height = 50
-        self.fileList = fileList
-        self.resize(self.width,self.height)
-        self._main = QWidget()
-        self.setCentralWidget(self._main)
-        
-        layout = QGridLayout(self._main)
+# Keeps a BatchEngine and its worker processes running, and processes the batches sent to a Unix socket
+class JobDaemon:
+    def __init__(self, socket_path = None, workers = None, window = None):
+        self.socket_path = socket_path or default_socket_path()
+        self.engine = BatchEngine(workers, window)
+        self.queue = FairQueue()
+        self.in_flight = {}
+        self.server = None
+        self.stopping = threading.Event()
+        self.build_caches = {}
+        self.build_caches_lock = threading.Lock()
+        # Batches whose connection is still sending results
+        self.batches = set()
+        self.batches_done = threading.Condition()
         
-        # File selection menus
-        self.inFileFrame  = FileSelector(self,fileList,is_output=False)
-        self.outFileFrame = FileSelector(self,fileList,is_output=True,other_selector=self.inFileFrame)
-        self.inFileFrame.set_other_selector(self.outFileFrame)
+    # Build cache of the output folder of a batch. Batches writing to the same folder share it, so saving one batch
+    # never drops what another recorded
+    def get_build_cache(self, file_list):
+        with self.build_caches_lock:
+            cache = file_list.get_build_cache()
+            if cache is None:
+                return None
+            return self.build_caches.setdefault(os.path.abspath(cache.path), cache)
         
-        layout.addWidget(self.inFileFrame,0,0,1,5)
-        layout.addWidget(self.outFileFrame,1,0,1,5)
+    # Serve until stop() is called or Ctrl+C
+    def serve(self):
+        if not hasattr(socket, "AF_UNIX"):
+            raise OSError("daemon mode needs Unix domain sockets, which this system does not have")
+        if os.path.exists(self.socket_path):
+            if daemon_running(self.socket_path):
+                raise OSError("a daemon is already running on " + self.socket_path)
+            # Left over by a daemon that was killed
+            os.unlink(self.socket_path)
         
-        # Controls pane
-        self.controls = ControlsPane(self,fileList)
-        self.controls.input_selector = self.inFileFrame
-        self.controls.output_selector = self.outFileFrame
-        layout.addWidget(self.controls,5,4)
+        executor = self.engine.get_executor()
+        futures.wait([executor.submit(warm_worker) for i in range(self.engine.workers)])
         
-        # Table
-        self.table = ImageListTable(self,fileList)
-        self.table.height = 500
-        layout.addWidget(self.table,3,0,50,4)
-        
-        self.refresh_file_list()
+        old_umask = os.umask(0o177)
+        try:
+            handler = type("DaemonRequestHandler", (DaemonRequestHandler, socketserver.StreamRequestHandler), {})
+            self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, handler)
+        finally:
+            os.umask(old_umask)
+        self.server.daemon_threads = True
+        self.server.job_daemon = self
+        dispatcher = threading.Thread(target = self.dispatch, daemon = True)
+        dispatcher.start()
+        print("AutoScale daemon with " + str(self.engine.workers) + " workers listening on " + self.socket_path, file = sys.stderr)
+        try:
+            self.server.serve_forever(poll_interval = 0.5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopping.set()
+            self.queue.wake()
+            dispatcher.join()
+            with self.batches_done:
+                self.batches_done.wait_for(lambda: not self.batches, Daemon_Shutdown_Timeout)
+            self.server.server_close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            self.engine.shutdown()
+            
+    # Stop serving. Files that are being processed are finished first
+    def stop(self):
+        self.stopping.set()
+        self.queue.wake()
+        if self.server is not None:
+            # shutdown() waits for serve_forever, so it cannot run in a connection thread directly
+            threading.Thread(target = self.server.shutdown, daemon = True).start()
+    
+    def status(self):
+        return {"type": "status", "pid": os.getpid(), "workers": self.engine.workers, "batches": self.queue.batches(),
+                "queued": len(self.queue), "running": len(self.in_flight)}
+    
+    # Build the batch of a submit request, queue it, and send its results until it is finished
+    def serve_batch(self, request, send):
+        try:
+            arguments = vars(parse_arguments([]))
+            arguments.update(request.get("arguments", {}))
+            arguments = argparse.Namespace(**arguments)
+            file_settings = {}
+            for entry in request.get("files", []):
+                if isinstance(entry, str):
+                    entry = {"filename": entry}
+                entry = dict(entry)
+                filename = os.path.abspath(entry.pop("filename"))
+                unknown = set(entry).difference(Daemon_File_Settings)
+                if unknown:
+                    raise ValueError("unknown file settings " + ", ".join(sorted(unknown)))
+                file_settings[filename] = dict((Daemon_File_Settings[key], value) for key, value in entry.items())
+            arguments.files = list(arguments.files) + list(file_settings)
+            if not os.path.isdir(arguments.input):
+                raise ValueError("Input folder " + arguments.input + " does not exist.")
+            file_list = build_file_list(arguments)
+            for settings in file_settings.values():
+                check_zoom(file_list.profile, settings.get("zoom"))
+            for index, filename in enumerate(file_list.filenames):
+                if filename in file_settings:
+                    file_list.set_settings(index, **file_settings[filename])
+            cache = self.get_build_cache(file_list)
+            jobs = dict(file_list.get_jobs())
+            batch = DaemonBatch(dict(cache.filter_jobs(jobs.items())) if cache is not None else jobs, cache)
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            send({"type": "error", "message": str(error)})
+            return
         
-        self.show()
+        # Counted here, the skipped count of the cache is shared with the other batches
+        up_to_date = len(jobs) - len(batch.jobs)
+        with self.batches_done:
+            self.batches.add(batch)
+        finished = False
+        try:
+            send({"type": "accepted", "images": len(batch.jobs), "up_to_date": up_to_date,
+                  "input_dir": file_list.get_cwd(), "output_dir": file_list.get_output_dir()})
+            if not self.queue.put_many(batch, [(batch, index, job) for index, job in batch.jobs.items()]):
+                for index, job in batch.jobs.items():
+                    batch.add_result(BatchResult(index, job["filename"], 0, Daemon_Stopped))
+            while True:
+                message = batch.next_message()
+                if message is None:
+                    break
+                send(message)
+            finished = True
+            error = batch.close_archives()
+            if error is not None:
+                send({"type": "error", "message": error})
+            # Saved before the answer, so the next batch of the client finds the files up to date
+            if cache is not None:
+                cache.save()
+            send({"type": "done", "images": len(batch.jobs), "processed": batch.processed, "failed": batch.failed, "up_to_date": up_to_date})
+        except OSError:
+            if not finished:
+                # The client went away: drop its files that did not start yet and wait for the running ones
+                batch.cancel(self.queue.remove(batch))
+                while batch.next_message() is not None:
+                    pass
+                batch.close_archives()
+                if cache is not None:
+                    cache.save()
+        finally:
+            with self.batches_done:
+                self.batches.discard(batch)
+                self.batches_done.notify_all()
     
-    def refresh_file_list(self):
-        self.fileList.set_cwd(self.inFileFrame.get_file_path())
-        self.fileList.get_all_images_in_folder()
-        self.table.add_all_files()
+    # Feeds the workers from the queue and hands the results to their batches
+    def dispatch(self):
+        executor = self.engine.get_executor()
+        while not self.stopping.is_set() or self.in_flight:
+            while not self.stopping.is_set() and len(self.in_flight) < self.engine.window:
+                item = self.queue.get(timeout = 0 if self.in_flight else 0.5)
+                if item is None:
+                    break
+                batch, index, job = item
+                if batch.cancelled:
+                    batch.finish_job()
+                    continue
+                self.in_flight[executor.submit(run_job, index, job)] = item
+            if not self.in_flight:
+                continue
+            # Short timeout, so new batches get their first files started quickly
+            done, _ = futures.wait(self.in_flight, timeout = 0.05, return_when = futures.FIRST_COMPLETED)
+            for future in done:
+                batch, index, job = self.in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as error:
+                    # Only happens if the pool itself broke (e.g. a worker was killed): start a new one
+                    if self.engine.executor is executor:
+                        executor.shutdown(wait = False)
+                        self.engine.executor = None
+                        executor = self.engine.get_executor()
+                    result = BatchResult(index, job["filename"], 0, type(error).__name__ + ": " + str(error))
+                batch.add_result(result)
+        # Files that did not start fail, so every client still gets an answer for each of its files
+        for batch, index, job in self.queue.close():
+            if batch.cancelled:
+                batch.finish_job()
+            else:
+                batch.add_result(BatchResult(index, job["filename"], 0, Daemon_Stopped))
 
-if __name__ == '__main__':
-    fileList = FileList()
-    if len(sys.argv) > 1:
-        for image_filename in sys.argv[1:]:
+# True if a daemon answers on the socket
+def daemon_running(socket_path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+# The options of a command line run, as sent to the daemon. Paths are made absolute, since the daemon runs in
+# another folder. A manifest on stdin is read here and moved into arguments.files, as the daemon cannot read our stdin
+def submit_arguments(arguments):
+    if arguments.manifest == "-":
+        arguments.files = list(arguments.files) + read_manifest("-", arguments.input)
+        # An empty list must not turn into a folder scan
+        arguments.manifest = None if arguments.files else os.devnull
+    values = vars(arguments).copy()
+    values["input"] = os.path.abspath(arguments.input)
+    values["files"] = [os.path.abspath(filename) for filename in arguments.files]
+    for key in ("output", "calibration", "manifest", "archive"):
+        if values.get(key):
+            values[key] = os.path.abspath(values[key])
+    # Only used by the client
+    for key in ("summary", "metrics", "prometheus", "daemon", "submit", "socket", "watch"):
+        values.pop(key, None)
+    return values
+
+# Send a batch to a daemon and wait for it. on_result gets a BatchResult for every file as soon as it is done.
+# files are optional per-file settings (see above). Returns the "done" message of the daemon.
+# Raises OSError if no daemon could be reached and ValueError if the daemon refused the batch
+def submit_to_daemon(arguments, on_result = None, socket_path = None, files = ()):
+    if not hasattr(socket, "AF_UNIX"):
+        raise OSError("this system does not have Unix domain sockets")
+    request = {"type": "submit", "arguments": submit_arguments(arguments), "files": list(files)}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path or default_socket_path())
+        connection.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        accepted = None
+        for line in connection.makefile("rb"):
+            message = json.loads(line.decode("utf-8"))
+            if message["type"] == "error":
+                raise ValueError(message["message"])
+            if message["type"] == "accepted":
+                accepted = message
+            elif message["type"] == "result" and on_result is not None:
+                on_result(BatchResult(message["index"], message["filename"], message["processed"], message["error"], message["stats"]))
+            elif message["type"] == "done":
+                return dict(accepted or {}, **message)
+    raise OSError("the daemon closed the connection before the batch was done")
+
+# Ask a running daemon to stop, or for its status. Returns its answer
+def daemon_request(kind, socket_path = None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path or default_socket_path())
+        connection.sendall(json.dumps({"type": kind}).encode("utf-8") + b"\n")
+        return json.loads(connection.makefile("rb").readline().decode("utf-8"))
+
+# Run a batch from the command line. Returns the exit code: 0 if every image worked, 1 if any failed, 2 for bad arguments
+def main(argv = None):
+    arguments = parse_arguments(argv)
+    if arguments.daemon:
+        try:
+            JobDaemon(arguments.socket, arguments.workers).serve()
+        except OSError as error:
+            print(str(error), file = sys.stderr)
+            return 2
+        return 0
+    if not os.path.isdir(arguments.input):
+        print("Input folder " + arguments.input + " does not exist.", file = sys.stderr)
+        return 2
+    if arguments.submit and arguments.watch:
+        print("--watch cannot be used with --submit.", file = sys.stderr)
+        return 2
+    if arguments.archive and arguments.watch:
+        print("--watch cannot be used with --archive.", file = sys.stderr)
+        return 2
+    
+    start_time = time.time()
+    results = []
+    archive_failed = False
+    metrics = Metrics()
+    metrics_log = None
+    if arguments.metrics:
+        try:
+            metrics_log = JsonLinesWriter(arguments.metrics)
+        except OSError as error:
+            print(str(error), file = sys.stderr)
+            return 2
+        metrics.add_hook(metrics_log)
+    def on_result(result):
+        if result.error is not None and arguments.submit:
+            print("Could not process " + result.filename + ": " + result.error, file = sys.stderr)
+        results.append(result)
+        metrics.record(result)
+    def write_metrics():
+        if arguments.prometheus:
+            metrics.write_prometheus(arguments.prometheus)
+    
+    try:
+        if arguments.submit:
+            try:
+                batch = submit_to_daemon(arguments, on_result, arguments.socket)
+            except OSError as error:
+                print("Could not reach the daemon (" + str(error) + "), processing here.", file = sys.stderr)
+                del results[:]
+                arguments.submit = False
+            except ValueError as error:
+                print(str(error), file = sys.stderr)
+                return 2
+            else:
+                input_dir, output_dir = batch["input_dir"], batch["output_dir"]
+                number_files, up_to_date = batch["processed"], batch["up_to_date"]
+                write_metrics()
+        if not arguments.submit:
+            try:
+                file_list = build_file_list(arguments)
+            except (OSError, ValueError) as error:
+                print(str(error), file = sys.stderr)
+                return 2
+            if arguments.pipeline:
+                threads = arguments.workers or 4
+                engine = PipelineEngine(readers = threads, writers = threads, queue_depth = arguments.queue_depth,
+                                        memory_limit = int(arguments.memory_limit * (1 << 20)))
+            else:
+                engine = BatchEngine(workers = arguments.workers)
             try:
-                process_image(image_filename)
-            except:
-                print("Could not open " + image_filename)
+                number_files = file_list.process_all_images(engine, on_result = on_result)
+                write_metrics()
+                if arguments.watch:
+                    number_files = number_files + watch_folder(file_list, engine, arguments, on_result, write_metrics)
+                    write_metrics()
+            except ArchiveError as error:
+                # The files in archives that could not be finished failed, the others are still counted
+                print("Could not write the archive: " + str(error), file = sys.stderr)
+                archive_failed = True
+                lost = set(error.filenames)
+                for position, result in enumerate(results):
+                    if result.error is None and result.filename in lost:
+                        print("Could not process " + result.filename + ": its archive could not be written", file = sys.stderr)
+                        results[position] = result._replace(count = 0, error = "ArchiveError: " + str(error))
+                number_files = sum(result.count for result in results)
+            finally:
+                engine.shutdown()
+            input_dir, output_dir, up_to_date = file_list.get_cwd(), file_list.get_output_dir(), file_list.skipped
+    finally:
+        if metrics_log is not None:
+            metrics_log.close()
+    failed = [result for result in results if result.error is not None]
+    # Files that process_image skipped (not an image, already has a scale) count as done but were not processed
+    skipped = set(result.index for result in results if result.error is None and (result.stats or {}).get("skipped"))
+    number_files = number_files - len(skipped)
     
-            
-    app = QApplication(sys.argv)
-    ex = App(fileList)
-    sys.exit(app.exec_())
\ No newline at end of file
+    summary = {"input_dir": input_dir, "output_dir": output_dir, "images": len(results),
+               "processed": number_files, "skipped": len(skipped), "failed": len(failed), "up_to_date": up_to_date,
+               "seconds": round(time.time() - start_time, 3), "metrics": metrics.summary(),
+               "files": [{"filename": result.filename, "processed": 0 if result.index in skipped else result.count,
+                          "skipped": result.index in skipped, "error": result.error}
+                         for result in sorted(results, key = lambda result: result.index)]}
+    if arguments.summary == "-":
+        print(json.dumps(summary, indent = 1))
+    elif arguments.summary:
+        with open(arguments.summary, "w", encoding = "utf-8") as file:
+            json.dump(summary, file, indent = 1)
+    print(str(number_files) + " images processed, " + str(len(skipped)) + " skipped, " + str(len(failed)) + " failed, " + str(up_to_date) + " up to date.",
+          file = sys.stderr)
+    
+    return 1 if failed or archive_failed else 0
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1:] != ["--startup-timing"]:
+        sys.exit(main())
+    # No arguments: open the window
+    import AutoScaleGUI
+    sys.exit(AutoScaleGUI.main())
@@ -0,0 +1,210 @@
+from PIL import Image
+import AutoScale
+import os, io, sys, json, math, time, shutil, argparse, platform, tempfile, statistics
+
+# Benchmarks for the image processing of AutoScale.py, to size hardware and to check that changes do not make it slower.
+# A synthetic set of images is generated (every format in Valid_Filenames, several sizes and modes, multi-frame TIFF),
+# then opening, drawing, encoding, process_image, folder scans and whole batches are timed separately.
+# Results are written as JSON and can be compared with an earlier run:
+#     python AutoScaleBenchmark.py --sizes 1,8 --output new.json --baseline old.json --tolerance 0.2
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# Image modes that can be generated: 8-bit color, 8-bit grayscale and 16-bit grayscale
+Benchmark_Modes = ["RGB", "L", "I;16"]
+
+# Which modes each format can store without conversion. GIF is only generated from grayscale: a color image
+# quantized to 256 colors leaves no free palette entry for the scale color
+def mode_supported(extension, mode):
+    if mode == "I;16":
+        return extension in (".png", ".tif", ".tiff")
+    if extension == ".gif":
+        return mode == "L"
+    return True
+
+# A synthetic microscope-like image: smooth background with some noise, so compression behaves realistically
+def make_image(megapixels, mode):
+    width = int(math.sqrt(megapixels * 1e6 * 4 / 3))
+    height = int(width * 3 / 4)
+    background = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 20)
+    image = Image.blend(background, noise, 0.3)
+    if mode == "RGB":
+        return Image.merge("RGB", (image, image.transpose(Image.FLIP_LEFT_RIGHT), noise))
+    if mode == "I;16":
+        return image.convert("I").point(lambda value: value * 257).convert("I;16")
+    return image
+
+# Generate the test images. Returns a list of {"name", "path", "format", "mode", "megapixels", "frames"}
+def generate_corpus(directory, sizes, modes, extensions, frames = 3):
+    corpus = []
+    for megapixels in sizes:
+        for mode in modes:
+            image = None
+            for extension in extensions:
+                if not mode_supported(extension, mode):
+                    continue
+                if image is None:
+                    image = make_image(megapixels, mode)
+                name = "%gmp_%s%s" % (megapixels, mode.replace(";", ""), extension)
+                path = os.path.join(directory, name)
+                if not os.path.exists(path):
+                    AutoScale.save_image(image, path, path)
+                corpus.append({"name": name, "path": path, "format": extension, "mode": mode, "megapixels": megapixels, "frames": 1})
+            # Multi-frame TIFF, as written by stack acquisitions
+            if frames > 1 and ".tif" in extensions and image is not None:
+                name = "%gmp_%s_%dframes.tif" % (megapixels, mode.replace(";", ""), frames)
+                path = os.path.join(directory, "stacks", name)
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok = True)
+                    image.save(path, save_all = True, append_images = [image] * (frames - 1))
+                corpus.append({"name": "stacks/" + name, "path": path, "format": ".tif", "mode": mode, "megapixels": megapixels, "frames": frames})
+    return corpus
+
+# Run function repeat times. Returns the median and the best time in seconds
+def time_call(function, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"median": statistics.median(times), "min": min(times)}
+
+# Highest memory used by this process and its finished children so far, in MB. None where it is not available
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        peak = max(peak, resource.getrusage(who).ru_maxrss)
+    # Linux gives kB, macOS gives bytes
+    return round(peak / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+def open_image(path):
+    image = Image.open(path)
+    image.load()
+    return image
+
+# Time every stage of one image
+def benchmark_file(file, output_dir, repeat):
+    path = file["path"]
+    image = open_image(path)
+    settings = dict(pixel_per_unit = AutoScale.ZOOM_10X, bar_width_unit = 50, unit = "um", color = "white")
+
+    def draw_cold():
+        AutoScale.Overlay_Cache.clear()
+        AutoScale.add_scale(image, **settings)
+
+    result = dict((key, file[key]) for key in ("name", "format", "mode", "megapixels", "frames"))
+    result["bytes"] = os.path.getsize(path)
+    result["open"] = time_call(lambda: open_image(path), repeat)
+    result["draw_cold"] = time_call(draw_cold, repeat)
+    result["draw"] = time_call(lambda: AutoScale.add_scale(image, **settings), repeat)
+    result["encode"] = time_call(lambda: AutoScale.save_image(image, io.BytesIO(), path), repeat)
+    result["process_image"] = time_call(lambda: AutoScale.process_image(path, os.path.dirname(path), output_dir, lowercase = False, **settings), repeat)
+    return result
+
+# Time a folder scan and a whole batch through FileList
+def benchmark_batch(corpus_dir, output_dir, workers, repeat):
+    file_list = AutoScale.FileList()
+    file_list.set_cwd(corpus_dir)
+    file_list.set_output_dir(output_dir)
+    file_list.set_subdirectories(True)
+    file_list.set_force(True)
+    result = {"scan": time_call(file_list.get_all_images_in_folder, repeat), "files": len(file_list)}
+
+    engine = AutoScale.BatchEngine(workers = workers)
+    try:
+        file_list.process_all_images(engine) # Start the workers before timing
+        result["process_all_images"] = time_call(lambda: file_list.process_all_images(engine), repeat)
+    finally:
+        engine.shutdown()
+    result["workers"] = engine.workers
+    return result
+
+# Every timing of a result file, as {"files/<name>/<stage>": seconds}
+def flatten_timings(results):
+    timings = {}
+    for file in results["files"]:
+        for stage in ("open", "draw_cold", "draw", "encode", "process_image"):
+            timings["files/" + file["name"] + "/" + stage] = file[stage]["median"]
+    for stage in ("scan", "process_all_images"):
+        if stage in results.get("batch", {}):
+            timings["batch/" + stage] = results["batch"][stage]["median"]
+    return timings
+
+# Timings that got slower than the baseline by more than tolerance (0.2 = 20 %) and by more than min_delta seconds,
+# so that noise on very short timings is not reported. Returns (name, baseline, current) tuples
+def compare(results, baseline, tolerance, min_delta = 0.005):
+    current = flatten_timings(results)
+    previous = flatten_timings(baseline)
+    regressions = []
+    for name in sorted(set(current).intersection(previous)):
+        if current[name] > previous[name] * (1 + tolerance) and current[name] - previous[name] > min_delta:
+            regressions.append((name, previous[name], current[name]))
+    return regressions
+
+def parse_arguments(argv = None):
+    parser = argparse.ArgumentParser(prog = "AutoScaleBenchmark.py", description = "Benchmark the scale bar processing on synthetic images.")
+    parser.add_argument("--sizes", default = "1,8", help = "image sizes in megapixels, separated by commas (default: 1,8). Up to 200 is realistic")
+    parser.add_argument("--modes", default = ",".join(Benchmark_Modes), help = "image modes, separated by commas (default: RGB,L,I;16)")
+    parser.add_argument("--formats", default = ",".join(AutoScale.Valid_Filenames), help = "file extensions, separated by commas (default: all)")
+    parser.add_argument("--frames", type = int, default = 3, help = "frames of the multi-frame TIFF files, 1 for none (default: 3)")
+    parser.add_argument("--repeat", type = int, default = 3, help = "times every measure is repeated; the median is kept (default: 3)")
+    parser.add_argument("-j", "--workers", type = int, default = None, help = "worker processes for the batch benchmark (default: one per CPU)")
+    parser.add_argument("--corpus", help = "folder for the generated images, kept between runs (default: a temporary folder)")
+    parser.add_argument("-o", "--output", help = "write the results to this JSON file (default: print them)")
+    parser.add_argument("--baseline", help = "JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "slowdown allowed before a timing counts as a regression (default: 0.2 = 20%%)")
+    parser.add_argument("--min-delta", type = float, default = 5, help = "smallest slowdown in ms that counts as a regression (default: 5)")
+    return parser.parse_args(argv)
+
+# Returns the exit code: 0, or 1 if there were regressions compared to the baseline
+def main(argv = None):
+    arguments = parse_arguments(argv)
+    sizes = [float(size) for size in arguments.sizes.split(",")]
+    modes = arguments.modes.split(",")
+    extensions = [extension if extension.startswith(".") else "." + extension for extension in arguments.formats.lower().split(",")]
+
+    temporary_dir = tempfile.mkdtemp(prefix = "autoscale_benchmark_")
+    corpus_dir = arguments.corpus or os.path.join(temporary_dir, "corpus")
+    output_dir = os.path.join(temporary_dir, "output")
+    os.makedirs(corpus_dir, exist_ok = True)
+    try:
+        start = time.perf_counter()
+        corpus = generate_corpus(corpus_dir, sizes, modes, extensions, arguments.frames)
+        print("Corpus of " + str(len(corpus)) + " images ready in " + str(round(time.perf_counter() - start, 1)) + " s", file = sys.stderr)
+
+        results = {"meta": {"python": platform.python_version(), "pillow": Image.__version__, "platform": platform.platform(),
+                            "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "repeat": arguments.repeat},
+                   "files": []}
+        for file in corpus:
+            results["files"].append(benchmark_file(file, output_dir, arguments.repeat))
+            print("  " + file["name"] + ": process_image " + str(round(results["files"][-1]["process_image"]["median"] * 1000, 1)) + " ms", file = sys.stderr)
+        results["batch"] = benchmark_batch(corpus_dir, output_dir, arguments.workers, arguments.repeat)
+        results["overlay_cache"] = AutoScale.Overlay_Cache.stats()
+        results["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        shutil.rmtree(temporary_dir, ignore_errors = True)
+
+    if arguments.output:
+        with open(arguments.output, "w", encoding = "utf-8") as file:
+            json.dump(results, file, indent = 1)
+    else:
+        print(json.dumps(results, indent = 1))
+
+    if arguments.baseline:
+        with open(arguments.baseline, encoding = "utf-8") as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, arguments.tolerance, arguments.min_delta / 1000)
+        for name, previous, current in regressions:
+            print("Slower: " + name + " " + str(round(previous * 1000, 1)) + " ms -> " + str(round(current * 1000, 1)) + " ms", file = sys.stderr)
+        print(str(len(regressions)) + " regressions compared to " + arguments.baseline, file = sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
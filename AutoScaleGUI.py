@@ -0,0 +1,730 @@
+import time
+# Start of the startup timings (see --startup-timing)
+Start_Time = time.perf_counter()
+
+from PyQt5.QtWidgets import *
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtCore import Qt, QTimer, QAbstractTableModel, QModelIndex
+from AutoScale import FileList, BatchEngine, Metrics, ThumbnailCache, Catalog, Encoder_Profiles, scan_images, calibrate_files, preview_image
+from collections import OrderedDict
+import os, sys, queue, sqlite3, threading
+
+Imports_Time = time.perf_counter()
+
+# Graphical interface of MicroAutoScale. The image processing itself is in AutoScale.py, which also works without Qt.
+
+# Visual frames for file selection. Contain file location info
+class FileSelector(QWidget):
+    def __init__(self,parent, fileList, is_output = False, other_selector = None):
+        super().__init__()
+        self.parent = parent
+        self.is_output = is_output
+        self.fileList = fileList
+        self.other_selector = other_selector
+        if is_output:
+            self.labeltext = "Output folder: "
+        else:
+            self.labeltext = "Input folder: "
+            
+        self.fileText = os.getcwd()
+
+        layout = QGridLayout(self)
+        self.label = QLabel(self.labeltext)
+        layout.addWidget(self.label,0,0)
+        self.textBox = QLineEdit(self.fileText)
+        layout.addWidget(self.textBox,0,1)
+        self.button = QPushButton("Browse...",self)
+        self.button.clicked.connect(self.on_click)
+        layout.addWidget(self.button,0,2)
+        if not is_output:
+            self.run_subdirectories = QCheckBox("Also edit files in subfolders", self)
+            self.run_subdirectories.clicked.connect(self.on_checkbox_click)
+            layout.addWidget(self.run_subdirectories,1,1)
+        else:
+            self.isLowercase = QCheckBox("Turn all files into lowercase", self)
+            self.isLowercase.clicked.connect(self.on_checkbox_click)
+            layout.addWidget(self.isLowercase,1,1)
+            self.isRegionOnly = QCheckBox("Only rewrite the part of TIFF/JPEG files under the scale (faster for large images)", self)
+            self.isRegionOnly.clicked.connect(self.on_checkbox_click)
+            layout.addWidget(self.isRegionOnly,2,1)
+            
+            # How the output files are written
+            encoding_layout = QHBoxLayout()
+            encoding_layout.addWidget(QLabel("Encoding:"))
+            self.encoder = QComboBox(self)
+            self.encoder.addItems(list(Encoder_Profiles))
+            self.encoder.setToolTip("fast: quickest, bigger files. compact: smaller files. archive: best quality, slowest. "
+                                    "match-source: same compression as the input files")
+            self.encoder.activated.connect(self.on_encoding_change)
+            encoding_layout.addWidget(self.encoder)
+            encoding_layout.addWidget(QLabel("Format:"))
+            self.outputFormat = QComboBox(self)
+            self.outputFormat.addItems(["Same as input", "png", "jpg", "tif", "bmp"])
+            self.outputFormat.activated.connect(self.on_encoding_change)
+            encoding_layout.addWidget(self.outputFormat)
+            self.isPyramid = QCheckBox("Tiled pyramid TIFF", self)
+            self.isPyramid.setToolTip("For very large images (stitched scans): tiled TIFF files with reduced copies, "
+                                      "quick to open in slide viewers, each with its own scale")
+            self.isPyramid.clicked.connect(self.on_encoding_change)
+            encoding_layout.addWidget(self.isPyramid)
+            encoding_layout.addStretch()
+            layout.addLayout(encoding_layout,3,1)
+
+        
+        
+    def on_click(self):
+        self.fileText = str(QFileDialog.getExistingDirectory(self, "Select folder",self.fileList.get_cwd()))
+        self.textBox.setText(self.fileText)
+        if not self.is_output:
+            self.fileList.set_cwd(self.fileText)
+            self.parent.refresh_file_list()
+            self.other_selector.fileText = self.fileText
+            self.other_selector.textBox.setText(self.fileText)
+        else:
+            self.fileList.set_output_dir(self.fileText)
+    
+    def on_checkbox_click(self):
+        if not self.is_output:
+            self.fileList.set_subdirectories(self.run_subdirectories.isChecked())
+            self.parent.refresh_file_list()
+        else:
+            self.fileList.set_lowercase(self.isLowercase.isChecked())
+            self.fileList.set_region_only(self.isRegionOnly.isChecked())
+        
+    def on_encoding_change(self):
+        self.fileList.set_encoder(self.encoder.currentText())
+        self.fileList.set_output_format(self.outputFormat.currentText() if self.outputFormat.currentIndex() > 0 else None)
+        self.fileList.set_pyramid(self.isPyramid.isChecked())
+        
+    def set_other_selector(self,other_selector):
+        self.other_selector = other_selector
+    
+    def get_file_path(self):
+        self.fileText = self.textBox.text()
+        return self.fileText
+        
+    
+# Control buttons
+class ControlsPane(QWidget):
+    def __init__(self, parent, file_list_reference, engine):
+        super().__init__()
+        self.parent = parent
+        self.file_list_reference = file_list_reference
+        self.engine = engine
+        self.progress = None
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.check_progress)
+        layout = QVBoxLayout(self)
+        self.refresh_button = QPushButton("Refresh",self)
+        self.refresh_button.clicked.connect(self.refresh)
+        layout.addWidget(self.refresh_button)
+        
+        self.add_button = QPushButton("Add Scales", self)
+        self.add_button.clicked.connect(self.do)
+        layout.addWidget(self.add_button)
+        
+        self.force_checkbox = QCheckBox("Redo all", self)
+        self.force_checkbox.setToolTip("Also process images that were already processed with the same settings")
+        self.force_checkbox.clicked.connect(self.on_force_click)
+        layout.addWidget(self.force_checkbox)
+        
+    # Get all files
+    def refresh(self):
+        self.parent.refresh_file_list()
+        
+    def on_force_click(self):
+        self.file_list_reference.set_force(self.force_checkbox.isChecked())
+
+    # Apply transformation. The batch runs in the engine's worker processes; check_progress collects the results
+    def do(self):
+        if self.engine.is_running():
+            return
+        self.file_list_reference.set_cwd(self.input_selector.get_file_path())
+        self.file_list_reference.set_output_dir(self.output_selector.get_file_path())
+        # Images that are up to date in the output folder are not processed again
+        self.cache = self.file_list_reference.get_build_cache()
+        jobs = list(self.file_list_reference.get_pending_jobs(self.cache))
+        self.jobs = dict(jobs)
+        
+        self.number_of_files = 0
+        self.finished_jobs = 0
+        self.errors = []
+        self.metrics = Metrics()
+        self.add_button.setEnabled(False)
+        self.progress = QProgressDialog("Adding scales...", "Cancel", 0, len(jobs), self)
+        self.progress.setWindowTitle("Processing")
+        self.progress.setWindowModality(Qt.WindowModal)
+        self.progress.setAutoClose(False)
+        self.progress.setAutoReset(False)
+        self.progress.canceled.connect(self.engine.cancel)
+        self.progress.show()
+        
+        self.engine.start(jobs)
+        self.timer.start(50)
+    
+    # Called by the timer while a batch is running
+    def check_progress(self):
+        # Check before polling, so no result can arrive between the last poll and the end of the batch
+        running = self.engine.is_running()
+        for result in self.engine.poll():
+            self.finished_jobs = self.finished_jobs + 1
+            self.number_of_files = self.number_of_files + result.count
+            self.metrics.record(result)
+            if result.error is not None:
+                self.errors.append(os.path.basename(result.filename) + ": " + result.error)
+            else:
+                if self.cache is not None:
+                    self.cache.record(self.jobs[result.index])
+                self.progress.setLabelText("Adding scales... " + os.path.basename(result.filename))
+        self.progress.setValue(self.finished_jobs)
+        
+        if not running:
+            self.timer.stop()
+            # Closing the dialog emits canceled, which must not cancel a finished batch
+            self.progress.canceled.disconnect()
+            self.progress.close()
+            self.add_button.setEnabled(True)
+            if self.cache is not None:
+                try:
+                    self.cache.save()
+                except OSError as error:
+                    self.errors.append("Could not save " + self.cache.path + ": " + str(error))
+            self.show_summary()
+            
+    def show_summary(self):
+        number_of_files = self.number_of_files
+        dialog = QMessageBox()
+        dialog.setIcon(QMessageBox.Information if not self.errors else QMessageBox.Warning)
+        if number_of_files == 1:
+            text = "1 image processed."
+        else:
+            text = str(number_of_files) + " images processed."
+        if self.cache is not None and self.cache.skipped:
+            text = text + " " + str(self.cache.skipped) + " images were already up to date."
+        if self.engine.is_cancelled():
+            text = text + " Cancelled by user."
+        details = list(self.errors)
+        if self.errors:
+            text = text + "\n" + str(len(self.errors)) + " images could not be processed."
+        # Where the time went, to see if opening, drawing or saving is slow
+        seconds = self.metrics.summary()["seconds"]
+        if seconds:
+            details.append("Time spent: " + ", ".join(stage + " " + str(round(value, 1)) + " s" for stage, value in seconds.items()))
+        if details:
+            dialog.setDetailedText("\n".join(details))
+        dialog.setText(text)
+            
+        dialog.setWindowTitle("Complete")
+        dialog.setStandardButtons(QMessageBox.Ok)
+        dialog.exec()
+        
+
+# Table model on top of the FileList. Qt only asks for the rows that are visible, so large folders stay fast
+class FileListModel(QAbstractTableModel):
+    headers = ["do", "File", "Zoom", "Pixel per unit", "Bar size (Unit)", "Unit", "Color"]
+    fields = ["do", "filename", "zoom", "pixel_per_unit", "bar_width_unit", "unit", "color"]
+    
+    def __init__(self, file_list_reference):
+        super().__init__()
+        self.fileList = file_list_reference
+        # Settings are saved to the catalog of the folder by a background thread, in the order they were changed
+        self.save_queue = queue.Queue()
+        threading.Thread(target = self.save_in_thread, daemon = True).start()
+        
+    def rowCount(self, parent = QModelIndex()):
+        return 0 if parent.isValid() else len(self.fileList)
+        
+    def columnCount(self, parent = QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+        
+    def headerData(self, section, orientation, role = Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.headers[section]
+        return super().headerData(section, orientation, role)
+        
+    def data(self, index, role = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, col = index.row(), index.column()
+        if col == 0:
+            if role == Qt.CheckStateRole:
+                return Qt.Checked if self.fileList.do[row] else Qt.Unchecked
+            return None
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            if col == 1:
+                return os.path.basename(self.fileList.filenames[row])
+            return str(self.fileList.get(row, self.fields[col]))
+        if role == Qt.ToolTipRole and col == 1:
+            return self.fileList.filenames[row]
+        return None
+        
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        col = index.column()
+        if col == 0:
+            flags = flags | Qt.ItemIsUserCheckable
+        elif col == 3:
+            # The pixel per unit can only be typed in for custom zoom levels
+            if self.fileList.zoom[index.row()] not in self.fileList.profile.objectives:
+                flags = flags | Qt.ItemIsEditable
+        elif col != 1:
+            flags = flags | Qt.ItemIsEditable
+        return flags
+        
+    # Update file information when an item is changed
+    def setData(self, index, value, role = Qt.EditRole):
+        if not index.isValid():
+            return False
+        row, col = index.row(), index.column()
+        if col == 0 and role == Qt.CheckStateRole:
+            self.fileList.set_settings(row, do = (value == Qt.Checked))
+            self.save_settings([row], edited = False)
+        elif col > 1 and role == Qt.EditRole:
+            try:
+                if col == 2:
+                    # A zoom level also changes the pixel per unit
+                    self.fileList.set_settings(row, zoom = str(value))
+                elif col == 3:
+                    self.fileList.set_settings(row, zoom = "Custom", pixel_per_unit = float(value))
+                elif col == 4:
+                    self.fileList.set_settings(row, bar_width_unit = float(value))
+                elif col == 5:
+                    self.fileList.set_settings(row, unit = str(value))
+                elif col == 6:
+                    self.fileList.set_settings(row, color = str(value))
+            except ValueError:
+                return False
+            self.save_settings([row])
+        else:
+            return False
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.headers) - 1))
+        return True
+    
+    # Add files found by a scan to the end of the list, as (filename, pixel per unit from the header or None) pairs
+    def add_files(self, files):
+        if not files:
+            return
+        first = len(self.fileList)
+        self.beginInsertRows(QModelIndex(), first, first + len(files) - 1)
+        for filename, pixel_per_unit in files:
+            self.fileList.new_file(filename, pixel_per_unit)
+        self.endInsertRows()
+        
+    # Add files from the catalog, with all their settings
+    def add_records(self, records):
+        if not records:
+            return
+        first = len(self.fileList)
+        self.beginInsertRows(QModelIndex(), first, first + len(records) - 1)
+        self.fileList.extend_records(records)
+        self.endInsertRows()
+        
+    # Keep the settings of some rows (all if rows is None) in the catalog, if the files came from one.
+    # edited is False for changes that are not settings chosen by the user (see FileList.save_settings)
+    def save_settings(self, rows = None, edited = True):
+        if self.fileList.catalog is not None:
+            self.save_queue.put((self.fileList.catalog, self.fileList.records(rows), edited))
+            
+    # Close a catalog that is not used anymore, once the settings still waiting to be saved to it are saved
+    def close_catalog(self, catalog):
+        if catalog is not None:
+            self.save_queue.put((catalog, None, None))
+            
+    def save_in_thread(self):
+        while True:
+            catalog, records, edited = self.save_queue.get()
+            try:
+                if records is None:
+                    catalog.close()
+                else:
+                    catalog.save(records, edited)
+            except sqlite3.Error as error:
+                print("Could not save the settings: " + str(error), file = sys.stderr)
+            finally:
+                self.save_queue.task_done()
+        
+    def clear(self):
+        self.beginResetModel()
+        self.close_catalog(self.fileList.catalog)
+        self.fileList.clear()
+        self.endResetModel()
+        
+    # Tell the views that columns first..last of every row changed, in one go
+    def all_rows_changed(self, first, last):
+        if len(self.fileList):
+            self.dataChanged.emit(self.index(0, first), self.index(len(self.fileList) - 1, last))
+    
+    def set_all_do(self, do):
+        self.fileList.set_column("do", do)
+        self.all_rows_changed(0, 0)
+        self.save_settings(edited = False)
+    
+    # Give all files the settings of one file
+    def copy_settings(self, selected_row):
+        self.fileList.copy_settings(selected_row)
+        self.all_rows_changed(2, len(self.headers) - 1)
+        self.save_settings()
+
+
+# Drop-down list to choose the zoom level. It is only created for the cell being edited
+class ZoomDelegate(QStyledItemDelegate):
+    def __init__(self, parent, file_list_reference):
+        super().__init__(parent)
+        self.fileList = file_list_reference
+        
+    def createEditor(self, parent, option, index):
+        editor = QComboBox(parent)
+        editor.addItems(list(self.fileList.profile.objectives) + ["Custom"])
+        # Apply the choice right away, like the old always-visible drop-downs did
+        editor.activated.connect(lambda: self.commit_and_close(editor))
+        return editor
+        
+    def commit_and_close(self, editor):
+        self.commitData.emit(editor)
+        self.closeEditor.emit(editor)
+        
+    def setEditorData(self, editor, index):
+        text = index.data(Qt.EditRole)
+        position = editor.findText(text)
+        editor.setCurrentIndex(position if position >= 0 else editor.count() - 1)
+        
+    def setModelData(self, editor, model, index):
+        model.setData(index, editor.currentText(), Qt.EditRole)
+
+
+class ImageListTable(QWidget):
+    def __init__(self, parent, file_list_reference):
+        super().__init__()
+        self.parent = parent
+        self.fileList = file_list_reference
+        
+        layout = QGridLayout(self)
+        self.model = FileListModel(file_list_reference)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.zoom_delegate = ZoomDelegate(self.table, file_list_reference)
+        self.table.setItemDelegateForColumn(2, self.zoom_delegate)
+        self.table.setEditTriggers(QAbstractItemView.CurrentChanged | QAbstractItemView.DoubleClicked | QAbstractItemView.SelectedClicked | QAbstractItemView.EditKeyPressed)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        # All rows have the same height, so Qt never needs to measure them
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        
+        layout.addWidget(self.table,0,0,3,4)
+        
+        # Buttons for selection
+        self.selectAll = QPushButton("Select All")
+        self.selectAll.clicked.connect(self.select_all)
+        layout.addWidget(self.selectAll,3,2)
+        
+        self.selectNone = QPushButton("Select None")
+        self.selectNone.clicked.connect(self.select_none)
+        layout.addWidget(self.selectNone,3,3)
+        
+        self.copySettings = QPushButton("Copy settings to other files")
+        self.copySettings.clicked.connect(self.copy_settings)
+        layout.addWidget(self.copySettings,3,1)
+        
+        self.table.resizeColumnsToContents()
+        
+    def add_files(self, files, records = ()):
+        had_files = len(self.fileList) > 0
+        self.model.add_files(files)
+        self.model.add_records(records)
+        if not had_files:
+            self.table.resizeColumnsToContents()
+        
+    def clear_table(self):
+        self.model.clear()
+        
+    # Set all files to "do"
+    def select_all(self):
+        self.model.set_all_do(True)
+    
+    # Set all files to "don't do"
+    def select_none(self):
+        self.model.set_all_do(False)
+        
+    # Change settings to they are similar between files
+    def copy_settings(self):
+        # Get selected row
+        selected_row = self.table.currentIndex().row()
+        if selected_row < 0:
+            return
+        self.model.copy_settings(selected_row)
+            
+
+# Preview of the selected image with its scale, updated when its settings change.
+# Thumbnails are loaded in a background thread, which only loads the last image asked for, so scrolling quickly
+# through the table does not pile up work. They are kept in memory and in the on-disk thumbnail cache
+class PreviewPane(QWidget):
+    def __init__(self, parent, file_list_reference, thumbnail_cache, memory_size = 64):
+        super().__init__()
+        self.parent = parent
+        self.fileList = file_list_reference
+        self.cache = thumbnail_cache
+        self.memory_size = memory_size
+        self.thumbnails = OrderedDict() # filename: (thumbnail, full size) or the error that happened when loading it
+        self.row = None
+        self.waiting_for = None
+        self.requests = queue.Queue()
+        self.loaded = queue.Queue()
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.check_loaded)
+        
+        layout = QVBoxLayout(self)
+        self.image_label = QLabel("No image selected")
+        self.image_label.setAlignment(Qt.AlignCenter)
+        self.image_label.setMinimumSize(300, 225)
+        layout.addWidget(self.image_label)
+        self.caption = QLabel("")
+        self.caption.setWordWrap(True)
+        layout.addWidget(self.caption)
+        layout.addStretch()
+        
+        self.thread = threading.Thread(target = self.load_in_thread, daemon = True)
+        self.thread.start()
+        
+    def load_in_thread(self):
+        while True:
+            filename = self.requests.get()
+            # Skip the images that were already scrolled past
+            while True:
+                try:
+                    filename = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+            if filename is None:
+                return
+            try:
+                result = self.cache.get(filename)
+            except Exception as error:
+                result = error
+            self.loaded.put((filename, result))
+    
+    # Show the image of a row of the file list, or nothing if row is None
+    def show_row(self, row):
+        if row is None or row < 0 or row >= len(self.fileList):
+            self.row = None
+            self.image_label.clear()
+            self.image_label.setText("No image selected")
+            self.caption.setText("")
+            return
+        self.row = row
+        filename = self.fileList.filenames[row]
+        if filename in self.thumbnails:
+            self.thumbnails.move_to_end(filename)
+            self.render()
+        else:
+            self.caption.setText("Loading " + os.path.basename(filename) + "...")
+            self.waiting_for = filename
+            self.requests.put(filename)
+            self.timer.start(30)
+    
+    def check_loaded(self):
+        while True:
+            try:
+                filename, result = self.loaded.get_nowait()
+            except queue.Empty:
+                break
+            self.thumbnails[filename] = result
+            while len(self.thumbnails) > self.memory_size:
+                self.thumbnails.popitem(last = False)
+            if filename == self.waiting_for:
+                self.timer.stop()
+                self.waiting_for = None
+                self.render()
+    
+    # Draw the scale with the current settings of the row
+    def render(self):
+        if self.row is None:
+            return
+        filename = self.fileList.filenames[self.row]
+        result = self.thumbnails.get(filename)
+        if result is None:
+            return
+        if isinstance(result, Exception):
+            self.image_label.clear()
+            self.image_label.setText("No preview")
+            self.caption.setText(os.path.basename(filename) + ": " + type(result).__name__ + ": " + str(result))
+            return
+        thumbnail, full_size = result
+        file = self.fileList.get_file(self.row)
+        preview = preview_image(thumbnail, full_size, file["pixel_per_unit"], file["bar_width_unit"], file["unit"], file["color"])
+        data = preview.tobytes("raw", "RGB")
+        image = QImage(data, preview.width, preview.height, preview.width * 3, QImage.Format_RGB888)
+        pixmap = QPixmap.fromImage(image)
+        self.image_label.setPixmap(pixmap.scaled(self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        self.caption.setText(os.path.basename(filename) + " (" + str(full_size[0]) + " x " + str(full_size[1]) + ")")
+    
+    # Connected to the dataChanged signal of the table model
+    def on_data_changed(self, top_left, bottom_right):
+        if self.row is not None and top_left.row() <= self.row <= bottom_right.row():
+            self.render()
+    
+    def stop(self):
+        self.requests.put(None)
+
+
+class App(QMainWindow):
+    # startup_timing: print how long the imports, the window and the first scan took, then quit
+    def __init__(self,fileList, startup_timing = False):
+        super().__init__()
+        self.startup_times = OrderedDict([("imports", Imports_Time)]) if startup_timing else None
+        self.title = 'Micro Auto Scale'
+        self.setWindowTitle(self.title)
+        self.width = 680
+        self.height = 50
+        self.fileList = fileList
+        self.engine = BatchEngine()
+        self.resize(self.width,self.height)
+        self._main = QWidget()
+        self.setCentralWidget(self._main)
+        
+        layout = QGridLayout(self._main)
+        
+        # File selection menus
+        self.inFileFrame  = FileSelector(self,fileList,is_output=False)
+        self.outFileFrame = FileSelector(self,fileList,is_output=True,other_selector=self.inFileFrame)
+        self.inFileFrame.set_other_selector(self.outFileFrame)
+        
+        layout.addWidget(self.inFileFrame,0,0,1,5)
+        layout.addWidget(self.outFileFrame,1,0,1,5)
+        
+        # Controls pane
+        self.controls = ControlsPane(self,fileList,self.engine)
+        self.controls.input_selector = self.inFileFrame
+        self.controls.output_selector = self.outFileFrame
+        layout.addWidget(self.controls,5,4)
+        
+        # Table
+        self.table = ImageListTable(self,fileList)
+        self.table.height = 500
+        layout.addWidget(self.table,3,0,50,4)
+        
+        # Preview of the selected image
+        self.preview = PreviewPane(self,fileList,ThumbnailCache())
+        layout.addWidget(self.preview,6,4,47,1)
+        self.table.table.selectionModel().currentRowChanged.connect(lambda current, previous: self.preview.show_row(current.row()))
+        self.table.model.dataChanged.connect(self.preview.on_data_changed)
+        self.table.model.modelReset.connect(lambda: self.preview.show_row(None))
+        
+        # The folder is scanned in a thread; check_scan adds the files it found to the table
+        self.scan_stop = threading.Event()
+        self.scan_queue = queue.Queue()
+        self.scan_timer = QTimer(self)
+        self.scan_timer.timeout.connect(self.check_scan)
+        
+        # The window is shown first; the folder is only read once the event loop runs, in the background
+        self.show()
+        self.startup_mark("window")
+        QTimer.singleShot(0, self.refresh_file_list)
+    
+    # Remember when a step of the startup was done, the first time it happens
+    def startup_mark(self, step):
+        if self.startup_times is not None and step not in self.startup_times:
+            self.startup_times[step] = time.perf_counter()
+            
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        self.startup_mark("first paint")
+    
+    def report_startup(self):
+        for step, when in self.startup_times.items():
+            print(step + ": " + str(round((when - Start_Time) * 1000)) + " ms", file = sys.stderr)
+        print(str(len(self.fileList)) + " files", file = sys.stderr)
+    
+    # Scan the input folder again. The table is filled while the scan goes on
+    def refresh_file_list(self):
+        self.fileList.set_cwd(self.inFileFrame.get_file_path())
+        self.table.clear_table()
+        
+        # Stop the previous scan. It has its own queue, so nothing it still finds ends up in the table
+        self.scan_stop.set()
+        self.scan_stop = threading.Event()
+        self.scan_queue = queue.Queue()
+        thread = threading.Thread(target = self.scan_in_thread, daemon = True,
+                                  args = (self.fileList.get_cwd(), self.fileList.get_do_subdirectories(), self.fileList.profile,
+                                          self.scan_queue, self.scan_stop))
+        thread.start()
+        self.scan_timer.start(50)
+    
+    # The files and their saved settings come from the catalog of the folder, which is brought up to date first.
+    # The first time a folder is opened, files reach the table while the folder is scanned.
+    # Puts ("records", list of records), ("files", [(filename, pixel per unit)]) and finally ("done", catalog or None).
+    # ("reset", []) drops what was put before, when the catalog failed after giving some of its files
+    @staticmethod
+    def scan_in_thread(folder_path, run_subdirectories, profile, scan_queue, stop):
+        catalog = None
+        try:
+            catalog = Catalog.for_folder(folder_path)
+            if len(catalog) == 0:
+                catalog.reconcile(profile, run_subdirectories, stop = stop, on_added = lambda records: scan_queue.put(("records", records)))
+            else:
+                catalog.reconcile(profile, run_subdirectories, stop = stop)
+                for records in catalog.iter_records():
+                    scan_queue.put(("records", records))
+        except (OSError, sqlite3.Error) as error:
+            print("Could not use the catalog of " + folder_path + " (" + str(error) + "), scanning the folder.", file = sys.stderr)
+            if catalog is not None:
+                catalog.close()
+                catalog = None
+            scan_queue.put(("reset", []))
+            # The headers are read here too, so the calibration is known when the files reach the table
+            filenames = (entry.path for entry in scan_images(folder_path, run_subdirectories, stop = stop))
+            for item in calibrate_files(filenames, profile):
+                scan_queue.put(("files", [item]))
+                if stop.is_set():
+                    break
+        if stop.is_set() and catalog is not None:
+            # A new scan took the place of this one, nothing will use its catalog
+            catalog.close()
+            catalog = None
+        scan_queue.put(("done", catalog))
+    
+    def check_scan(self):
+        files = []
+        records = []
+        while True:
+            try:
+                kind, items = self.scan_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "done":
+                self.scan_timer.stop()
+                self.fileList.catalog = items
+                break
+            if kind == "reset":
+                files, records = [], []
+                self.table.clear_table()
+                continue
+            (files if kind == "files" else records).extend(items)
+        self.table.add_files(files, records)
+        if files or records:
+            self.startup_mark("first rows")
+        if self.startup_times is not None and not self.scan_timer.isActive():
+            self.startup_mark("scan done")
+            self.report_startup()
+            self.close()
+        
+    def closeEvent(self, event):
+        self.scan_stop.set()
+        # Settings that are still being saved
+        self.table.model.close_catalog(self.fileList.catalog)
+        self.fileList.catalog = None
+        self.table.model.save_queue.join()
+        self.preview.stop()
+        self.engine.shutdown()
+        super().closeEvent(event)
+
+# --startup-timing prints the time taken until the imports are done, the window is shown and painted, the first files are
+# listed and the folder is completely read, then quits
+def main():
+    app = QApplication(sys.argv)
+    ex = App(FileList(), startup_timing = "--startup-timing" in sys.argv)
+    return app.exec_()
+
+if __name__ == '__main__':
+    sys.exit(main())
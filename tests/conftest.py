@@ -0,0 +1,13 @@
+import os, sys
+import pytest
+
+# The modules are at the top of the repository, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Catalogs and thumbnails go to a cache folder of the test, never to the one of the user
+@pytest.fixture(autouse = True)
+def cache_home(tmp_path, monkeypatch):
+    folder = tmp_path / "cache"
+    monkeypatch.setenv("XDG_CACHE_HOME", str(folder))
+    monkeypatch.setenv("LOCALAPPDATA", str(folder))
+    return folder
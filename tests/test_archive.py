@@ -0,0 +1,135 @@
+import os, io, re, json, tarfile, zipfile
+import pytest
+from PIL import Image
+
+import AutoScale
+
+def make_inputs(folder, number = 12):
+    os.makedirs(os.path.join(folder, "sub"))
+    for index in range(number):
+        noise = Image.effect_noise((120, 90), 10 + index).convert("RGB")
+        noise.save(os.path.join(folder, "sub" if index % 3 == 0 else "", "%02d.png" % index))
+
+def make_jobs(input_dir, **settings):
+    filenames = sorted(os.path.join(root, name) for root, folders, names in os.walk(input_dir) for name in names)
+    return [(index, dict(filename = filename, input_dir = input_dir, output_dir = input_dir, pixel_per_unit = AutoScale.ZOOM_10X,
+                         bar_width_unit = 50, unit = "um", color = "white", **settings))
+            for index, filename in enumerate(filenames)]
+
+def read_zip(path):
+    with zipfile.ZipFile(path) as archive:
+        manifest = json.loads(archive.read(AutoScale.Archive_Manifest))["entries"]
+        return archive.namelist(), manifest, dict((name, archive.read(name)) for name in archive.namelist())
+
+def test_manifest_lists_every_entry_with_its_settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(AutoScale.tempfile, "tempdir", str(tmp_path))
+    input_dir = str(tmp_path / "in")
+    make_inputs(input_dir)
+    jobs = make_jobs(input_dir, archive = str(tmp_path / "out.zip"), encoder = "fast")
+    results = list(AutoScale.BatchEngine(workers = 1).run(jobs))
+    assert all(result.error is None and result.count == 1 for result in results)
+
+    names, manifest, contents = read_zip(tmp_path / "out.zip")
+    assert names[-1] == AutoScale.Archive_Manifest
+    assert [entry["name"] for entry in manifest] == names[:-1]
+    for (index, job), entry in zip(jobs, manifest):
+        assert entry["source"] == os.path.relpath(job["filename"], input_dir).replace(os.sep, "/")
+        assert entry["name"] == AutoScale.archive_name(job)
+        assert entry["bytes"] == len(contents[entry["name"]])
+        assert entry["pixel_per_unit"] == AutoScale.ZOOM_10X and entry["encoder"] == "fast"
+        assert "archive" not in entry
+        with Image.open(io.BytesIO(contents[entry["name"]])) as image:
+            assert image.size == (120, 90)
+    # Nothing is left in the input folder nor in the temporary folder
+    assert sorted(os.listdir(input_dir)) == sorted(["sub"] + ["%02d.png" % index for index in range(12) if index % 3])
+    assert sorted(os.listdir(tmp_path)) == ["in", "out.zip"]
+
+@pytest.mark.parametrize("name", ["batch", "pipeline"])
+def test_shards_are_filled_in_order(tmp_path, name):
+    input_dir = str(tmp_path / "in")
+    make_inputs(input_dir, 30)
+    shard_size = 60000
+    jobs = make_jobs(input_dir, archive = str(tmp_path / "out.zip"), shard_size = shard_size)
+    engine = AutoScale.BatchEngine(workers = 1) if name == "batch" else AutoScale.PipelineEngine(readers = 3, writers = 3)
+    results = list(engine.run(jobs))
+    assert len(results) == 30 and all(result.error is None for result in results)
+
+    shards = sorted(os.listdir(tmp_path))
+    shards.remove("in")
+    assert len(shards) > 2
+    assert shards == ["out-%04d.zip" % number for number in range(len(shards))]
+    entries = []
+    for number, shard in enumerate(shards):
+        names, manifest, contents = read_zip(tmp_path / shard)
+        size = sum(entry["bytes"] for entry in manifest)
+        # Every shard but the last is full, and none goes on after reaching the size
+        if number < len(shards) - 1:
+            assert size >= shard_size
+        assert size - manifest[-1]["bytes"] < shard_size
+        entries.extend(entry["source"] for entry in manifest)
+    sources = [os.path.relpath(job["filename"], input_dir).replace(os.sep, "/") for index, job in jobs]
+    # One worker adds the entries in the order of the jobs
+    assert entries == sources if name == "batch" else sorted(entries) == sorted(sources)
+
+def test_tar_archive(tmp_path):
+    input_dir = str(tmp_path / "in")
+    make_inputs(input_dir, 4)
+    jobs = make_jobs(input_dir, archive = str(tmp_path / "out.tar"), output_format = ".png")
+    results = list(AutoScale.BatchEngine(workers = 1).run(jobs))
+    assert all(result.error is None for result in results)
+
+    with tarfile.open(tmp_path / "out.tar") as archive:
+        members = archive.getmembers()
+        assert [member.name for member in members] == [AutoScale.archive_name(job) for index, job in jobs] + [AutoScale.Archive_Manifest]
+        manifest = json.load(archive.extractfile(AutoScale.Archive_Manifest))["entries"]
+        for member, entry in zip(members, manifest):
+            assert member.size == entry["bytes"]
+            with Image.open(archive.extractfile(member)) as image:
+                assert image.format == "PNG"
+
+def test_failed_entries_are_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr(AutoScale.tempfile, "tempdir", str(tmp_path))
+    input_dir = str(tmp_path / "in")
+    make_inputs(input_dir, 6)
+    jobs = make_jobs(input_dir, archive = str(tmp_path / "out.zip"))
+    add = AutoScale.ArchiveShard.add
+    def failing_add(shard, name, file, size):
+        if name == AutoScale.archive_name(jobs[3][1]):
+            raise OSError("disk full")
+        add(shard, name, file, size)
+    monkeypatch.setattr(AutoScale.ArchiveShard, "add", failing_add)
+
+    results = sorted(AutoScale.BatchEngine(workers = 1).run(jobs))
+    # The archive is broken from the failed entry on
+    assert [result.error is None for result in results] == [True, True, True, False, False, False]
+    assert "disk full" in results[3].error and all(result.count == 0 for result in results[3:])
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("autoscale-")]
+
+def test_archive_that_cannot_be_finished_fails_its_files(tmp_path, monkeypatch, capsys):
+    input_dir = str(tmp_path / "in")
+    make_inputs(input_dir, 6)
+    def failing_close(shard):
+        if shard.file.name.endswith("0001.zip"):
+            raise zipfile.LargeZipFile("too big")
+        shard.archive.close()
+        shard.file.close()
+    monkeypatch.setattr(AutoScale.ArchiveShard, "close", failing_close)
+
+    summary_path = str(tmp_path / "summary.json")
+    code = AutoScale.main(["-i", input_dir, "-r", "-j", "1", "--pixel-per-unit", "2", "--archive", str(tmp_path / "out.zip"),
+                           "--shard-size", "0.03", "--summary", summary_path])
+    assert code == 1
+    with open(summary_path) as file:
+        summary = json.load(file)
+    written = set()
+    for shard in os.listdir(tmp_path):
+        if shard.startswith("out-") and shard != "out-0001.zip":
+            with zipfile.ZipFile(tmp_path / shard) as archive:
+                written.update(archive.namelist())
+    failed = [entry for entry in summary["files"] if entry["error"]]
+    assert failed and summary["failed"] == len(failed)
+    assert summary["processed"] == 6 - len(failed)
+    for entry in summary["files"]:
+        name = AutoScale.output_filename(os.path.relpath(entry["filename"], input_dir), "", "", "_with_scale", True, None).replace(os.sep, "/")
+        assert (name in written) == (entry["error"] is None)
+    assert re.search("Could not write the archive: .*out-0001.zip.*LargeZipFile", capsys.readouterr().err)
@@ -0,0 +1,60 @@
+import os
+from PIL import Image
+
+import AutoScale
+
+def make_list(input_dir, output_dir, names = ("a.png", "b.png", "c.png")):
+    if not os.path.isdir(input_dir):
+        os.makedirs(input_dir)
+        for number, name in enumerate(names):
+            Image.new("RGB", (80, 60), (number * 40, 0, 0)).save(os.path.join(input_dir, name))
+    file_list = AutoScale.FileList()
+    file_list.set_cwd(input_dir)
+    file_list.set_output_dir(output_dir)
+    file_list.get_all_images_in_folder(input_dir)
+    return file_list
+
+def run(input_dir, output_dir, **options):
+    file_list = make_list(input_dir, output_dir)
+    for setting, value in options.items():
+        getattr(file_list, "set_" + setting)(value)
+    results = []
+    file_list.process_all_images(on_result = results.append)
+    return file_list.skipped, sorted(os.path.basename(result.filename) for result in results)
+
+def test_second_run_skips_everything(tmp_path):
+    input_dir, output_dir = str(tmp_path / "in"), str(tmp_path / "out")
+    assert run(input_dir, output_dir) == (0, ["a.png", "b.png", "c.png"])
+    assert os.path.exists(os.path.join(output_dir, AutoScale.Build_Cache_Filename))
+    assert run(input_dir, output_dir) == (3, [])
+    assert run(input_dir, output_dir, force = True) == (0, ["a.png", "b.png", "c.png"])
+
+def test_changes_make_files_run_again(tmp_path):
+    input_dir, output_dir = str(tmp_path / "in"), str(tmp_path / "out")
+    run(input_dir, output_dir)
+    # A changed input, and a deleted output
+    Image.new("RGB", (90, 60)).save(os.path.join(input_dir, "a.png"))
+    os.unlink(os.path.join(output_dir, "b_with_scale.png"))
+    assert run(input_dir, output_dir) == (1, ["a.png", "b.png"])
+    # Other settings give other outputs
+    assert run(input_dir, output_dir, output_format = "jpg") == (0, ["a.png", "b.png", "c.png"])
+    assert run(input_dir, output_dir, output_format = "jpg") == (3, [])
+
+def test_touched_files_are_checked_by_content(tmp_path):
+    input_dir, output_dir = str(tmp_path / "in"), str(tmp_path / "out")
+    file_list = make_list(input_dir, output_dir)
+    jobs = dict(file_list.get_jobs())
+    cache = AutoScale.BuildCache.for_output_dir(output_dir, check_content = True)
+    for index, job in jobs.items():
+        AutoScale.process_image(**job)
+        cache.record(job)
+    cache.save()
+
+    filename = jobs[0]["filename"]
+    stat = os.stat(filename)
+    os.utime(filename, ns = (stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    cache = AutoScale.BuildCache.for_output_dir(output_dir, check_content = True)
+    assert [index for index, job in cache.filter_jobs(jobs.items())] == [] and cache.skipped == 3
+    # Without the content check, only the time is compared
+    cache = AutoScale.BuildCache.for_output_dir(output_dir)
+    assert [index for index, job in cache.filter_jobs(jobs.items())] == [0]
@@ -0,0 +1,90 @@
+import json, struct
+import pytest
+from PIL import Image, TiffImagePlugin, TiffTags
+
+import AutoScale
+
+def save_tiff(path, tags, big_tiff = False):
+    ifd = TiffImagePlugin.ImageFileDirectory_v2()
+    for tag, value in tags.items():
+        ifd[tag] = value
+        if isinstance(value, bytes):
+            ifd.tagtype[tag] = TiffTags.UNDEFINED
+    Image.new("L", (20, 10)).save(path, tiffinfo = ifd, big_tiff = big_tiff)
+    return path
+
+def ome_description(size, unit = None):
+    unit = ' PhysicalSizeXUnit="' + unit + '"' if unit else ""
+    return ('<?xml version="1.0"?><OME><Image><Pixels PhysicalSizeX="' + str(size) + '"' + unit +
+            ' SizeX="20" SizeY="10"/></Image></OME>')
+
+def test_tiff_resolution(tmp_path):
+    # Pixels per centimeter, pixels per inch (the default unit), and BigTIFF
+    assert AutoScale.header_pixels_per_um(save_tiff(str(tmp_path / "cm.tif"), {282: 26041.69, 296: 3})) == pytest.approx(2.604169)
+    assert AutoScale.header_pixels_per_um(save_tiff(str(tmp_path / "inch.tif"), {282: 254.0})) == pytest.approx(0.01)
+    assert AutoScale.header_pixels_per_um(save_tiff(str(tmp_path / "big.tif"), {282: 1e4, 296: 3}, True)) == pytest.approx(1)
+    # No unit: nothing to go by
+    assert AutoScale.header_pixels_per_um(save_tiff(str(tmp_path / "none.tif"), {282: 1e4, 296: 1})) is None
+
+def test_imagej_description(tmp_path):
+    description = "ImageJ=1.53t\nimages=1\nunit=\\u00B5m\nspacing=1\n"
+    path = save_tiff(str(tmp_path / "imagej.tif"), {270: description, 282: 12.84722, 296: 1})
+    assert AutoScale.header_pixels_per_um(path) == pytest.approx(12.84722)
+    path = save_tiff(str(tmp_path / "imagej_nm.tif"), {270: "ImageJ=1.53t\nunit=nm\n", 282: 0.002, 296: 1})
+    assert AutoScale.header_pixels_per_um(path) == pytest.approx(2)
+    # An unknown unit falls back on the resolution unit
+    path = save_tiff(str(tmp_path / "imagej_pixel.tif"), {270: "ImageJ=1.53t\nunit=pixel\n", 282: 1e4, 296: 3})
+    assert AutoScale.header_pixels_per_um(path) == pytest.approx(1)
+
+def test_ome_description(tmp_path):
+    assert AutoScale.header_pixels_per_um(save_tiff(str(tmp_path / "um.ome.tif"), {270: ome_description(0.0778)})) == pytest.approx(1 / 0.0778)
+    assert AutoScale.header_pixels_per_um(save_tiff(str(tmp_path / "nm.ome.tif"), {270: ome_description(250, "nm")})) == pytest.approx(4)
+    # The OME size wins over the TIFF resolution
+    path = save_tiff(str(tmp_path / "both.ome.tif"), {270: ome_description(0.5), 282: 1e4, 296: 3})
+    assert AutoScale.header_pixels_per_um(path) == pytest.approx(2)
+    assert AutoScale.description_pixels_per_um(ome_description(0), None) is None
+    assert AutoScale.description_pixels_per_um(ome_description(1, "parsec"), None) is None
+
+def test_lsm_voxel_size(tmp_path):
+    information = b"\0" * AutoScale.Lsm_Voxel_Size_Offset + struct.pack("<d", 0.25e-6) + b"\0" * 16
+    assert AutoScale.header_pixels_per_um(save_tiff(str(tmp_path / "scan.tif"), {34412: information})) == pytest.approx(4)
+    # A block too short to hold the voxel size is ignored
+    assert AutoScale.header_pixels_per_um(save_tiff(str(tmp_path / "short.tif"), {34412: b"\0" * 20})) is None
+
+def test_other_formats(tmp_path):
+    Image.new("RGB", (20, 10)).save(str(tmp_path / "a.png"), dpi = (25400, 25400))
+    Image.new("RGB", (20, 10)).save(str(tmp_path / "b.jpg"))
+    (tmp_path / "broken.tif").write_bytes(b"II*\0 not really")
+    assert AutoScale.header_pixels_per_um(str(tmp_path / "a.png")) == pytest.approx(1, rel = 1e-3)
+    assert AutoScale.header_pixels_per_um(str(tmp_path / "b.jpg")) is None
+    assert AutoScale.read_header_pixels_per_um(str(tmp_path / "broken.tif")) is None
+    assert AutoScale.read_header_pixels_per_um(str(tmp_path / "missing.png")) is None
+
+def test_profile_and_calibrate_files(tmp_path):
+    paths = [save_tiff(str(tmp_path / "50x_header.tif"), {282: 128472.2, 296: 3}),
+             save_tiff(str(tmp_path / "custom.tif"), {282: 40000.0, 296: 3}),
+             save_tiff(str(tmp_path / "sample_x50.tif"), {282: 72.0}), # 72 dpi is not a calibration
+             str(tmp_path / "missing_100x.tif")]
+    profile = AutoScale.Default_Profile
+    for workers in (1, 4):
+        calibrations = list(AutoScale.calibrate_files(paths, profile, workers))
+        assert [filename for filename, pixel_per_unit in calibrations] == paths
+        assert [pixel_per_unit for filename, pixel_per_unit in calibrations] == [pytest.approx(AutoScale.ZOOM_50X), pytest.approx(4), None, None]
+    assert [profile.calibration(filename, pixel_per_unit)[0] for filename, pixel_per_unit in calibrations] == ["50x", "Custom", "50x", "100x"]
+
+    # A profile in nanometers, that does not read headers
+    with open(str(tmp_path / "profile.json"), "w", encoding = "utf-8") as file:
+        json.dump({"unit": "nm", "objectives": {"low": 0.004, "high": 0.04}, "patterns": [["high", "high"]]}, file)
+    profile = AutoScale.CalibrationProfile.load(str(tmp_path / "profile.json"))
+    assert profile.header_calibration(40) == pytest.approx(0.04) and profile.zoom_for(0.0401) == "high"
+    assert profile.calibration("x_high.tif") == ("high", 0.04) and profile.calibration("x.tif") == ("low", 0.004)
+    profile.use_headers = False
+    assert list(AutoScale.calibrate_files(paths, profile)) == [(path, None) for path in paths]
+    with pytest.raises(ValueError, match = "Unknown unit"):
+        AutoScale.CalibrationProfile({"low": 1}, unit = "furlong")
+    with pytest.raises(ValueError, match = "Unknown objective"):
+        AutoScale.CalibrationProfile({"low": 1}, [("x", "high")])
+    with open(str(tmp_path / "empty.json"), "w", encoding = "utf-8") as file:
+        json.dump({"unit": "um"}, file)
+    with pytest.raises(ValueError, match = "not a calibration profile"):
+        AutoScale.CalibrationProfile.load(str(tmp_path / "empty.json"))
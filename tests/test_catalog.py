@@ -0,0 +1,92 @@
+import os, queue, sqlite3, threading
+import pytest
+from PIL import Image
+
+import AutoScale
+
+def make_images(folder, names):
+    for name in names:
+        path = os.path.join(folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        Image.new("RGB", (40, 30)).save(path)
+
+def filenames(catalog):
+    return [record[0] for records in catalog.iter_records() for record in records]
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = str(tmp_path / "images")
+    make_images(folder, ["a.png", "b_50x.png", os.path.join("sub", "c.png")])
+    return folder
+
+def test_reconcile_finds_new_and_deleted_files(folder):
+    profile = AutoScale.Default_Profile
+    catalog = AutoScale.Catalog.for_folder(folder)
+    assert catalog.reconcile(profile, True) == (3, 0)
+    assert filenames(catalog) == [os.path.join(folder, name) for name in ("a.png", "b_50x.png", os.path.join("sub", "c.png"))]
+    records = dict((record[0], record[1:]) for records in catalog.iter_records() for record in records)
+    assert records[os.path.join(folder, "b_50x.png")][1] == "50x"
+    
+    make_images(folder, [os.path.join("sub", "d.png"), os.path.join("new", "e.png")])
+    os.remove(os.path.join(folder, "a.png"))
+    assert catalog.reconcile(profile, True) == (2, 1)
+    assert filenames(catalog) == [os.path.join(folder, name) for name in
+                                  ("b_50x.png", os.path.join("new", "e.png"), os.path.join("sub", "c.png"), os.path.join("sub", "d.png"))]
+    
+    # Without subfolders, only the top folder is kept
+    catalog.reconcile(profile, False)
+    assert filenames(catalog) == [os.path.join(folder, "b_50x.png")]
+    catalog.close()
+
+def test_saved_settings_are_kept(folder):
+    file_list = AutoScale.FileList()
+    file_list.set_cwd(folder)
+    file_list.load_catalog()
+    row = file_list.filenames.index(os.path.join(folder, "a.png"))
+    file_list.set_settings(row, zoom = "100x", color = "black")
+    file_list.save_settings([row])
+    file_list.catalog.close()
+    
+    reopened = AutoScale.FileList()
+    reopened.set_cwd(folder)
+    reopened.load_catalog()
+    assert reopened.get_file(row)["zoom"] == "100x" and reopened.get_file(row)["color"] == "black"
+    # Edited settings stay when the calibration profile changes, the others are worked out again
+    profile = AutoScale.CalibrationProfile({"10x": 1.0, "50x": 5.0, "100x": 10.0}, [("50x", "50x")], "10x")
+    reopened.catalog.reconcile(profile)
+    records = dict((record[0], record[1:]) for records in reopened.catalog.iter_records() for record in records)
+    assert records[os.path.join(folder, "a.png")][1:3] == ("100x", AutoScale.Zoom_Levels["100x"])
+    assert records[os.path.join(folder, "b_50x.png")][1:3] == ("50x", 5.0)
+    reopened.catalog.close()
+
+def test_command_line_falls_back_to_a_scan(folder, monkeypatch):
+    def broken(self, catalog = None, stop = None):
+        raise sqlite3.OperationalError("disk I/O error")
+    monkeypatch.setattr(AutoScale.FileList, "load_catalog", broken)
+    arguments = AutoScale.parse_arguments(["-i", folder, "--catalog"])
+    file_list = AutoScale.build_file_list(arguments)
+    assert file_list.catalog is None
+    assert sorted(file_list.filenames) == [os.path.join(folder, "a.png"), os.path.join(folder, "b_50x.png")]
+
+def test_window_scan_falls_back_without_duplicates(folder, monkeypatch):
+    AutoScaleGUI = pytest.importorskip("AutoScaleGUI")
+    reconcile, closed = AutoScale.Catalog.reconcile, []
+    # The catalog gives its files, then fails
+    def failing(self, profile, run_subdirectories = False, workers = 8, stop = None, on_added = None):
+        reconcile(self, profile, run_subdirectories, workers, stop, on_added)
+        raise sqlite3.OperationalError("disk I/O error")
+    close = AutoScale.Catalog.close
+    monkeypatch.setattr(AutoScale.Catalog, "reconcile", failing)
+    monkeypatch.setattr(AutoScale.Catalog, "close", lambda self: (closed.append(self), close(self)))
+    scan_queue = queue.Queue()
+    AutoScaleGUI.App.scan_in_thread(folder, True, AutoScale.Default_Profile, scan_queue, threading.Event())
+    
+    messages = []
+    while not scan_queue.empty():
+        messages.append(scan_queue.get())
+    kinds = [kind for kind, items in messages]
+    assert kinds[0] == "records" and kinds[-1] == "done" and messages[-1][1] is None
+    # What came before the reset is dropped by the window, the scan lists every file once after it
+    after_reset = [item[0] for kind, items in messages[kinds.index("reset"):] if kind == "files" for item in items]
+    assert sorted(after_reset) == [os.path.join(folder, name) for name in ("a.png", "b_50x.png", os.path.join("sub", "c.png"))]
+    assert len(closed) == 1
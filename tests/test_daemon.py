@@ -0,0 +1,90 @@
+import os, json, time, threading
+import pytest
+from PIL import Image
+
+import AutoScale
+
+pytestmark = pytest.mark.skipif(not hasattr(AutoScale.socket, "AF_UNIX"), reason = "the daemon needs Unix domain sockets")
+
+def make_images(folder, number, size = (200, 150)):
+    os.makedirs(folder, exist_ok = True)
+    for index in range(number):
+        Image.effect_noise(size, 20 + index).convert("RGB").save(os.path.join(folder, "%02d.png" % index))
+
+@pytest.fixture
+def daemon(tmp_path):
+    daemon = AutoScale.JobDaemon(str(tmp_path / "daemon.sock"), workers = 1, window = 1)
+    thread = threading.Thread(target = daemon.serve, daemon = True)
+    thread.start()
+    deadline = time.time() + 60
+    while not os.path.exists(daemon.socket_path) or daemon.server is None:
+        assert thread.is_alive() and time.time() < deadline
+        time.sleep(0.05)
+    daemon.thread = thread
+    yield daemon
+    daemon.stop()
+    thread.join(60)
+
+def submit(daemon, *argv, **options):
+    results = []
+    done = AutoScale.submit_to_daemon(AutoScale.parse_arguments(list(argv)), options.get("on_result", results.append), daemon.socket_path,
+                                      options.get("files", ()))
+    return done, results
+
+def test_submit_and_status(daemon, tmp_path):
+    make_images(str(tmp_path / "in"), 5)
+    done, results = submit(daemon, "-i", str(tmp_path / "in"), "-o", str(tmp_path / "out"), "--pixel-per-unit", "2")
+    assert done["type"] == "done" and done["images"] == 5 and done["processed"] == 5 and done["failed"] == 0
+    assert sorted(result.index for result in results) == list(range(5)) and all(result.error is None for result in results)
+    assert sorted(name for name in os.listdir(tmp_path / "out") if name.endswith(".png")) == ["%02d_with_scale.png" % index for index in range(5)]
+
+    status = AutoScale.daemon_request("status", daemon.socket_path)
+    assert status["type"] == "status" and status["pid"] == os.getpid() and status["workers"] == 1
+    assert status["batches"] == status["queued"] == status["running"] == 0
+
+def test_unknown_zoom_is_refused(daemon, tmp_path):
+    make_images(str(tmp_path / "in"), 1)
+    with pytest.raises(ValueError, match = "Unknown zoom"):
+        submit(daemon, "-i", str(tmp_path / "in"), files = [{"filename": str(tmp_path / "in" / "00.png"), "zoom": "20x"}])
+
+def test_batches_share_the_build_cache(daemon, tmp_path):
+    input_dir, output_dir = str(tmp_path / "in"), str(tmp_path / "out")
+    make_images(input_dir, 6)
+    # Two clients at the same time, each with half of the files, writing to the same output folder
+    answers = {}
+    def client(names):
+        answers[names[0]] = submit(daemon, "-i", input_dir, "-o", output_dir, "--pixel-per-unit", "2",
+                                   *[os.path.join(input_dir, name) for name in names])[0]
+    threads = [threading.Thread(target = client, args = (names,)) for names in (["00.png", "01.png", "02.png"], ["03.png", "04.png", "05.png"])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [answers[name]["processed"] for name in ("00.png", "03.png")] == [3, 3]
+    assert len(daemon.build_caches) == 1
+    with open(os.path.join(output_dir, AutoScale.Build_Cache_Filename), encoding = "utf-8") as file:
+        assert len(json.load(file)) == 6
+
+    done, results = submit(daemon, "-i", input_dir, "-o", output_dir, "--pixel-per-unit", "2")
+    assert done["up_to_date"] == 6 and done["images"] == 0 and not results
+    Image.new("RGB", (20, 20)).save(os.path.join(input_dir, "02.png"))
+    done, results = submit(daemon, "-i", input_dir, "-o", output_dir, "--pixel-per-unit", "2")
+    assert done["up_to_date"] == 5 and [result.filename for result in results] == [os.path.join(input_dir, "02.png")]
+
+def test_shutdown_answers_the_waiting_files(daemon, tmp_path):
+    make_images(str(tmp_path / "in"), 30, (600, 400))
+    results = []
+    def on_result(result):
+        if not results:
+            assert AutoScale.daemon_request("shutdown", daemon.socket_path) == {"type": "done"}
+        results.append(result)
+    done = submit(daemon, "-i", str(tmp_path / "in"), "--pixel-per-unit", "2", on_result = on_result)[0]
+
+    stopped = [result for result in results if result.error == AutoScale.Daemon_Stopped]
+    assert len(results) == 30 and len(set(result.index for result in results)) == 30
+    assert stopped and done["failed"] == len(stopped) and done["processed"] == 30 - len(stopped)
+    daemon.thread.join(60)
+    assert not daemon.thread.is_alive() and not os.path.exists(daemon.socket_path)
+    # Once stopped, the daemon takes no more batches
+    with pytest.raises(OSError):
+        submit(daemon, "-i", str(tmp_path / "in"))
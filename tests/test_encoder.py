@@ -0,0 +1,87 @@
+import io, os
+import pytest
+from PIL import Image, ImageCms, ImageDraw
+
+import AutoScale
+
+def reopen(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+def encode(image, filename, encoder):
+    buffer = io.BytesIO()
+    AutoScale.save_image(image, buffer, filename, encoder)
+    return buffer.getvalue()
+
+def source_jpeg(quality = 40):
+    exif = Image.Exif()
+    exif[0x010F] = "Lab microscope"
+    icc = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    buffer = io.BytesIO()
+    Image.effect_noise((128, 96), 40).convert("RGB").save(buffer, "JPEG", quality = quality, exif = exif, icc_profile = icc, dpi = (300, 300))
+    return reopen(buffer.getvalue())
+
+def test_profiles_give_their_options():
+    image = source_jpeg()
+    assert AutoScale.encoder_options(image, "JPEG") == {}
+    assert AutoScale.encoder_options(image, "PNG", "fast")["compress_level"] == 1
+    options = AutoScale.encoder_options(image, "JPEG", "archive")
+    assert (options["quality"], options["subsampling"], options["optimize"]) == (95, "4:4:4", True)
+    # Every profile but default keeps the metadata
+    for encoder in AutoScale.Encoder_Profiles:
+        options = AutoScale.encoder_options(image, "PNG", encoder)
+        assert [key in options for key in ("icc_profile", "exif", "dpi")] == [encoder != "default"] * 3
+    with pytest.raises(ValueError, match = "Unknown encoder profile"):
+        AutoScale.encoder_options(image, "PNG", "tiny")
+    with pytest.raises(ValueError, match = "Unknown encoder profile"):
+        AutoScale.FileList().set_encoder("tiny")
+
+def test_match_source_keeps_the_jpeg_tables():
+    image = source_jpeg()
+    output = reopen(encode(image, "out.jpg", "match-source"))
+    assert output.quantization == image.quantization
+    assert output.info["exif"] == image.info["exif"] and output.info["icc_profile"] == image.info["icc_profile"]
+    assert output.info["dpi"] == pytest.approx(image.info["dpi"])
+    # The default profile uses the Pillow quality instead, and drops the metadata
+    output = reopen(encode(image, "out.jpg", "default"))
+    assert output.quantization != image.quantization and "exif" not in output.info and "icc_profile" not in output.info
+    # Tables cannot be kept from a PNG
+    png = reopen(encode(image, "out.png", "default"))
+    assert "quality" not in AutoScale.encoder_options(png, "JPEG", "match-source")
+
+def test_match_source_keeps_the_tiff_compression():
+    buffer = io.BytesIO()
+    Image.effect_noise((64, 64), 30).save(buffer, "TIFF", compression = "tiff_lzw", description = "ImageJ=1.53t\nunit=micron\n", dpi = (2540, 2540))
+    image = reopen(buffer.getvalue())
+    output = reopen(encode(image, "out.tif", "match-source"))
+    assert output.info["compression"] == "tiff_lzw"
+    assert output.tag_v2[270] == "ImageJ=1.53t\nunit=micron\n" and output.info["dpi"] == pytest.approx((2540, 2540))
+    assert reopen(encode(image, "out.tif", "fast")).info["compression"] == "raw"
+    assert reopen(encode(image, "out.tif", "archive")).info["compression"] == "tiff_adobe_deflate"
+
+def test_profiles_change_the_size():
+    image = Image.linear_gradient("L").convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for position in range(0, 256, 16):
+        draw.ellipse((position, position, position + 40, position + 30), outline = (255, position, 0))
+    sizes = dict((encoder, len(encode(image, "out.png", encoder))) for encoder in ("fast", "compact", "archive"))
+    assert sizes["fast"] > sizes["compact"] >= sizes["archive"]
+    for encoder in sizes:
+        assert reopen(encode(image, "out.png", encoder)).tobytes() == image.tobytes()
+
+def test_other_output_format_converts_the_mode(tmp_path):
+    buffer = io.BytesIO()
+    Image.linear_gradient("L").resize((64, 64)).point(lambda value: value * 256).convert("I;16").save(buffer, "PNG")
+    image = reopen(buffer.getvalue())
+    assert image.mode == "I;16"
+    output = reopen(encode(image, "out.jpg", "compact"))
+    assert output.format == "JPEG" and output.mode == "L"
+
+    # Through process_image, with an encoder and another output format
+    input_dir, output_dir = str(tmp_path / "in"), str(tmp_path / "out")
+    os.makedirs(input_dir)
+    Image.effect_noise((200, 150), 20).convert("RGB").save(os.path.join(input_dir, "a.bmp"))
+    assert AutoScale.process_image(os.path.join(input_dir, "a.bmp"), input_dir, output_dir, encoder = "archive", output_format = ".png") == 1
+    with Image.open(os.path.join(output_dir, "a_with_scale.png")) as output:
+        assert output.format == "PNG" and output.size == (200, 150)
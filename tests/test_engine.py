@@ -0,0 +1,57 @@
+import os, time
+from PIL import Image, ImageChops
+
+import AutoScale
+
+def make_folder(folder, number = 8):
+    os.makedirs(folder)
+    for index in range(number):
+        Image.effect_noise((160, 120), 10 + index).convert("RGB").save(os.path.join(folder, "%02d.png" % index))
+    with open(os.path.join(folder, "broken.png"), "wb") as file:
+        file.write(b"not an image")
+
+def make_list(input_dir, output_dir):
+    file_list = AutoScale.FileList()
+    file_list.set_cwd(input_dir)
+    file_list.set_output_dir(output_dir)
+    file_list.get_all_images_in_folder(input_dir)
+    return file_list
+
+def test_pool_gives_the_same_outputs_as_one_process(tmp_path):
+    input_dir = str(tmp_path / "in")
+    make_folder(input_dir)
+    engine = AutoScale.BatchEngine(workers = 2, window = 3)
+    results = []
+    try:
+        assert make_list(input_dir, str(tmp_path / "pool")).process_all_images(engine, on_result = results.append) == 8
+    finally:
+        engine.shutdown()
+    assert make_list(input_dir, str(tmp_path / "serial")).process_all_images() == 8
+
+    assert sorted(result.index for result in results) == list(range(9))
+    failed = [result for result in results if result.error is not None]
+    assert [os.path.basename(result.filename) for result in failed] == ["broken.png"] and failed[0].count == 0
+    names = sorted(os.listdir(tmp_path / "serial"))
+    assert sorted(os.listdir(tmp_path / "pool")) == names and len(names) == 9 # With the build cache
+    for name in names:
+        if name.endswith(".png"):
+            with Image.open(tmp_path / "pool" / name) as pool, Image.open(tmp_path / "serial" / name) as serial:
+                assert ImageChops.difference(pool, serial).getbbox() is None
+
+def test_start_poll_and_cancel(tmp_path):
+    input_dir = str(tmp_path / "in")
+    make_folder(input_dir, 40)
+    file_list = make_list(input_dir, str(tmp_path / "out"))
+    engine = AutoScale.BatchEngine(workers = 1)
+    engine.start(file_list.get_jobs())
+    results = []
+    while not results:
+        results.extend(engine.poll())
+        time.sleep(0.01)
+    engine.cancel()
+    engine.thread.join(60)
+    results.extend(engine.poll())
+    assert engine.is_cancelled() and not engine.is_running()
+    # The batch stopped early, and every result came once
+    assert 0 < len(results) < 41 and len(set(result.index for result in results)) == len(results)
+    engine.shutdown()
@@ -0,0 +1,71 @@
+import os, time
+import pytest
+from PIL import Image
+
+import AutoScale
+
+def make_list(names):
+    file_list = AutoScale.FileList()
+    for name in names:
+        file_list.new_file(os.path.join("/data", name))
+    return file_list
+
+def test_set_column_with_a_mask():
+    file_list = make_list(["a%d.png" % number for number in range(10)])
+    mask = bytearray(10)
+    mask[2:5] = b"\x01\x01\x01"
+    mask[8] = 7
+    for field, value in (("do", False), ("zoom", "50x"), ("bar_width_unit", 20), ("unit", "nm")):
+        file_list.set_column(field, value, mask)
+    selected = [2, 3, 4, 8]
+    for row in range(10):
+        assert file_list.get(row, "do") == (row not in selected)
+        assert file_list.get(row, "zoom") == ("50x" if row in selected else file_list.get(0, "zoom"))
+        assert file_list.get(row, "bar_width_unit") == (20 if row in selected else 50)
+        assert file_list.get(row, "unit") == ("nm" if row in selected else file_list.profile.unit)
+    # Lists of rows still work, and a mask must have one byte per file
+    file_list.set_column("color", "black", [0, 9])
+    assert [file_list.get(row, "color") for row in range(10)] == ["black"] + ["white"] * 8 + ["black"]
+    with pytest.raises(ValueError):
+        file_list.set_column("do", True, bytearray(3))
+
+def test_match_and_settings_where():
+    file_list = make_list(["x_50.png", "y_50.png", "x_10.png", "z.png"])
+    assert file_list.match("_50") == bytearray(b"\x01\x01\x00\x00")
+    assert file_list.match("_50", rows = [1, 2, 3]) == bytearray(b"\x00\x01\x00\x00")
+    before = file_list.get_file(1)
+    file_list.set_settings_where(file_list.match("x_"), zoom = "50x")
+    assert [file_list.get(row, "zoom") for row in (0, 2)] == ["50x", "50x"]
+    assert [file_list.get(row, "pixel_per_unit") for row in (0, 2)] == [AutoScale.ZOOM_50X] * 2
+    assert file_list.get_file(1) == before
+
+def test_pattern_zoom_is_checked_like_zoom(tmp_path):
+    for name in ("a_sample.png", "b_sample.png"):
+        Image.new("RGB", (40, 30)).save(str(tmp_path / name))
+    for options in (["--zoom", "20x"], ["--pattern", "a_:zoom=20x"]):
+        with pytest.raises(ValueError, match = "Unknown zoom 20x"):
+            AutoScale.build_file_list(AutoScale.parse_arguments(["-i", str(tmp_path)] + options))
+        assert AutoScale.main(["-i", str(tmp_path)] + options) == 2
+    file_list = AutoScale.build_file_list(AutoScale.parse_arguments(["-i", str(tmp_path), "--pattern", "a_:zoom=100x,bar=10"]))
+    rows = dict((os.path.basename(filename), row) for row, filename in enumerate(file_list.filenames))
+    assert file_list.get(rows["a_sample.png"], "zoom") == "100x" and file_list.get(rows["a_sample.png"], "bar_width_unit") == 10
+    assert file_list.get(rows["b_sample.png"], "bar_width_unit") == 50
+
+def test_parallel_scan_keeps_the_folder_order(tmp_path, monkeypatch):
+    for folder in ("a", "a/x", "a/y/deep", "b", "c/z"):
+        os.makedirs(tmp_path / folder)
+    for number, folder in enumerate(("", "a", "a/x", "a/y", "a/y/deep", "b", "c", "c/z")):
+        for name in ("1.png", "2.jpg"):
+            (tmp_path / folder / ("%d_%s" % (number, name))).write_bytes(b"")
+    expected = [entry.path for entry in AutoScale.scan_images(str(tmp_path), True, workers = 1)]
+    assert len(expected) == 16 and expected[:2] == [str(tmp_path / "0_1.png"), str(tmp_path / "0_2.jpg")]
+    # Folders that come first are the slowest to list, so they finish last
+    scan_folder = AutoScale.scan_folder
+    def slow_scan_folder(path):
+        time.sleep(0.05 if os.path.basename(path) in ("a", "x") else 0)
+        return scan_folder(path)
+    monkeypatch.setattr(AutoScale, "scan_folder", slow_scan_folder)
+    assert [entry.path for entry in AutoScale.scan_images(str(tmp_path), True, workers = 8)] == expected
+    file_list = AutoScale.FileList()
+    file_list.get_all_images_in_folder(str(tmp_path), True)
+    assert file_list.filenames == expected
@@ -0,0 +1,22 @@
+import os, json
+from PIL import Image
+
+import AutoScale
+
+def test_summary_counts_skipped_files(tmp_path):
+    input_dir = tmp_path / "in"
+    os.makedirs(input_dir)
+    for name in ("a.png", "b.png", "c_with_scale.png"):
+        Image.new("RGB", (60, 40)).save(str(input_dir / name))
+    (input_dir / "broken.png").write_bytes(b"not an image")
+    summary_path = str(tmp_path / "summary.json")
+    code = AutoScale.main(["-i", str(input_dir), "-j", "1", "--pixel-per-unit", "2", "--summary", summary_path])
+    with open(summary_path, encoding = "utf-8") as file:
+        summary = json.load(file)
+
+    assert code == 1
+    assert (summary["images"], summary["processed"], summary["skipped"], summary["failed"]) == (4, 2, 1, 1)
+    files = dict((os.path.basename(entry["filename"]), entry) for entry in summary["files"])
+    assert files["c_with_scale.png"]["skipped"] and files["c_with_scale.png"]["processed"] == 0
+    assert not files["a.png"]["skipped"] and files["a.png"]["processed"] == 1
+    assert files["broken.png"]["error"] and not files["broken.png"]["skipped"]
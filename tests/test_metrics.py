@@ -0,0 +1,98 @@
+import os, json
+from PIL import Image
+
+import AutoScale
+
+def result(index, filename, pixels = None, seconds = None, error = None, **stats):
+    if pixels is not None:
+        stats["pixels"] = pixels
+    stats["seconds"] = seconds or {}
+    return AutoScale.BatchResult(index, filename, 0 if error else 1, error, stats)
+
+def parse_prometheus(text):
+    samples = {}
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+def test_size_classes_and_records():
+    assert [AutoScale.size_class(pixels) for pixels in (None, 0, 10 ** 6, 10 ** 6 + 1, 50 * 10 ** 6, 10 ** 9)] == \
+        ["unknown", "unknown", "0-1MP", "1-8MP", "8-50MP", "50MP+"]
+    record = AutoScale.metrics_record(result(0, "/data/A.TIF", 4 * 10 ** 6, {"decode": 0.25, "encode": 0.0000004}, bytes_read = 100, mode = "I;16"))
+    assert (record["outcome"], record["format"], record["size_class"]) == ("processed", "tif", "1-8MP")
+    assert record["seconds"] == {"decode": 0.25, "encode": 0.0} and record["bytes_read"] == 100 and record["mode"] == "I;16"
+    assert "error" not in record and "reason" not in record
+    record = AutoScale.metrics_record(result(1, "/data/b", error = "cannot identify image file: /data/b"))
+    assert (record["outcome"], record["format"], record["size_class"], record["reason"]) == ("failed", "none", "unknown", "cannot identify image file")
+    assert AutoScale.metrics_record(result(2, "/data/c_with_scale.png", skipped = True))["outcome"] == "skipped"
+
+def test_hooks_write_json_lines(tmp_path):
+    path = str(tmp_path / "metrics.jsonl")
+    writer = AutoScale.JsonLinesWriter(path)
+    metrics = AutoScale.Metrics([writer])
+    records = []
+    metrics.add_hook(records.append)
+    metrics.record(result(0, "/data/a.png", 100, {"decode": 0.01}))
+    metrics.record(result(1, "/data/b.png", error = "broken: b.png"))
+    writer.close()
+    # The file is appended to, one record per line
+    writer = AutoScale.JsonLinesWriter(path)
+    AutoScale.Metrics([writer]).record(result(2, "/data/c.jpg", 100))
+    writer.close()
+    with open(path, encoding = "utf-8") as file:
+        lines = [json.loads(line) for line in file]
+    assert [line["filename"] for line in lines] == ["/data/a.png", "/data/b.png", "/data/c.jpg"]
+    assert lines[:2] == records and lines[1]["reason"] == "broken"
+
+def test_prometheus_text(tmp_path):
+    metrics = AutoScale.Metrics()
+    metrics.record(result(0, "/data/a.png", 100, {"decode": 0.003, "encode": 0.2}, bytes_read = 10, bytes_written = 20))
+    metrics.record(result(1, "/data/b.png", 200, {"decode": 0.04}, bytes_read = 5))
+    metrics.record(result(2, "/data/c.png", 300, {"decode": 100.0}))
+    metrics.record(result(3, "/data/d.tif", error = 'bad "file": d.tif'))
+    path = str(tmp_path / "metrics.prom")
+    metrics.write_prometheus(path)
+    assert os.listdir(tmp_path) == ["metrics.prom"]
+    with open(path, encoding = "utf-8") as file:
+        text = file.read()
+    assert text == metrics.prometheus() and text.endswith("\n")
+    assert "# TYPE autoscale_stage_seconds histogram" in text
+
+    samples = parse_prometheus(text)
+    assert samples['autoscale_files_total{format="png",size_class="0-1MP",outcome="processed"}'] == 3
+    assert samples['autoscale_files_total{format="tif",size_class="unknown",outcome="failed"}'] == 1
+    assert samples['autoscale_failures_total{reason="bad \\"file\\""}'] == 1
+    assert samples['autoscale_bytes_read_total{format="png"}'] == 15 and samples['autoscale_pixels_total{format="png"}'] == 600
+    # Buckets are cumulative and end with +Inf, which counts everything
+    labels = 'stage="decode",format="png",size_class="0-1MP"'
+    buckets = [(line.split('le="')[1].split('"')[0], samples[line]) for line in samples if line.startswith("autoscale_stage_seconds_bucket{" + labels)]
+    assert [bound for bound, count in buckets] == [str(bound) for bound in AutoScale.Metrics_Buckets] + ["+Inf"]
+    counts = [count for bound, count in buckets]
+    assert counts == sorted(counts) and counts[0] == 1 and counts[AutoScale.Metrics_Buckets.index(0.05)] == 2 and counts[-2:] == [2, 3]
+    assert samples["autoscale_stage_seconds_count{" + labels + "}"] == 3
+    assert abs(samples["autoscale_stage_seconds_sum{" + labels + "}"] - 100.043) < 1e-9
+
+    assert metrics.summary() == {"files": {"processed": 3, "failed": 1}, "failures": {'bad "file"': 1},
+                                 "seconds": {"decode": 100.043, "encode": 0.2}, "bytes_read": 15, "bytes_written": 20}
+    metrics.clear()
+    assert parse_prometheus(metrics.prometheus()) == {}
+
+def test_main_writes_metrics(tmp_path):
+    input_dir = tmp_path / "in"
+    os.makedirs(input_dir)
+    for name in ("a.png", "b.png"):
+        Image.new("RGB", (60, 40)).save(str(input_dir / name))
+    (input_dir / "broken.png").write_bytes(b"not an image")
+    metrics_path, prometheus_path = str(tmp_path / "metrics.jsonl"), str(tmp_path / "metrics.prom")
+    assert AutoScale.main(["-i", str(input_dir), "-j", "1", "--pixel-per-unit", "2", "--metrics", metrics_path, "--prometheus", prometheus_path]) == 1
+
+    with open(metrics_path, encoding = "utf-8") as file:
+        records = dict((os.path.basename(record["filename"]), record) for record in map(json.loads, file))
+    assert sorted(records) == ["a.png", "b.png", "broken.png"]
+    assert records["a.png"]["outcome"] == "processed" and records["a.png"]["pixels"] == 2400 and records["a.png"]["seconds"]
+    assert records["broken.png"]["outcome"] == "failed" and records["broken.png"]["error"]
+    with open(prometheus_path, encoding = "utf-8") as file:
+        samples = parse_prometheus(file.read())
+    assert samples['autoscale_files_total{format="png",size_class="0-1MP",outcome="processed"}'] == 2
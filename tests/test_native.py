@@ -0,0 +1,74 @@
+import os
+import pytest
+from PIL import Image
+
+import AutoScale
+
+needs_numpy = pytest.mark.skipif(AutoScale.numpy is None, reason = "anti-aliased blending needs NumPy")
+
+Settings = (AutoScale.ZOOM_10X, 50, "um")
+
+def coverage(size, color = "white"):
+    overlay = AutoScale.OverlayCache().get(size, *Settings, color)
+    mask = Image.new("L", size, 0)
+    mask.paste(overlay.patch.getchannel("A"), overlay.origin)
+    return mask
+
+def values(image):
+    return [image.getpixel((x, y)) for y in range(image.height) for x in range(image.width)]
+
+@needs_numpy
+@pytest.mark.parametrize("mode", ["I;16", "I;16B", "I"])
+def test_16_bit_images_keep_their_depth(mode):
+    size = (240, 180)
+    image = AutoScale.add_scale(Image.new(mode, size, 1000), *Settings, color = "white")
+    assert image.mode == mode
+    for pixel, alpha in zip(values(image), values(coverage(size))):
+        # Full 16 bit white under the scale, the background untouched, and anti-aliased edges in between
+        assert pixel == round(1000 + (65535 - 1000) * alpha / 255)
+    assert 65535 in values(image) and any(1000 < pixel < 65535 for pixel in values(image))
+    image = AutoScale.add_scale(Image.new(mode, size, 1000), *Settings, color = "black")
+    assert min(values(image)) == 0 and max(values(image)) == 1000
+
+@needs_numpy
+def test_float_images_use_their_brightest_pixel():
+    image = Image.new("F", (240, 180), 0.25)
+    image.putpixel((0, 0), 40.5)
+    AutoScale.add_scale(image, *Settings, color = "white")
+    assert image.mode == "F" and max(values(image)) == 40.5
+    assert sum(1 for pixel in values(image) if pixel == 40.5) > 1
+    # Images darker than 1.0 use 1.0 as white
+    image = AutoScale.add_scale(Image.new("F", (240, 180), 0.25), *Settings, color = "gray")
+    assert max(values(image)) == pytest.approx(AutoScale.native_value("gray", 1.0, False))
+
+@needs_numpy
+def test_render_scale_array_matches_the_image():
+    numpy = AutoScale.numpy
+    array = numpy.full((180, 240), 1000, numpy.uint16)
+    view = array[:, :]
+    assert AutoScale.render_scale_array(view, *Settings) is view
+    image = AutoScale.add_scale(Image.new("I;16", (240, 180), 1000), *Settings)
+    assert array.tolist() == numpy.array(image).tolist()
+    # White is the maximum of the type, or of the array for floats, unless it is given
+    array = numpy.zeros((180, 240), numpy.uint8)
+    assert AutoScale.render_scale_array(array, *Settings).max() == 255
+    array = numpy.full((180, 240), 2.0, numpy.float32)
+    assert AutoScale.render_scale_array(array, *Settings).max() == 2.0
+    array = numpy.zeros((180, 240), numpy.uint16)
+    assert AutoScale.render_scale_array(array, *Settings, white = 4095).max() == 4095
+
+def test_without_numpy_the_value_is_still_right(monkeypatch):
+    monkeypatch.setattr(AutoScale, "numpy", None)
+    image = AutoScale.add_scale(Image.new("I;16", (240, 180), 1000), *Settings, color = "white")
+    assert image.mode == "I;16" and set(values(image)) == {1000, 65535}
+
+@needs_numpy
+def test_process_image_keeps_16_bit_files(tmp_path):
+    input_dir, output_dir = str(tmp_path / "in"), str(tmp_path / "out")
+    os.makedirs(input_dir)
+    Image.new("I;16", (240, 180), 3000).save(os.path.join(input_dir, "a.tif"))
+    Image.new("I;16", (240, 180), 3000).save(os.path.join(input_dir, "b.png"))
+    for name in ("a_with_scale.tif", "b_with_scale.png"):
+        AutoScale.process_image(os.path.join(input_dir, name.replace("_with_scale", "")), input_dir, output_dir, pixel_per_unit = AutoScale.ZOOM_10X)
+        with Image.open(os.path.join(output_dir, name)) as output:
+            assert output.mode in ("I;16", "I") and output.getextrema() == (3000, 65535)
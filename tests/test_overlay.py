@@ -0,0 +1,57 @@
+import threading
+from PIL import Image, ImageChops
+
+import AutoScale
+
+Settings = (AutoScale.ZOOM_10X, 50, "um", "white")
+
+def test_same_scale_is_rendered_once():
+    cache = AutoScale.OverlayCache()
+    first = cache.get((800, 600), *Settings)
+    assert cache.get((800, 600), *Settings) is first
+    assert cache.get([800, 600], AutoScale.ZOOM_10X, 50.0, "um", "white") is first
+    assert cache.get((800, 600), AutoScale.ZOOM_10X, 50, "um", "black") is not first
+    assert cache.get((801, 600), *Settings) is not first
+    assert cache.stats() == {"hits": 2, "misses": 3, "size": 3, "maxsize": 64}
+    cache.clear()
+    assert cache.stats() == {"hits": 0, "misses": 0, "size": 0, "maxsize": 64}
+
+def test_least_recently_used_scales_are_dropped():
+    cache = AutoScale.OverlayCache(maxsize = 2)
+    first = cache.get((100, 100), *Settings)
+    second = cache.get((200, 200), *Settings)
+    assert cache.get((100, 100), *Settings) is first
+    cache.get((300, 300), *Settings)
+    assert cache.stats()["size"] == 2
+    # The first one was used last, so the second one went
+    assert cache.get((100, 100), *Settings) is first
+    assert cache.get((200, 200), *Settings) is not second
+
+def test_cached_scale_draws_the_same_image():
+    image = Image.effect_noise((900, 700), 30).convert("RGB")
+    cache = AutoScale.OverlayCache()
+    first = AutoScale.add_scale(image.copy(), *Settings, cache = cache)
+    second = AutoScale.add_scale(image.copy(), *Settings, cache = cache)
+    assert cache.stats()["hits"] == 1
+    assert ImageChops.difference(first, second).getbbox() is None
+    # Only the box of the scale changed, and it has the color of the scale
+    overlay = cache.get(image.size, *Settings)
+    left, top = overlay.origin
+    box = ImageChops.difference(first, image).getbbox()
+    assert left <= box[0] and top <= box[1] and box[2] <= left + overlay.patch.width and box[3] <= top + overlay.patch.height
+    assert first.getpixel((int(900 * 0.95) - 5, int(700 * 0.955))) == (255, 255, 255)
+
+def test_threads_share_one_cache():
+    cache = AutoScale.OverlayCache()
+    overlays = []
+    def work():
+        for size in range(100, 140):
+            overlays.append(cache.get((size, size), *Settings))
+    threads = [threading.Thread(target = work) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats["size"] == 40 and stats["hits"] + stats["misses"] == 160
+    assert len(overlays) == 160 and all(isinstance(overlay, AutoScale.Overlay) for overlay in overlays)
@@ -0,0 +1,103 @@
+import os, io, zipfile, threading
+import pytest
+from PIL import Image, ImageChops, ImageSequence
+
+import AutoScale
+
+def make_inputs(folder):
+    os.makedirs(os.path.join(folder, "sub"))
+    noise = Image.effect_noise((500, 400), 40).convert("RGB")
+    noise.save(os.path.join(folder, "noise.png"))
+    noise.save(os.path.join(folder, "sub", "photo.jpg"), quality = 90)
+    noise.convert("L").save(os.path.join(folder, "gray.tif"), compression = "tiff_adobe_deflate")
+    frames = [Image.new("RGB", (300, 200), (50 * i, 80, 120)) for i in range(3)]
+    frames[0].save(os.path.join(folder, "z.tif"), save_all = True, append_images = frames[1:])
+    frames[0].save(os.path.join(folder, "t.gif"), save_all = True, append_images = frames[1:], loop = 0)
+    Image.new("RGB", (10, 10)).save(os.path.join(folder, "old_with_scale.png"))
+
+def make_jobs(input_dir, output_dir, **settings):
+    filenames = sorted(os.path.join(root, name) for root, folders, names in os.walk(input_dir) for name in names)
+    return [(index, dict(filename = filename, input_dir = input_dir, output_dir = output_dir, pixel_per_unit = AutoScale.ZOOM_10X,
+                         bar_width_unit = 50, unit = "um", color = "white", **settings))
+            for index, filename in enumerate(filenames)]
+
+def frames(image):
+    return [frame.convert("RGBA").copy() for frame in ImageSequence.Iterator(image)]
+
+def assert_same_images(first, second):
+    with Image.open(first) as first, Image.open(second) as second:
+        first_frames, second_frames = frames(first), frames(second)
+    assert len(first_frames) == len(second_frames)
+    for first_frame, second_frame in zip(first_frames, second_frames):
+        assert ImageChops.difference(first_frame, second_frame).getbbox() is None
+
+def outputs(folder):
+    return sorted(os.path.relpath(os.path.join(root, name), folder) for root, folders, names in os.walk(folder) for name in names)
+
+@pytest.mark.parametrize("settings", [dict(), dict(output_format = ".png"), dict(region_only = True), dict(pyramid = True, output_format = ".tif")],
+                         ids = ["same format", "png", "region", "pyramid"])
+def test_pipeline_matches_batch_engine(tmp_path, settings):
+    input_dir = str(tmp_path / "in")
+    make_inputs(input_dir)
+    batch_results = list(AutoScale.BatchEngine(workers = 1).run(make_jobs(input_dir, str(tmp_path / "batch"), **settings)))
+    pipeline_results = list(AutoScale.PipelineEngine(readers = 2, writers = 2).run(make_jobs(input_dir, str(tmp_path / "pipeline"), **settings)))
+    
+    assert all(result.error is None for result in batch_results + pipeline_results)
+    summary = lambda results: sorted((result.index, result.count, bool(result.stats.get("skipped"))) for result in results)
+    assert summary(batch_results) == summary(pipeline_results)
+    assert outputs(tmp_path / "batch") == outputs(tmp_path / "pipeline")
+    for name in outputs(tmp_path / "batch"):
+        assert_same_images(tmp_path / "batch" / name, tmp_path / "pipeline" / name)
+
+def test_pipeline_archive_matches_batch_engine(tmp_path):
+    input_dir = str(tmp_path / "in")
+    make_inputs(input_dir)
+    for name, engine in (("batch", AutoScale.BatchEngine(workers = 1)), ("pipeline", AutoScale.PipelineEngine())):
+        results = list(engine.run(make_jobs(input_dir, str(tmp_path / name), archive = str(tmp_path / (name + ".zip")))))
+        assert all(result.error is None and result.output is None for result in results)
+    
+    with zipfile.ZipFile(tmp_path / "batch.zip") as batch, zipfile.ZipFile(tmp_path / "pipeline.zip") as pipeline:
+        names = batch.namelist()
+        assert sorted(names) == sorted(pipeline.namelist())
+        assert AutoScale.Archive_Manifest in names and "sub/photo_with_scale.jpg" in names
+        for name in names:
+            if name != AutoScale.Archive_Manifest:
+                assert_same_images(io.BytesIO(batch.read(name)), io.BytesIO(pipeline.read(name)))
+    assert not os.path.exists(tmp_path / "batch") and not os.path.exists(tmp_path / "pipeline")
+
+def test_outputs_into_a_new_folder_at_once(tmp_path, monkeypatch):
+    input_dir = str(tmp_path / "in")
+    os.makedirs(os.path.join(input_dir, "a", "b"))
+    for number in range(24):
+        Image.new("RGB", (60, 40), (number * 10, 0, 0)).save(os.path.join(input_dir, "a", "b", "%02d.png" % number))
+    # Every reader finds the output folder missing and creates it, as when they all check it at the same time
+    output_folder = str(tmp_path / "threads" / "a" / "b")
+    checked = threading.local()
+    def missing_once(check):
+        def patched(path):
+            if path == output_folder and not getattr(checked, "done", False):
+                checked.done = True
+                return False
+            return check(path)
+        return patched
+    monkeypatch.setattr(os.path, "isdir", missing_once(os.path.isdir))
+    monkeypatch.setattr(os.path, "exists", missing_once(os.path.exists))
+    barrier = threading.Barrier(8)
+    errors = []
+    def prepare(number):
+        barrier.wait()
+        try:
+            AutoScale.prepare_output(os.path.join(input_dir, "a", "b", "%02d.png" % number), input_dir, str(tmp_path / "threads"))
+        except OSError as error:
+            errors.append(error)
+    threads = [threading.Thread(target = prepare, args = (number,)) for number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    monkeypatch.undo()
+    
+    for run in range(5):
+        results = list(AutoScale.PipelineEngine(readers = 8).run(make_jobs(input_dir, str(tmp_path / ("pipeline%d" % run)))))
+        assert [result.error for result in results] == [None] * 24
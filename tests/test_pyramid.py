@@ -0,0 +1,109 @@
+import os
+import pytest
+from PIL import Image, ImageChops
+
+import AutoScale
+
+Settings = dict(pixel_per_unit = AutoScale.ZOOM_10X, bar_width_unit = 50, unit = "um", color = "white")
+
+def make_image(size = (1300, 900)):
+    image = Image.effect_noise(size, 40).convert("RGB")
+    image.paste((200, 40, 40), (0, 0, size[0] // 3, size[1] // 3))
+    return image
+
+def pages(filename):
+    with Image.open(filename) as image:
+        for number in range(image.n_frames):
+            image.seek(number)
+            image.load()
+            yield image.copy(), dict(image.tag_v2)
+
+def test_pyramid_levels(tmp_path):
+    filename = str(tmp_path / "scan.tif")
+    make_image().save(filename)
+    pyramid = str(tmp_path / "pyramid.tif")
+    AutoScale.write_pyramid(filename, pyramid, **Settings)
+    
+    levels = list(pages(pyramid))
+    # 1300 x 900 halved until it fits in one tile of 256
+    assert [image.size for image, tags in levels] == [(1300, 900), (650, 450), (325, 225), (163, 113)]
+    for number, (image, tags) in enumerate(levels):
+        assert tags[254] == (1 if number else 0)
+        assert tags[322] == tags[323] == AutoScale.Pyramid_Tile_Size
+        # Resolution in pixels per centimeter, halved with every level
+        assert tags[296] == 3
+        pixels_per_cm = Settings["pixel_per_unit"] / 2**number * 1e4
+        assert float(tags[282]) == pytest.approx(pixels_per_cm, rel = 1e-3)
+        assert float(tags[283]) == pytest.approx(pixels_per_cm, rel = 1e-3)
+
+def test_pyramid_first_level_matches_process_image(tmp_path):
+    os.makedirs(tmp_path / "in")
+    filename = str(tmp_path / "in" / "scan.tif")
+    make_image().save(filename, compression = "tiff_adobe_deflate")
+    AutoScale.process_image(filename, str(tmp_path / "in"), str(tmp_path / "pyramid"), pyramid = True, **Settings)
+    AutoScale.process_image(filename, str(tmp_path / "in"), str(tmp_path / "full"), **Settings)
+    
+    with Image.open(tmp_path / "pyramid" / "scan_with_scale.tif") as pyramid, Image.open(tmp_path / "full" / "scan_with_scale.tif") as full:
+        assert ImageChops.difference(pyramid.convert("RGB"), full.convert("RGB")).getbbox() is None
+
+# Streamed inputs give the same pyramid as an uncompressed TIFF
+@pytest.mark.parametrize("options", [dict(compression = "tiff_lzw"), dict(compression = "tiff_lzw", tiffinfo = {278: 900}),
+                                     dict(big_tiff = True), dict(big_tiff = True, compression = "tiff_adobe_deflate")],
+                         ids = ["lzw", "lzw one strip", "bigtiff", "bigtiff deflate"])
+def test_streamed_inputs(tmp_path, options):
+    image = make_image()
+    image.save(tmp_path / "raw.tif")
+    AutoScale.write_pyramid(str(tmp_path / "raw.tif"), str(tmp_path / "expected.tif"), **Settings)
+    filename = str(tmp_path / "input.tif")
+    image.save(filename, **options)
+    with open(filename, "rb") as file:
+        assert AutoScale.read_tiff_layout(file) is not None
+    AutoScale.write_pyramid(filename, str(tmp_path / "pyramid.tif"), **Settings)
+    
+    for (level, tags), (expected, expected_tags) in zip(pages(tmp_path / "pyramid.tif"), pages(tmp_path / "expected.tif")):
+        assert ImageChops.difference(level, expected).getbbox() is None
+
+def test_lzw_decompressor_streams(tmp_path, monkeypatch):
+    image = make_image((300, 200))
+    filename = str(tmp_path / "lzw.tif")
+    image.save(filename, compression = "tiff_lzw", tiffinfo = {278: 200})
+    # Every strip through LzwDecompressor, a band of rows at a time
+    monkeypatch.setattr(AutoScale, "Lzw_Libtiff_Size", 0)
+    with open(filename, "rb") as file:
+        layout = AutoScale.read_tiff_layout(file)
+        bands = list(AutoScale.read_tiff_bands(file, layout, 16))
+    assert [band.height for band in bands] == [16] * 12 + [8]
+    decoded = Image.new("RGB", image.size)
+    for number, band in enumerate(bands):
+        decoded.paste(band, (0, number * 16))
+    assert ImageChops.difference(decoded, image).getbbox() is None
+
+def test_open_large_image_keeps_the_size_limit(tmp_path, monkeypatch):
+    filename = str(tmp_path / "big.png")
+    Image.new("L", (2000, 1000)).save(filename)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100000)
+    with AutoScale.open_large_image(filename) as image:
+        assert image.size == (2000, 1000)
+        image.load()
+    assert Image.MAX_IMAGE_PIXELS == 100000
+    with pytest.raises(Image.DecompressionBombError):
+        Image.open(filename)
+
+def test_large_images_of_other_formats_are_still_refused(tmp_path, monkeypatch):
+    filename = str(tmp_path / "big.gif")
+    Image.new("L", (2000, 1000)).save(filename)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100000)
+    with pytest.raises(Image.DecompressionBombError):
+        AutoScale.open_large_image(filename)
+
+@pytest.mark.parametrize("extension", [".png", ".jpg"])
+def test_pyramid_of_other_formats_is_saved_as_tif(tmp_path, extension):
+    os.makedirs(tmp_path / "in")
+    filename = str(tmp_path / "in" / ("scan" + extension))
+    make_image().save(filename)
+    AutoScale.process_image(filename, str(tmp_path / "in"), str(tmp_path / "out"), pyramid = True, **Settings)
+    assert os.listdir(tmp_path / "out") == ["scan_with_scale.tif"]
+    with Image.open(tmp_path / "out" / "scan_with_scale.tif") as image:
+        assert image.format == "TIFF" and image.n_frames == 4
+    job = dict(filename = filename, input_dir = str(tmp_path / "in"), output_dir = str(tmp_path / "out"), pyramid = True, **Settings)
+    assert AutoScale.archive_name(job) == "scan_with_scale.tif"
@@ -0,0 +1,72 @@
+import os
+import pytest
+from PIL import Image, ImageChops, ImageStat
+
+import AutoScale
+
+Settings = dict(pixel_per_unit = AutoScale.ZOOM_10X, bar_width_unit = 50, unit = "um", color = "white")
+
+# Noisy enough that compression does not hide a wrong block, with a flat part so it also compresses
+def make_image(size = (700, 500)):
+    image = Image.effect_noise(size, 40).convert("RGB")
+    image.paste((20, 90, 160), (0, 0, size[0] // 2, size[1] // 2))
+    return image
+
+# Output of process_image without the region rewrite, as a reference
+def full_output(filename, output_dir):
+    AutoScale.process_image(filename, os.path.dirname(filename), str(output_dir), **Settings)
+    return Image.open(AutoScale.output_filename(filename, os.path.dirname(filename), str(output_dir), "_with_scale", True, None))
+
+@pytest.mark.parametrize("options", [dict(), dict(compression = "tiff_adobe_deflate"), dict(tiffinfo = {278: 16}),
+                                     dict(compression = "tiff_adobe_deflate", tiffinfo = {278: 16}), dict(big_tiff = True)],
+                         ids = ["raw", "deflate", "raw strips", "deflate strips", "bigtiff"])
+def test_strip_tiff_region_matches_process_image(tmp_path, options):
+    filename = str(tmp_path / "in" / "strips.tif")
+    os.makedirs(os.path.dirname(filename))
+    make_image().save(filename, **options)
+    region_filename = str(tmp_path / "region.tif")
+    assert AutoScale.rewrite_region(filename, region_filename, **Settings)
+    
+    with Image.open(region_filename) as region:
+        assert ImageChops.difference(region.convert("RGB"), full_output(filename, tmp_path / "full").convert("RGB")).getbbox() is None
+
+def test_tiled_tiff_region_matches_process_image(tmp_path):
+    # Pillow does not write tiled TIFF files, the pyramid output is one
+    source = str(tmp_path / "source.tif")
+    make_image((1100, 900)).save(source)
+    filename = str(tmp_path / "in" / "tiled.tif")
+    os.makedirs(os.path.dirname(filename))
+    AutoScale.write_pyramid(source, filename, AutoScale.ZOOM_10X / 2, 100, "um", "black")
+    with open(filename, "rb") as file:
+        assert AutoScale.read_tiff_layout(file).tiled
+    region_filename = str(tmp_path / "region.tif")
+    assert AutoScale.rewrite_region(filename, region_filename, **Settings)
+    
+    with Image.open(region_filename) as region:
+        assert ImageChops.difference(region.convert("RGB"), full_output(filename, tmp_path / "full").convert("RGB")).getbbox() is None
+
+def test_lzw_tiff_is_not_rewritten_by_region(tmp_path):
+    filename = str(tmp_path / "lzw.tif")
+    make_image().save(filename, compression = "tiff_lzw")
+    assert not AutoScale.rewrite_region(filename, str(tmp_path / "region.tif"), **Settings)
+
+def test_jpeg_region_only_changes_the_intervals_under_the_scale(tmp_path):
+    filename = str(tmp_path / "in" / "photo.jpg")
+    os.makedirs(os.path.dirname(filename))
+    make_image((800, 600)).save(filename, quality = 90, restart_marker_rows = 1)
+    region_filename = str(tmp_path / "region.jpg")
+    assert AutoScale.rewrite_region(filename, region_filename, **Settings)
+    
+    with Image.open(filename) as original, Image.open(region_filename) as region:
+        original, region = original.convert("RGB"), region.convert("RGB")
+        assert region.size == original.size
+        box = AutoScale.overlay_box(AutoScale.Overlay_Cache.get(original.size, *Settings.values()))
+        changed = ImageChops.difference(region, original).getbbox()
+        # Only the rows of restart intervals under the scale change (one MCU row of 16 pixels per interval here)
+        assert changed is not None
+        assert changed[1] >= box[1] // 16 * 16 and changed[3] <= (box[3] + 15) // 16 * 16
+        # and there the scale is drawn like process_image draws it, up to the loss of encoding these intervals again
+        expected = original.copy()
+        AutoScale.add_scale(expected, *Settings.values())
+        difference = ImageChops.difference(region.crop(box), expected.crop(box))
+        assert max(ImageStat.Stat(difference).mean) < 4
@@ -0,0 +1,75 @@
+import os
+from PIL import Image, ImageChops, ImageSequence, TiffImagePlugin
+
+import AutoScale
+
+Settings = dict(pixel_per_unit = AutoScale.ZOOM_10X, bar_width_unit = 50, unit = "um", color = "white")
+
+def make_frames(number, size = (400, 300)):
+    return [Image.new("RGB", size, (40 * i, 100, 255 - 40 * i)) for i in range(number)]
+
+def scaled(frame):
+    frame = frame.convert("RGB")
+    AutoScale.add_scale(frame, **Settings)
+    return frame
+
+def process(tmp_path, name):
+    stats = {}
+    AutoScale.process_image(str(tmp_path / "in" / name), str(tmp_path / "in"), str(tmp_path / "out"), stats = stats, **Settings)
+    root, extension = os.path.splitext(name)
+    return str(tmp_path / "out" / (root + "_with_scale" + extension)), stats
+
+def test_tiff_stack(tmp_path):
+    os.makedirs(tmp_path / "in")
+    frames = make_frames(4)
+    frames[0].save(tmp_path / "in" / "z.tif", save_all = True, append_images = frames[1:])
+    output, stats = process(tmp_path, "z.tif")
+    
+    assert stats["frames"] == 4
+    with Image.open(output) as stack:
+        assert stack.n_frames == 4
+        for frame, expected in zip(ImageSequence.Iterator(stack), frames):
+            assert ImageChops.difference(frame.convert("RGB"), scaled(expected)).getbbox() is None
+
+def test_reduced_tiff_pages_are_not_frames(tmp_path):
+    os.makedirs(tmp_path / "in")
+    frames = make_frames(3)
+    with TiffImagePlugin.AppendingTiffWriter(str(tmp_path / "in" / "z.tif"), True) as file:
+        for frame in frames:
+            frame.save(file, format = "TIFF")
+            file.newFrame()
+            frame.resize((100, 75)).save(file, format = "TIFF", tiffinfo = {254: 1})
+            file.newFrame()
+    output, stats = process(tmp_path, "z.tif")
+    
+    assert stats["frames"] == 3
+    with Image.open(output) as stack:
+        assert [frame.size for frame in ImageSequence.Iterator(stack)] == [(400, 300)] * 3
+
+def test_pyramid_input_is_not_a_stack(tmp_path):
+    os.makedirs(tmp_path / "in")
+    make_frames(1, (1000, 800))[0].save(tmp_path / "scan.tif")
+    AutoScale.write_pyramid(str(tmp_path / "scan.tif"), str(tmp_path / "in" / "pyramid.tif"), **Settings)
+    assert AutoScale.open_stack(str(tmp_path / "in" / "pyramid.tif"), str(tmp_path / "out.tif")) is None
+    output, stats = process(tmp_path, "pyramid.tif")
+    
+    assert "frames" not in stats
+    with Image.open(output) as image:
+        assert image.n_frames == 1
+
+def test_gif_stack(tmp_path):
+    os.makedirs(tmp_path / "in")
+    frames = make_frames(5)
+    frames[0].save(tmp_path / "in" / "t.gif", save_all = True, append_images = frames[1:], loop = 3, duration = 80)
+    output, stats = process(tmp_path, "t.gif")
+    
+    assert stats["frames"] == 5
+    with open(output, "rb") as file:
+        # One loop block, in the header
+        assert file.read().count(b"NETSCAPE2.0") == 1
+    with Image.open(output) as stack, Image.open(tmp_path / "in" / "t.gif") as original:
+        assert stack.n_frames == 5
+        assert stack.info["loop"] == 3
+        for frame, expected in zip(ImageSequence.Iterator(stack), ImageSequence.Iterator(original)):
+            assert frame.info["duration"] == 80
+            assert ImageChops.difference(frame.convert("RGB"), scaled(expected)).getbbox() is None
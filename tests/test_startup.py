@@ -0,0 +1,20 @@
+import os, sys, subprocess
+
+import AutoScale
+
+Folder = os.path.dirname(os.path.abspath(AutoScale.__file__))
+
+def loaded_after(code):
+    script = "import sys\n" + code + "\nprint(' '.join(sorted(sys.modules)))"
+    output = subprocess.run([sys.executable, "-c", script], cwd = Folder, capture_output = True, text = True, check = True).stdout
+    return set(output.split())
+
+def test_import_loads_no_heavy_module():
+    modules = loaded_after("import AutoScale")
+    for name in ("PIL.Image", "numpy", "sqlite3", "hashlib", "socket", "socketserver", "concurrent.futures", "logging", "zipfile", "tarfile"):
+        assert name not in modules
+
+def test_lazy_modules_load_on_first_use():
+    modules = loaded_after("import AutoScale\nAutoScale.hashlib.sha1\nAutoScale.futures.wait")
+    assert "hashlib" in modules and "concurrent.futures" in modules
+    assert "sqlite3" not in modules
@@ -0,0 +1,89 @@
+import os, time
+from PIL import Image
+
+import AutoScale
+
+def make_images(folder, number):
+    os.makedirs(folder)
+    paths = []
+    for index in range(number):
+        paths.append(os.path.join(folder, "%02d.png" % index))
+        Image.effect_noise((300, 200), 20 + index).convert("RGB").save(paths[-1])
+    return paths
+
+def count_loads(monkeypatch):
+    loads = []
+    load_thumbnail = AutoScale.load_thumbnail
+    def counting_load_thumbnail(filename, size):
+        loads.append(filename)
+        return load_thumbnail(filename, size)
+    monkeypatch.setattr(AutoScale, "load_thumbnail", counting_load_thumbnail)
+    return loads
+
+def cached_files(cache):
+    return sorted(name for name in os.listdir(cache.folder) if name.endswith(".png"))
+
+# Pretend the thumbnails were used one after the other, an hour apart, in the order of paths
+def set_use_order(cache, paths):
+    now = time.time()
+    for age, path in enumerate(reversed(paths)):
+        os.utime(cache.path(path), (now - 3600 * (age + 1), now - 3600 * (age + 1)))
+
+def test_thumbnails_are_reused_until_the_image_changes(tmp_path, monkeypatch):
+    path = make_images(str(tmp_path / "in"), 1)[0]
+    loads = count_loads(monkeypatch)
+    cache = AutoScale.ThumbnailCache(str(tmp_path / "cache"), thumbnail_size = 64)
+    thumbnail, full_size = cache.get(path)
+    assert full_size == (300, 200) and max(thumbnail.size) == 64
+    cached, cached_size = cache.get(path)
+    assert loads == [path] and cached_size == full_size and cached.tobytes() == thumbnail.tobytes()
+    # The default folder follows XDG_CACHE_HOME
+    assert AutoScale.ThumbnailCache().folder == os.path.join(os.environ["XDG_CACHE_HOME"], "MicroAutoScale", "thumbnails")
+
+    Image.new("RGB", (30, 20), "red").save(path)
+    stat = os.stat(path)
+    os.utime(path, ns = (stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert cache.get(path)[1] == (30, 20) and len(loads) == 2 and len(cached_files(cache)) == 2
+    cache.clear()
+    assert not os.path.exists(cache.folder) and cache.total_bytes == 0
+
+def test_least_recently_used_thumbnails_are_evicted(tmp_path, monkeypatch):
+    paths = make_images(str(tmp_path / "in"), 6)
+    loads = count_loads(monkeypatch)
+    cache = AutoScale.ThumbnailCache(str(tmp_path / "cache"), thumbnail_size = 64)
+    for path in paths[:4]:
+        cache.get(path)
+    sizes = dict((path, os.path.getsize(cache.path(path))) for path in paths[:4])
+    assert cache.total_bytes == sum(sizes.values())
+
+    # The first thumbnail was used again after the others, so the second one is the oldest
+    set_use_order(cache, [paths[1], paths[2], paths[3], paths[0]])
+    cache.get(paths[0])
+    assert len(loads) == 4
+    cache.max_bytes = sum(sizes.values()) + 10
+    cache.get(paths[4])
+    sizes[paths[4]] = os.path.getsize(cache.path(paths[4]))
+    # Deleted from the oldest, down to 90% of max_bytes and no further
+    expected, total = [paths[1], paths[2], paths[3], paths[0], paths[4]], sum(sizes.values())
+    while total > cache.max_bytes * 0.9:
+        total = total - sizes[expected.pop(0)]
+    assert [path for path in paths[:5] if os.path.exists(cache.path(path))] == sorted(expected)
+    assert paths[1] not in expected and paths[0] in expected and paths[4] in expected
+    assert cache.total_bytes == total == sum(os.path.getsize(os.path.join(cache.folder, name)) for name in cached_files(cache))
+
+def test_total_is_counted_from_the_folder(tmp_path):
+    paths = make_images(str(tmp_path / "in"), 3)
+    folder = str(tmp_path / "cache")
+    AutoScale.ThumbnailCache(folder, thumbnail_size = 64).get(paths[0])
+    # A new cache (another session) counts what is already there, and evicts it if it is over the limit
+    cache = AutoScale.ThumbnailCache(folder, max_bytes = 1, thumbnail_size = 64)
+    cache.get(paths[1])
+    assert cached_files(cache) == [] and cache.total_bytes == 0
+
+def test_unwritable_folder_keeps_nothing(tmp_path, monkeypatch):
+    path = make_images(str(tmp_path / "in"), 1)[0]
+    (tmp_path / "cache").write_bytes(b"a file, not a folder")
+    loads = count_loads(monkeypatch)
+    cache = AutoScale.ThumbnailCache(str(tmp_path / "cache"), thumbnail_size = 64)
+    assert cache.get(path)[1] == (300, 200) and cache.get(path)[1] == (300, 200)
+    assert len(loads) == 2